@@ -17,11 +17,14 @@ from warnings import warn
 from datasets.CRU import loadCRU_StnTS
 from datasets.common import days_per_month, getRootFolder, selectElements, translateVarNames
 from datasets.common import CRU_vars, stn_params, nullNaN
+from datasets.common import getRecordCacheFile, refreshRecordCache, loadRecordCache, saveRecordCache
+from datasets.common import matchStationRecords, mergeStationRecords, monthLengths, monthlyExtremes, extremesKernel
 from geodata.misc import ParseError, DateError, VariableError, ArgumentError, DatasetError, AxisError
 from geodata.misc import RecordClass, StrictRecordClass, isNumber, isInt 
 from geodata.base import Axis, Variable, Dataset
 from utils.nctools import writeNetCDF
 from geodata.netcdf import DatasetNetCDF
+from utils.parallel import shared_fill_rows
 # import derived variables from the WRF Tools package wrfavg
 import imp, os
 # read code root folder from environment variable
@@ -145,8 +148,69 @@ class DailyStationRecord(StrictRecordClass):
     self.validateHeader(f.readline()) # read first line as header
     f.close()
   
-  def parseRecord(self):
-    ''' open the station file and parse records; return a daiy time-series '''
+  def parseRecord(self, lvectorize=True, lflags=False):
+    ''' open the station file and parse records; return a daily time-series (and data flags, if lflags=True) '''
+    if lvectorize: return self.parseRecordArray(lflags=lflags)
+    elif lflags: raise NotImplementedError, "Data flags are only returned by the vectorized parser."
+    else: return self.parseRecordLoop()
+  
+  def parseRecordArray(self, lflags=False):
+    ''' open the station file and parse all records at once using NumPy string operations; return a daily 
+        time-series and, if lflags=True, an array of data flags ('' for no flag and 'M' for missing values) '''
+    # read entire file and validate header
+    f = codecs.open(self.filename, 'r', encoding=self.encoding)
+    lines = f.read().splitlines(); f.close()
+    self.validateHeader(lines[0]) # first line is header
+    # remove title lines and tokenize the remaining data lines in one pass
+    lines = [line.replace('-9999.9', ' -9999.9') for line in lines[1:] if line.strip() and line.split(None,1)[0] != 'Year']
+    # N.B.: without the replace, the split doesn't work
+    tokens = np.array(' '.join(lines).split())
+    if tokens.size != 33*len(lines):
+      for line in lines: # find offending line (only in case of errors)
+        if len(line.split()) != 33: raise ParseError, 'Line has {:d} values instead of 31:\n {:s}'.format(len(line.split())-2,line)
+    tokens = tokens.reshape((len(lines),33))
+    try: 
+      year = tokens[:,0].astype(np.int); mon = tokens[:,1].astype(np.int)
+    except ValueError:
+      raise ParseError, "No valid title or data found at begining of file:\n {:s}".format(self.filename)
+    # check continuity (no gaps allowed) and skip dates after the specified end date
+    months = ( year - self.begin_year ) * 12 + mon - self.begin_mon # months since begin of record
+    gaps = np.flatnonzero(months != np.arange(len(months)))
+    if len(gaps) > 0: raise DateError, lines[gaps[0]]
+    nmon = (self.end_year - self.begin_year) * 12 + (self.end_mon - self.begin_mon +1)
+    if len(months) < nmon: raise ParseError, 'Reached end of file before specified end date: {:s}'.format(self.filename)
+    values = tokens[:nmon,2:].ravel() # 31 days per month (padded with missing values)
+    # split off data flags
+    lmissing = np.char.startswith(values, self.missing) # missing values; or num[-1] == 'M'
+    numbers = np.char.rstrip(values, self.flags)
+    numlen = np.char.str_len(numbers); flaglen = np.char.str_len(values) - numlen
+    lastchar = numbers.view(numbers.dtype.kind+'1').reshape((numbers.size,-1))[np.arange(numbers.size),np.maximum(numlen-1,0)]
+    linvalid = np.logical_or(flaglen > 1, np.logical_not(np.char.isdigit(lastchar))) # at most one flag after a digit
+    if 'float' in self.dtype: linvalid = np.logical_or(linvalid, np.logical_or(np.char.find(numbers, '.') < 0, numlen < 2)) # at least 1 digit plus decimal
+    linvalid = np.logical_and(linvalid, np.logical_not(lmissing))
+    if np.any(linvalid):
+      num = values[np.flatnonzero(linvalid)[0]]; line = lines[np.flatnonzero(linvalid)[0]//31]
+      raise ParseError, "Unable to process value '{:s}' in line:\n {:s}".format(num,line)
+    # convert values and screen for values out of bounds
+    numbers[lmissing] = 'nan' # missing values are filled with NaN
+    data = numbers.astype(np.float64)
+    with np.errstate(invalid='ignore'): # NaN comparisons
+      lbounds = np.logical_or(data < self.varmin, data > self.varmax)
+    if np.any(lbounds): 
+      warn("Encountered {:d} values outside of the valid range [{:f}, {:f}] in file (ignored):\n {:s}".format(
+            lbounds.sum(), self.varmin, self.varmax, self.filename))
+      data[lbounds] = np.NaN
+    data = data.astype(self.dtype)
+    # return array (and flags)
+    if lflags:
+      chars = values.view(values.dtype.kind+'1').reshape((values.size,-1))
+      flags = np.where(flaglen > 0, chars[np.arange(values.size),np.minimum(numlen,chars.shape[1]-1)], '')
+      flags[lmissing] = 'M'
+      return data, flags.astype(values.dtype.kind+'1')
+    else: return data
+  
+  def parseRecordLoop(self):
+    ''' open the station file and parse records line by line; return a daiy time-series '''
     # open file
     f = codecs.open(self.filename, 'r', encoding=self.encoding)
     self.validateHeader(f.readline()) # read first line as header
@@ -209,6 +273,22 @@ class DailyStationRecord(StrictRecordClass):
     return data
   
 
+def parseStationRecord(station, cache_folder=None, **kwargs):
+  ''' parse a station record, using a binary cache, if a cache folder is given; also a helper function to parse 
+      station records in worker processes (bound methods can not be pickled) '''
+  if cache_folder is None: return station.parseRecord(**kwargs)
+  cachefile = getRecordCacheFile(station.filename, station.variable, cache_folder)
+  data, atts = loadRecordCache(station.filename, cachefile, lmmap=True)
+  if data is not None:
+    # compare with station meta data and dates (EC records are defined by the station file)
+    if atts['begin_year'] != station.begin_year or atts['begin_mon'] != station.begin_mon or atts['end_year'] != station.end_year or atts['end_mon'] != station.end_mon: data = None
+  if data is None:
+    data = station.parseRecord(**kwargs)
+    saveRecordCache(station.filename, cachefile, data, begin_year=station.begin_year, begin_mon=station.begin_mon, 
+                    end_year=station.end_year, end_mon=station.end_mon)
+  return data
+
+
 ## class that defines variable properties (specifics are implemented in children)
 class VarDef(RecordClass):
   # variable specific
@@ -319,6 +399,9 @@ temp_xtrm.append(dict(name='CSD', var='Tmax', mode='above', threshold=273.15+25.
 temp_xtrm.append(dict(name='CFD', var='Tmin', mode='below', threshold=273.15, 
                       long_name='Consecutive Frost Days (< 0C)', klass=dv.ConsecutiveExtrema))
 
+# extremes that can be computed with batched kernels for all months at once (see monthlyExtremes)
+extremes_kernels = {dv.Extrema:'extrema', dv.MeanExtrema:'runmean', dv.ConsecutiveExtrema:'consecutive'}
+
 # map from common variable names to WRF names (which are used in the derived_variables module)
 ec_varmap = dict(RAIN='precip', south_north='time', time='station', west_east=None, # swap order of axes                 
                  T2MIN='Tmin', T2MAX='Tmax', FrostDays='frzfrq', SummerDays='sumfrq') 
@@ -366,6 +449,7 @@ class StationRecords(object):
   constraints    = None # constraints to limit the number of stations that are loaded
   # internal variables
   stationlists   = None # list of station objects
+  previous       = None # matching records from an existing dataset (for incremental update)
   dataset        = None # GeoPy Dataset (will hold results) 
   
   def __init__(self, folder='', stationfile='stations.txt', variables=None, extremes=None, interval='daily', 
@@ -467,9 +551,10 @@ class StationRecords(object):
             self.stationlists[varname].append(station)
     assert len(self.stationlists[varname]) == ns # make sure we got all (lists should have the same length)
     
-  def prepareDataset(self, filename=None, folder=None):
+  def prepareDataset(self, filename=None, folder=None, lincremental=False):
     ''' prepare a GeoPy dataset for the station data (with all the meta data); 
-        create a NetCDF file for monthly data; also add derived variables          '''
+        create a NetCDF file for monthly data; also add derived variables; in incremental mode, 
+        records from an existing NetCDF file are reused for unchanged stations  '''
     if folder is None: folder = avgfolder # default folder scheme 
     elif not isinstance(folder,basestring): raise TypeError
     if filename is None: filename = 'ec{:s}_monthly.nc'.format(self.datatype) # default folder scheme 
@@ -523,6 +608,9 @@ class StationRecords(object):
       dataset += Variable(axes=(station,), data=np.zeros(len(station), dtype='int16'),  **tmpatts)
     # write dataset to file
     ncfile = '{:s}/{:s}'.format(folder,filename)      
+    # load existing records for incremental update (before the file is overwritten)
+    if lincremental and os.path.exists(ncfile): self.previous = matchStationRecords(ncfile, dataset)
+    else: self.previous = None
     #zlib = dict(chunksizes=dict(station=len(station))) # compression settings; probably OK as is 
     ncset = writeNetCDF(dataset, ncfile, feedback=False, overwrite=True, writeData=True, 
                         skipUnloaded=True, close=False, zlib=True)
@@ -531,7 +619,11 @@ class StationRecords(object):
     for xvar in self.extremes:
       if isinstance(xvar,dict):
         var = xvar.pop('var'); mode = xvar.pop('mode'); Klass = xvar.pop('klass')
+        if Klass in extremes_kernels: # parameters for batched computation over all months
+          kernel = extremesKernel(Klass, extremes_kernels[Klass], mode, **xvar)
+        else: kernel = None
         xvar = Klass(ncset.variables[var], mode, ignoreNaN=True, **xvar)
+        xvar.kernel = kernel
         xvar.prerequisites = [self.ravmap.get(varname,varname) for varname in xvar.prerequisites]
       elif isinstance(xvar,dv.DerivedVariable):
         xvar.axes = tuple([self.varmap.get(varname,varname) for varname in xvar.axes if self.varmap.get(varname,varname)])
@@ -552,13 +644,35 @@ class StationRecords(object):
     # reopen netcdf file with netcdf dataset
     self.dataset = DatasetNetCDF(dataset=ncset, mode='rw', load=True) # always need to specify mode manually
     
-  def readStationData(self):
-    ''' read station data from source files and store in dataset '''
+  def readStationData(self, NP=1, lvectorize=True, lcache=True, cache_folder=None, lbatch=True):
+    ''' read station data from source files and store in dataset; if NP > 1, station files are parsed 
+        in parallel and written directly to a shared (station, month, 31) buffer; parsed records are 
+        cached in binary files and in incremental mode only new or changed stations are processed; 
+        if lbatch=True, extremes are computed for all months at once (the monthly loop is the reference) '''
     assert self.dataset
+    # binary cache for parsed station records
+    if lcache:
+      if cache_folder is None: cache_folder = '{:s}/cache/'.format(self.folder) # default folder scheme
+      if not os.path.exists(cache_folder): os.makedirs(cache_folder)
+    else: cache_folder = None
+    # determine stations that have to be processed (in incremental mode only new or changed records)
+    nstn = len(self.dataset.station)
+    if self.previous is None or cache_folder is None: sidx = np.arange(nstn)
+    elif not all(varname in self.previous['data'] for varname in self.variables.keys()+[var.name for var in self.extremes]):
+      sidx = np.arange(nstn) # different variables
+    else:
+      lchanged = self.previous['index'] < 0 # new stations
+      for stationlist in self.stationlists.itervalues():
+        for s,station in enumerate(stationlist):
+          if not lchanged[s]:
+            cachefile = getRecordCacheFile(station.filename, station.variable, cache_folder)
+            lchanged[s] = not refreshRecordCache(station.filename, cachefile) # also store new mtime
+      sidx = np.flatnonzero(lchanged)
+      print("\n   Incremental update: {:d} of {:d} stations are new or changed".format(len(sidx),nstn))
     # determine record begin and end indices
     all_begin = self.dataset.time.coord[0] # coordinate value of first time step
-    begin_idx = ( self.dataset.stn_begin_date.getArray() - all_begin ) * 31.
-    end_idx = ( self.dataset.stn_end_date.getArray() - all_begin + 1 ) * 31.
+    begin_idx = ( self.dataset.stn_begin_date.getArray()[sidx].astype(np.int) - all_begin ) * 31
+    end_idx = ( self.dataset.stn_end_date.getArray()[sidx].astype(np.int) - all_begin + 1 ) * 31
     # loop over variables
     dailydata = dict() # to store daily data for derived variables
     monlydata = dict() # monthly data, but transposed
@@ -568,26 +682,33 @@ class StationRecords(object):
       print("\n {:s} ('{:s}'):\n".format(vardef.name.title(),var))
       varobj = self.dataset[var] # get variable object
       wrfvar = ravmap.get(varobj.name,varobj.name)
-      # allocate array
-      shape = (varobj.shape[0], varobj.shape[1]*31) # daily data!
-      dailytmp = np.empty(shape, dtype=varobj.dtype); dailytmp.fill(np.NaN) # initialize all with NaN
-      # loop over stations
-      s = 0 # station counter
-      for station in self.stationlists[var]:
-        print("   {:<15s} {:s}".format(station.name,station.filename))
-        # read station file
-        dailytmp[s,begin_idx[s]:end_idx[s]] = station.parseRecord()  
-        s += 1 # next station
-      assert s == varobj.shape[0]
+      stationlist = [self.stationlists[var][s] for s in sidx] # only stations that need to be processed
+      shape = (len(sidx),varobj.shape[1]) # monthly data for these stations
+      if NP > 1:
+        # parse station files in parallel and fill shared array
+        for station in stationlist: print("   {:<15s} {:s}".format(station.name,station.filename))
+        s = len(stationlist) # number of stations
+        dailytmp = shared_fill_rows(parseStationRecord, [(station,) for station in stationlist], 
+                                    zip(begin_idx,end_idx), shape+(31,), varobj.dtype, fillValue=np.NaN, 
+                                    NP=NP, kwargs=dict(lvectorize=lvectorize, cache_folder=cache_folder))
+      else:
+        # allocate array
+        dailytmp = np.empty((shape[0],shape[1]*31), dtype=varobj.dtype); dailytmp.fill(np.NaN) # initialize all with NaN
+        # loop over stations
+        s = 0 # station counter
+        for station in stationlist:
+          print("   {:<15s} {:s}".format(station.name,station.filename))
+          # read station file
+          dailytmp[s,begin_idx[s]:end_idx[s]] = parseStationRecord(station, cache_folder=cache_folder, lvectorize=lvectorize)  
+          s += 1 # next station
+      assert s == shape[0]
       dailytmp = vardef.convert(dailytmp) # apply conversion function
       # compute monthly average
-      dailytmp = dailytmp.reshape(varobj.shape+(31,))
+      dailytmp = dailytmp.reshape(shape+(31,))
       monlytmp = np.nanmean(dailytmp,axis=-1) # squeezes automatically
       # store daily and monthly data for computation of derived variables
       dailydata[wrfvar] = dailytmp
       monlydata[wrfvar] = monlytmp
-      # load data
-      varobj.load(monlytmp) # varobj.sync()
       del dailytmp, monlytmp
     # loop over derived nonlinear variables/extremes
     if any(not var.linear for var in self.extremes): print('\n computing (nonlinear) daily variables:')
@@ -598,39 +719,43 @@ class StationRecords(object):
         if var.name not in ravmap: ravmap[var.name] = var.name # naming convention for tmp storage 
         wrfvar = ravmap[var.name] 
         # allocate memory for monthly values
-        tmp = np.ma.empty(varobj.shape, dtype=varobj.dtype); tmp.fill(np.NaN) 
+        tmp = np.ma.empty(shape, dtype=varobj.dtype); tmp.fill(np.NaN) 
         # N.B.: some derived variable types may return masked arrays
         monlydata[wrfvar] = tmp
+    # compute extremes with batched kernels for all months at once
+    lengths = monthLengths(self.dataset.time.coord, year0=1979) # correct month lengths, including leap years
+    monthly = [] # variables that are computed in the monthly loop
+    for var in self.extremes:      
+      if not var.linear:
+        if lbatch and getattr(var,'kernel',None) is not None:
+          if s > 0: monlydata[ravmap[var.name]][:] = monthlyExtremes(dailydata[var.prerequisites[0]], lengths, **var.kernel)
+        else: monthly.append(var)
     # loop over time steps to compute nonlinear variables from daily values    
     tmpvars = dict()
-    for m,mon in enumerate(varobj.axes[1].coord):
-      # figure out length of month
-      if mon%12 == 1: # February
-        if calendar.isleap(1979 + mon/12): lmon = 29
-        else: lmon = 28
-      else: lmon = days_per_month[mon%12]
+    for m,lmon in enumerate(lengths if s > 0 and monthly else []): # skip, if there is nothing to do
       # construct arrays for this month
       tmpdata = {varname:data[:,m,0:lmon] for varname,data in dailydata.iteritems()}      
-      for var in self.extremes:      
-        if not var.linear:
-          varobj = self.dataset[var.name] # get variable object
-          wrfvar = ravmap[var.name]
-          dailytmp = var.computeValues(tmpdata, aggax=1, delta=86400., tmp=tmpvars)        
-          tmpdata[wrfvar] = dailytmp
-          monlytmp = var.aggregateValues(dailytmp, aggdata=None, aggax=1) # last axis
-          assert monlytmp.shape == (s,)
-          monlydata[wrfvar][:,m] = monlytmp
+      for var in monthly:      
+        varobj = self.dataset[var.name] # get variable object
+        wrfvar = ravmap[var.name]
+        dailytmp = var.computeValues(tmpdata, aggax=1, delta=86400., tmp=tmpvars)        
+        tmpdata[wrfvar] = dailytmp
+        monlytmp = var.aggregateValues(dailytmp, aggdata=None, aggax=1) # last axis
+        assert monlytmp.shape == (s,)
+        monlydata[wrfvar][:,m] = monlytmp
     # loop over linear derived variables/extremes
     if any(var.linear for var in self.extremes): print('\n computing (linear) monthly variables:')
     for var in self.extremes:      
-      varobj = self.dataset[var.name] # get variable object
       wrfvar = ravmap[var.name]
       if var.linear:
         # compute from available monthly data
         print("   {:<15s} {:s}".format(var.name,str(tuple(self.varmap.get(varname,varname) for varname in var.prerequisites))))
         monlytmp = var.computeValues(monlydata, aggax=1, delta=86400.)
         monlydata[wrfvar] = monlytmp
-      tmpload = monlydata[wrfvar]
+    # load data (merged with unchanged records in incremental mode)
+    for varname in self.variables.keys()+[var.name for var in self.extremes]:
+      varobj = self.dataset[varname] # get variable object
+      tmpload = mergeStationRecords(self.previous, varname, monlydata[ravmap.get(varname,varname)], sidx, varobj.shape)
       assert varobj.shape == tmpload.shape
       varobj.load(tmpload)
     # determine actual length of records (valid data points)
@@ -650,8 +775,9 @@ class StationRecords(object):
     self.dataset['stn_rec_len'].load(minlen)
     # synchronize data, i.e. write to disk
     self.dataset.sync()
+    self.previous = None # release memory
     
-    
+
 ## load pre-processed EC station time-series
 def loadEC_TS(name=None, filetype=None, prov=None, varlist=None, varatts=None, 
               filelist=None, folder=None, **kwargs): 
@@ -881,6 +1007,9 @@ if __name__ == '__main__':
 #   mode = 'test_conversion'
 #   mode = 'convert_prov_stations'
 #   mode = 'convert_all_stations'
+  # number of processes used to parse station files (default: serial)
+  if os.environ.has_key('PYAVG_THREADS'): NP = int(os.environ['PYAVG_THREADS'])
+  else: NP = 1
   
   # test wrapper function to load time series data from EC stations
   if mode == 'test_selection':
@@ -1043,7 +1172,7 @@ if __name__ == '__main__':
         filename = tsfile_prov.format(variables.values()[0].datatype,prov)        
         stations.prepareDataset(filename=filename, folder=None)
         # read actual station data
-        stations.readStationData()
+        stations.readStationData(NP=NP)
 
 
   # convert all station date to NetCDF
@@ -1059,6 +1188,6 @@ if __name__ == '__main__':
       # create netcdf file
       stations.prepareDataset(filename=None, folder=None) # default settings
       # read actual station data
-      stations.readStationData()
+      stations.readStationData(NP=NP)
       
       
\ No newline at end of file
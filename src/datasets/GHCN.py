@@ -17,11 +17,14 @@ from warnings import warn
 from datasets.CRU import loadCRU_StnTS
 from datasets.common import days_per_month, getRootFolder, selectElements, translateVarNames
 from datasets.common import CRU_vars, stn_params, nullNaN
-from geodata.misc import ParseError, ArgumentError, DatasetError, AxisError
+from datasets.common import getRecordCacheFile, refreshRecordCache, loadRecordCache, saveRecordCache
+from datasets.common import matchStationRecords, mergeStationRecords, monthLengths, monthlyExtremes, extremesKernel
+from geodata.misc import ParseError, DateError, ArgumentError, DatasetError, AxisError
 from geodata.misc import RecordClass, StrictRecordClass, isNumber, isInt 
 from geodata.base import Axis, Variable, Dataset
 from utils.nctools import writeNetCDF
 from geodata.netcdf import DatasetNetCDF
+from utils.parallel import shared_fill_rows
 # import derived variables from the WRF Tools package wrfavg
 import imp, os
 # read code root folder from environment variable
@@ -90,6 +93,8 @@ for threshold in precip_thresholds:
 # list of variables to load
 variable_list = varatts.keys() # also includes coordinate fields    
 
+linelen = 269 # number of characters in a line of a daily station file
+
 class DailyStationRecord(StrictRecordClass):
   '''
     A class that is used by StationRecords to facilitate access to daily station records from ASCII files.  
@@ -130,8 +135,62 @@ class DailyStationRecord(StrictRecordClass):
     self.validateHeader(f.readline()) # read first line as header
     f.close()
   
-  def parseRecord(self):
-    ''' open the station file and parse records; return a daily time-series '''
+  def parseRecord(self, lvectorize=True, lflags=False):
+    ''' open the station file and parse records; return a daily time-series (and data flags, if lflags=True) '''
+    if lvectorize: return self.parseRecordArray(lflags=lflags)
+    elif lflags: raise NotImplementedError, "Data flags are only returned by the vectorized parser."
+    else: return self.parseRecordLoop()
+  
+  def parseRecordArray(self, lflags=False):
+    ''' open the station file and parse all records at once using a fixed-width NumPy character array; return 
+        a daily time-series and, if lflags=True, an array of data flags (mflag, qflag and sflag combined) '''
+    # read entire file
+    f = codecs.open(self.filename, 'r', encoding=self.encoding)
+    lines = f.read().splitlines(); f.close()
+    if len(lines[-1]) < linelen: raise ParseError,'last line incomplete'
+    # the record extends from the first to the last line (all variables)
+    self.begin_year = int(lines[0][11:15]); self.begin_mon = int(lines[0][15:17])
+    self.end_year = int(lines[-1][11:15]); self.end_mon = int(lines[-1][15:17])
+    # allocate daily data array (31 days per month, filled with NaN for missing values)
+    nmon = (self.end_year - self.begin_year) * 12 + (self.end_mon - self.begin_mon +1)
+    data = np.empty((nmon,31), dtype=self.dtype); data.fill(np.NaN) # use NaN as missing values
+    flags = np.zeros((nmon,31), dtype='U3') # no flags
+    # select lines with the variable we're looking for and convert to character array
+    lines = [line for line in lines if line[17:21] == self.variable]
+    if len(lines) > 0:
+      chars = np.array(lines, dtype='U{:d}'.format(linelen)).view('U1').reshape((len(lines),linelen))
+      def columns(i0, width): # extract fixed-width columns
+        cols = i0 + 8*np.arange(31).reshape((31,1)) + np.arange(width) # 31 fields, spaced 8 characters apart
+        return np.ascontiguousarray(chars[:,cols]).view('U{:d}'.format(width)).reshape((len(lines),31))
+      # check dates (gaps are filled with missing values)
+      try:
+        year = np.ascontiguousarray(chars[:,11:15]).view('U4').ravel().astype(np.int)
+        mon = np.ascontiguousarray(chars[:,15:17]).view('U2').ravel().astype(np.int)
+      except ValueError: raise ParseError, "Invalid dates in file: {:s}".format(self.filename)
+      months = ( year - self.begin_year ) * 12 + mon - self.begin_mon # months since begin of record
+      if np.any(np.diff(months) < 1) or months[0] < 0 or months[-1] >= nmon or np.any(mon < 1) or np.any(mon > 12): 
+        raise DateError, "Dates are not continuous in file: {:s}".format(self.filename)
+      # convert daily values (5 characters, followed by 3 flags)
+      values = columns(21, 5)
+      lmissing = values == self.missing
+      values[lmissing] = 'nan' # missing values are filled with NaN
+      try: tmp = values.astype(np.float64)
+      except ValueError: raise ParseError, "Unable to process values in file: {:s}".format(self.filename)
+      # screen for values out of bounds
+      with np.errstate(invalid='ignore'): # NaN comparisons
+        lbounds = np.logical_or(tmp < self.varmin, tmp > self.varmax)
+      if np.any(lbounds): 
+        warn("Encountered {:d} values outside of the valid range [{:f}, {:f}] in file (ignored):\n {:s}".format(
+              lbounds.sum(), self.varmin, self.varmax, self.filename))
+        tmp[lbounds] = np.NaN
+      data[months,:] = tmp
+      if lflags: flags[months,:] = columns(26, 3)
+    # return array (and flags)
+    if lflags: return data.ravel(), flags.ravel()
+    else: return data.ravel()
+  
+  def parseRecordLoop(self):
+    ''' open the station file and parse records line by line; return a daily time-series '''
     # open file
     f = codecs.open(self.filename, 'r', encoding=self.encoding)
     infoline=f.readlines()
@@ -205,6 +264,22 @@ class DailyStationRecord(StrictRecordClass):
     return data
   
 
+def parseStationRecord(station, cache_folder=None, **kwargs):
+  ''' parse a station record, using a binary cache, if a cache folder is given; also a helper function to parse 
+      station records in worker processes (bound methods can not be pickled) '''
+  if cache_folder is None: return station.parseRecord(**kwargs)
+  cachefile = getRecordCacheFile(station.filename, station.variable, cache_folder)
+  data, atts = loadRecordCache(station.filename, cachefile, lmmap=True)
+  if data is None:
+    data = station.parseRecord(**kwargs)
+    saveRecordCache(station.filename, cachefile, data, begin_year=station.begin_year, begin_mon=station.begin_mon, 
+                    end_year=station.end_year, end_mon=station.end_mon)
+  else:
+    # the record extends from the first to the last line of the file (all variables)
+    for key,value in atts.iteritems(): setattr(station, key, int(value))
+  return data
+
+
 ## class that defines variable properties (specifics are implemented in children)
 class VarDef(RecordClass):
   # variable specific
@@ -308,6 +383,9 @@ temp_xtrm.append(dict(name='CSD', var='Tmax', mode='above', threshold=273.15+25.
                       long_name='Consecutive Summer Days (>25C)', klass=dv.ConsecutiveExtrema))
 temp_xtrm.append(dict(name='CFD', var='Tmin', mode='below', threshold=273.15, 
                       long_name='Consecutive Frost Days (< 0C)', klass=dv.ConsecutiveExtrema))
+# extremes that can be computed with batched kernels for all months at once (see monthlyExtremes)
+extremes_kernels = {dv.Extrema:'extrema', dv.MeanExtrema:'runmean', dv.ConsecutiveExtrema:'consecutive'}
+
 # map from common variable names to WRF names (which are used in the derived_variables module)
 ghcn_varmap = dict(RAIN='precip', south_north='time', time='station', west_east=None, # swap order of axes                 
                  TAMIN='Tmin', TAMAX='Tmax', FrostDays='frzfrq', SummerDays='sumfrq') 
@@ -357,6 +435,7 @@ class StationRecords(object):
   constraints    = None # constraints to limit the number of stations that are loaded
   # internal variables
   stationlists   = None # list of station objects
+  previous       = None # matching records from an existing dataset (for incremental update)
   dataset        = None # GeoPy Dataset (will hold results) 
   
   def __init__(self, folder=root_folder, stationfile='ghcnd-stations.txt', variables=None, extremes=None, interval='daily', 
@@ -446,9 +525,10 @@ class StationRecords(object):
 
     assert len(self.stationlists[varname]) == ns # make sure we got all (lists should have the same length)
     
-  def prepareDataset(self, filename=None, folder=None, station_folder=None):
+  def prepareDataset(self, filename=None, folder=None, station_folder=None, lincremental=False):
     ''' prepare a GeoPy dataset for the station data (with all the meta data); 
-        create a NetCDF file for monthly data; also add derived variables          '''
+        create a NetCDF file for monthly data; also add derived variables; in incremental mode, 
+        records from an existing NetCDF file are reused for unchanged stations  '''
     if folder is None: folder = avgfolder # default folder scheme 
     elif not isinstance(folder,basestring): raise TypeError, folder
     if station_folder is None: station_folder = '{:s}/ghcnd_all/'.format(root_folder) # default folder scheme 
@@ -525,6 +605,9 @@ class StationRecords(object):
       dataset += Variable(axes=(station,), data=np.zeros(len(station), dtype='int16'),  **tmpatts)
     # write dataset to file
     ncfile = '{:s}/{:s}'.format(folder,filename)      
+    # load existing records for incremental update (before the file is overwritten)
+    if lincremental and os.path.exists(ncfile): self.previous = matchStationRecords(ncfile, dataset)
+    else: self.previous = None
     #zlib = dict(chunksizes=dict(station=len(station))) # compression settings; probably OK as is 
     ncset = writeNetCDF(dataset, ncfile, feedback=False, overwrite=True, writeData=True, 
                         skipUnloaded=True, close=False, zlib=True)
@@ -533,7 +616,11 @@ class StationRecords(object):
     for xvar in self.extremes:
       if isinstance(xvar,dict):
         var = xvar.pop('var'); mode = xvar.pop('mode'); Klass = xvar.pop('klass')
+        if Klass in extremes_kernels: # parameters for batched computation over all months
+          kernel = extremesKernel(Klass, extremes_kernels[Klass], mode, **xvar)
+        else: kernel = None
         xvar = Klass(ncset.variables[var], mode, ignoreNaN=True, **xvar)
+        xvar.kernel = kernel
         xvar.prerequisites = [self.ravmap.get(varname,varname) for varname in xvar.prerequisites]
       elif isinstance(xvar,dv.DerivedVariable):
         xvar.axes = tuple([self.varmap.get(varname,varname) for varname in xvar.axes if self.varmap.get(varname,varname)])
@@ -552,13 +639,35 @@ class StationRecords(object):
     # reopen netcdf file with netcdf dataset
     self.dataset = DatasetNetCDF(dataset=ncset, mode='rw', load=True) # always need to specify mode manually
     
-  def readStationData(self):
-    ''' read station data from source files and store in dataset '''
+  def readStationData(self, NP=1, lvectorize=True, lcache=True, cache_folder=None, lbatch=True):
+    ''' read station data from source files and store in dataset; if NP > 1, station files are parsed 
+        in parallel and written directly to a shared (station, month, 31) buffer; parsed records are 
+        cached in binary files and in incremental mode only new or changed stations are processed; 
+        if lbatch=True, extremes are computed for all months at once (the monthly loop is the reference) '''
     assert self.dataset
+    # binary cache for parsed station records
+    if lcache:
+      if cache_folder is None: cache_folder = '{:s}/cache/'.format(self.folder) # default folder scheme
+      if not os.path.exists(cache_folder): os.makedirs(cache_folder)
+    else: cache_folder = None
+    # determine stations that have to be processed (in incremental mode only new or changed records)
+    nstn = len(self.dataset.station)
+    if self.previous is None or cache_folder is None: sidx = np.arange(nstn)
+    elif not all(varname in self.previous['data'] for varname in self.variables.keys()+[var.name for var in self.extremes]):
+      sidx = np.arange(nstn) # different variables
+    else:
+      lchanged = self.previous['index'] < 0 # new stations
+      for stationlist in self.stationlists.itervalues():
+        for s,station in enumerate(stationlist):
+          if not lchanged[s]:
+            cachefile = getRecordCacheFile(station.filename, station.variable, cache_folder)
+            lchanged[s] = not refreshRecordCache(station.filename, cachefile) # also store new mtime
+      sidx = np.flatnonzero(lchanged)
+      print("\n   Incremental update: {:d} of {:d} stations are new or changed".format(len(sidx),nstn))
     # determine record begin and end indices
     all_begin = self.dataset.time.coord[0] # coordinate value of first time step
-    begin_idx = ( self.dataset.stn_begin_date.getArray() - all_begin ) * 31.
-    end_idx = ( self.dataset.stn_end_date.getArray() - all_begin + 1 ) * 31.
+    begin_idx = ( self.dataset.stn_begin_date.getArray()[sidx].astype(np.int) - all_begin ) * 31
+    end_idx = ( self.dataset.stn_end_date.getArray()[sidx].astype(np.int) - all_begin + 1 ) * 31
     # loop over variables
     dailydata = dict() # to store daily data for derived variables
     monlydata = dict() # monthly data, but transposed
@@ -568,26 +677,33 @@ class StationRecords(object):
       print("\n {:s} ('{:s}'):\n".format(vardef.name.title(),var))
       varobj = self.dataset[var] # get variable object
       wrfvar = ravmap.get(varobj.name,varobj.name)
-      # allocate array
-      shape = (varobj.shape[0], varobj.shape[1]*31) # daily data!
-      dailytmp = np.empty(shape, dtype=varobj.dtype); dailytmp.fill(np.NaN) # initialize all with NaN
-      # loop over stations
-      s = 0 # station counter
-      for station in self.stationlists[var]:
-        print("   {:<15s} {:s}".format(station.name,station.filename))
-        # read station file
-        dailytmp[s,begin_idx[s]:end_idx[s]] = station.parseRecord()  
-        s += 1 # next station
-      assert s == varobj.shape[0]
+      stationlist = [self.stationlists[var][s] for s in sidx] # only stations that need to be processed
+      shape = (len(sidx),varobj.shape[1]) # monthly data for these stations
+      if NP > 1:
+        # parse station files in parallel and fill shared array
+        for station in stationlist: print("   {:<15s} {:s}".format(station.name,station.filename))
+        s = len(stationlist) # number of stations
+        dailytmp = shared_fill_rows(parseStationRecord, [(station,) for station in stationlist], 
+                                    zip(begin_idx,end_idx), shape+(31,), varobj.dtype, fillValue=np.NaN, 
+                                    NP=NP, kwargs=dict(lvectorize=lvectorize, cache_folder=cache_folder))
+      else:
+        # allocate array
+        dailytmp = np.empty((shape[0],shape[1]*31), dtype=varobj.dtype); dailytmp.fill(np.NaN) # initialize all with NaN
+        # loop over stations
+        s = 0 # station counter
+        for station in stationlist:
+          print("   {:<15s} {:s}".format(station.name,station.filename))
+          # read station file
+          dailytmp[s,begin_idx[s]:end_idx[s]] = parseStationRecord(station, cache_folder=cache_folder, lvectorize=lvectorize)  
+          s += 1 # next station
+      assert s == shape[0]
       dailytmp = vardef.convert(dailytmp) # apply conversion function
       # compute monthly average
-      dailytmp = dailytmp.reshape(varobj.shape+(31,))
+      dailytmp = dailytmp.reshape(shape+(31,))
       monlytmp = np.nanmean(dailytmp,axis=-1) # squeezes automatically
       # store daily and monthly data for computation of derived variables
       dailydata[wrfvar] = dailytmp
       monlydata[wrfvar] = monlytmp
-      # load data
-      varobj.load(monlytmp) # varobj.sync()
       del dailytmp, monlytmp
     # loop over derived nonlinear variables/extremes
     if any(not var.linear for var in self.extremes): print('\n computing (nonlinear) daily variables:')
@@ -598,39 +714,43 @@ class StationRecords(object):
         if var.name not in ravmap: ravmap[var.name] = var.name # naming convention for tmp storage 
         wrfvar = ravmap[var.name] 
         # allocate memory for monthly values
-        tmp = np.ma.empty(varobj.shape, dtype=varobj.dtype); tmp.fill(np.NaN) 
+        tmp = np.ma.empty(shape, dtype=varobj.dtype); tmp.fill(np.NaN) 
         # N.B.: some derived variable types may return masked arrays
         monlydata[wrfvar] = tmp
-    # loop over time steps      
+    # compute extremes with batched kernels for all months at once
+    lengths = monthLengths(self.dataset.time.coord, year0=1980) # correct month lengths, including leap years
+    monthly = [] # variables that are computed in the monthly loop
+    for var in self.extremes:      
+      if not var.linear:
+        if lbatch and getattr(var,'kernel',None) is not None:
+          if s > 0: monlydata[ravmap[var.name]][:] = monthlyExtremes(dailydata[var.prerequisites[0]], lengths, **var.kernel)
+        else: monthly.append(var)
+    # loop over time steps to compute nonlinear variables from daily values    
     tmpvars = dict()
-    for m,mon in enumerate(varobj.axes[1].coord):
-      # figure out length of month
-      if mon%12 == 1: # February
-        if calendar.isleap(1980 + mon/12): lmon = 29
-        else: lmon = 28
-      else: lmon = days_per_month[mon%12]
+    for m,lmon in enumerate(lengths if s > 0 and monthly else []): # skip, if there is nothing to do
       # construct arrays for this month
       tmpdata = {varname:data[:,m,0:lmon] for varname,data in dailydata.iteritems()}      
-      for var in self.extremes:      
-        if not var.linear:
-          varobj = self.dataset[var.name] # get variable object
-          wrfvar = ravmap[var.name]
-          dailytmp = var.computeValues(tmpdata, aggax=1, delta=86400., tmp=tmpvars)        
-          tmpdata[wrfvar] = dailytmp
-          monlytmp = var.aggregateValues(dailytmp, aggdata=None, aggax=1) # last axis
-          assert monlytmp.shape == (s,)
-          monlydata[wrfvar][:,m] = monlytmp
+      for var in monthly:      
+        varobj = self.dataset[var.name] # get variable object
+        wrfvar = ravmap[var.name]
+        dailytmp = var.computeValues(tmpdata, aggax=1, delta=86400., tmp=tmpvars)        
+        tmpdata[wrfvar] = dailytmp
+        monlytmp = var.aggregateValues(dailytmp, aggdata=None, aggax=1) # last axis
+        assert monlytmp.shape == (s,)
+        monlydata[wrfvar][:,m] = monlytmp
     # loop over linear derived variables/extremes
     if any(var.linear for var in self.extremes): print('\n computing (linear) monthly variables:')
     for var in self.extremes:      
-      varobj = self.dataset[var.name] # get variable object
       wrfvar = ravmap[var.name]
       if var.linear:
         # compute from available monthly data
         print("   {:<15s} {:s}".format(var.name,str(tuple(self.varmap.get(varname,varname) for varname in var.prerequisites))))
         monlytmp = var.computeValues(monlydata, aggax=1, delta=86400.)
         monlydata[wrfvar] = monlytmp
-      tmpload = monlydata[wrfvar]
+    # load data (merged with unchanged records in incremental mode)
+    for varname in self.variables.keys()+[var.name for var in self.extremes]:
+      varobj = self.dataset[varname] # get variable object
+      tmpload = mergeStationRecords(self.previous, varname, monlydata[ravmap.get(varname,varname)], sidx, varobj.shape)
       assert varobj.shape == tmpload.shape
       varobj.load(tmpload)
     # determine actual length of records (valid data points)
@@ -650,8 +770,9 @@ class StationRecords(object):
     self.dataset['stn_rec_len'].load(minlen)
     # synchronize data, i.e. write to disk
     self.dataset.sync()
+    self.previous = None # release memory
     
-    
+
 ## load pre-processed GHCN station time-series
 def loadGHCN_TS(name=None, filetype='all', varlist=None, varatts=None, 
               filelist=None, folder=None, **kwargs): 
@@ -854,6 +975,9 @@ if __name__ == '__main__':
 #   mode = 'test_station_reader'
 #   mode = 'test_conversion'
   mode = 'convert_all_stations'
+  # number of processes used to parse station files (default: serial)
+  if os.environ.has_key('PYAVG_THREADS'): NP = int(os.environ['PYAVG_THREADS'])
+  else: NP = 1
   
   if mode == 'test_selection':
     
@@ -994,4 +1118,4 @@ if __name__ == '__main__':
       # create netcdf file
       stations.prepareDataset(filename=None, folder=None) # default settings
       # read actual station data
-      stations.readStationData()
+      stations.readStationData(NP=NP)
@@ -13,8 +13,9 @@ import inspect
 import numpy as np
 import os
 import functools
+import hashlib
 # internal imports
-from utils.misc import expandArgumentList
+from utils.misc import expandArgumentList, atomicSave, saveNPZ, loadNPZ
 from geodata.misc import AxisError, DatasetError, DateError, ArgumentError, EmptyDatasetError, DataError, VariableError
 from geodata.base import Dataset, Variable, Axis, Ensemble
 from geodata.netcdf import DatasetNetCDF
@@ -258,6 +259,176 @@ def transformDays(data=None, var=None, slc=None, l365=False, lvar=None, linplace
     return data      
       
       
+## helper functions for station records
+
+# compute checksum of a (source) file
+def fileChecksum(filename, blocksize=2**20):
+  ''' compute the MD5 checksum of a file (read in blocks) '''
+  md5 = hashlib.md5()
+  with open(filename, 'rb') as f:
+    for block in iter(lambda: f.read(blocksize), b''): md5.update(block)
+  return md5.hexdigest()
+
+# name of binary cache file for a parsed station record
+def getRecordCacheFile(filename, variable, cache_folder):
+  ''' return the name of the binary cache file of a station record (without extension) '''
+  filename = os.path.splitext(os.path.basename(filename))[0]
+  return '{:s}/{:s}_{:s}'.format(cache_folder, filename, variable.replace(' ','_'))
+
+# load the meta data of a binary cache file and check if the cache is still valid
+def _loadRecordMeta(filename, cachefile):
+  ''' return the meta data of the binary cache of a station record, if it is valid, otherwise None '''
+  if not os.path.exists(cachefile+'.npy'): return None
+  meta = loadNPZ(cachefile+'_meta.npz') # None, if missing or unreadable
+  if meta is None or not all(key in meta for key in ('size','mtime','checksum')): return None
+  stat = os.stat(filename)
+  if meta['size'] != stat.st_size: return None
+  if meta['mtime'] != stat.st_mtime and meta['checksum'] != fileChecksum(filename): return None
+  return meta
+
+# check if a binary cache file is still valid
+def checkRecordCache(filename, cachefile):
+  ''' check if the binary cache of a station record is valid, based on file size, modification time and checksum 
+      of the source file; the checksum is only computed, if the source file was touched, but has the same size 
+      (use refreshRecordCache to store the new modification time); no files are written '''
+  return _loadRecordMeta(filename, cachefile) is not None
+
+# update the modification time of a valid binary cache file
+def refreshRecordCache(filename, cachefile):
+  ''' store the current modification time of the source file with a valid binary cache, so that the checksum 
+      does not have to be computed again; returns False, if the cache is not valid '''
+  meta = _loadRecordMeta(filename, cachefile)
+  if meta is None: return False
+  mtime = os.stat(filename).st_mtime
+  if meta['mtime'] != mtime: 
+    meta['mtime'] = mtime; saveNPZ(cachefile+'_meta.npz', lcompress=False, **meta)
+  return True
+
+# load a parsed station record from a binary cache file
+def loadRecordCache(filename, cachefile, lmmap=True):
+  ''' load a parsed station record from a binary cache file (memory-mapped, if lmmap=True), as well as additional 
+      attributes that were stored with it; returns None, None, if the cache is missing or not valid anymore '''
+  meta = _loadRecordMeta(filename, cachefile)
+  if meta is None: return None, None
+  try: data = np.load(cachefile+'.npy', mmap_mode='r' if lmmap else None)
+  except (IOError, ValueError): return None, None # unreadable file is a cache miss
+  atts = {key:value[()] for key,value in meta.iteritems() if key not in ('size','mtime','checksum')}
+  return data, atts
+
+# save a parsed station record to a binary cache file
+def saveRecordCache(filename, cachefile, data, **atts):
+  ''' save a parsed station record to a binary cache file, along with size, modification time and checksum of 
+      the source file (and additional attributes); files are written atomically (the meta data last), so that 
+      concurrent readers (and memory-maps) never see a partially written file '''
+  stat = os.stat(filename)
+  atomicSave(cachefile+'.npy', np.save, data)
+  saveNPZ(cachefile+'_meta.npz', lcompress=False, size=stat.st_size, mtime=stat.st_mtime, 
+          checksum=fileChecksum(filename), **atts)
+
+# load existing station records for incremental updates
+def matchStationRecords(ncfile, dataset, keys=('station_name','stn_lat','stn_lon','stn_begin_date','stn_end_date')):
+  ''' load station records from an existing NetCDF file and match them to the stations in a new dataset, based on 
+      station meta data (keys); returns a dictionary with the index of the matching station (-1 for new stations), 
+      the time offset and the data of all (station, time) variables, or None, if the file can not be used '''
+  previous = DatasetNetCDF(filelist=[ncfile], mode='r', load=True)
+  if not all(key in previous for key in keys) or 'time' not in previous.axes: 
+    previous.close(); return None
+  # match stations based on meta data
+  def stationKeys(ds): # normalize strings (padding)
+    return zip(*[[value.strip() if isinstance(value,basestring) else value for value in ds[key].getArray().tolist()] for key in keys])
+  oldkeys = {key:i for i,key in enumerate(stationKeys(previous))}
+  index = np.array([oldkeys.get(key,-1) for key in stationKeys(dataset)], dtype=np.int)
+  # time offset of previous records and data
+  offset = int(previous.time.coord[0] - dataset.time.coord[0])
+  data = {var.name:var.getArray() for var in previous.variables.itervalues() 
+          if tuple(ax.name for ax in var.axes) == ('station','time')}
+  previous.close()
+  return dict(index=index, offset=offset, data=data)
+
+# merge new and existing station records for incremental updates
+def mergeStationRecords(previous, varname, data, sidx, shape):
+  ''' merge new records (for stations sidx) with matching records from a previous dataset (see matchStationRecords);
+      if previous is None, data is returned unchanged '''
+  if previous is None: return data
+  merged = np.ma.masked_all(shape, dtype=data.dtype)
+  if varname in previous['data']:
+    olddata = previous['data'][varname]; index = previous['index']; offset = previous['offset']
+    t0 = max(0,offset); t1 = min(shape[1],offset+olddata.shape[1])
+    lold = index >= 0 # stations with existing records
+    if t0 < t1: merged[lold,t0:t1] = olddata[index[lold],t0-offset:t1-offset]
+  merged[sidx] = data # new or changed records
+  return merged
+
+
+# month lengths for daily station records
+def monthLengths(coord, year0):
+  ''' number of days in each month of a monthly time axis (months since January of year0), including leap years '''
+  coord = np.asarray(coord, dtype=np.int)
+  lengths = days_per_month_365[coord%12].astype(np.int)
+  year = year0 + coord//12
+  lleap = np.logical_and(year%4 == 0, np.logical_or(year%100 != 0, year%400 == 0))
+  lengths[np.logical_and(coord%12 == 1, lleap)] = 29 # February in leap years
+  return lengths
+
+# parameters for batched computation of extremes, based on derived variable classes
+def extremesKernel(Klass, kernel, mode, **kwargs):
+  ''' return the arguments for monthlyExtremes for a derived variable class and its keyword arguments; the 
+      'interval' and 'threshold' parameters are taken from kwargs or the defaults of the class constructor, 
+      so that both computations are consistent; returns None, if a parameter can not be determined '''
+  try: argspec = inspect.getargspec(Klass.__init__)
+  except TypeError: return None # not a Python function
+  defaults = dict(zip(argspec.args[-len(argspec.defaults):], argspec.defaults)) if argspec.defaults else dict()
+  params = dict(kernel=kernel, mode=mode)
+  for key in dict(runmean=('interval',), consecutive=('threshold',)).get(kernel,()):
+    if key in kwargs: params[key] = kwargs[key]
+    elif key in defaults: params[key] = defaults[key]
+    else: return None # fall back to monthly computation
+  return params
+
+# compute monthly extremes from daily values
+def monthlyExtremes(data, lengths, kernel='extrema', mode='max', interval=None, threshold=None):
+  ''' compute monthly extremes from a (station, month, 31) array of daily values (padded with NaN) for all months 
+      at once; kernels are 'extrema' (min/max of daily values), 'runmean' (min/max of running means over 
+      interval days) and 'consecutive' (longest run of days above/below a threshold); running means and runs
+      continue across month boundaries and are attributed to the month of their last day; NaN is ignored in 
+      extrema, invalidates running means and interrupts runs; months without valid values are NaN; the
+      parameters interval and threshold are required for 'runmean' and 'consecutive' (see extremesKernel) '''
+  ns,nm,nd = data.shape
+  if len(lengths) != nm or nd != 31: raise AxisError, "Daily data has to have shape (station, month, 31)."
+  # concatenate days without padding into a continuous daily series
+  lvalid = ( np.arange(nd).reshape((1,nd)) < lengths.reshape((nm,1)) ).ravel()
+  series = data.reshape((ns,nm*nd))[:,lvalid] 
+  offsets = np.concatenate(([0],np.cumsum(lengths)[:-1])) # first day of each month
+  if kernel == 'extrema': 
+    if mode == 'max': return np.fmax.reduceat(series, offsets, axis=1) # fmax ignores NaN
+    elif mode == 'min': return np.fmin.reduceat(series, offsets, axis=1)
+    else: raise ArgumentError, mode
+  elif kernel == 'runmean':
+    if interval is None: raise ArgumentError, "The 'runmean' kernel requires an interval."
+    lnan = np.isnan(series)
+    csum = np.zeros((ns,series.shape[1]+1)); csum[:,1:] = np.cumsum(np.where(lnan, 0, series), axis=1)
+    cnan = np.zeros((ns,series.shape[1]+1), dtype=np.int); cnan[:,1:] = np.cumsum(lnan, axis=1)
+    runmean = np.empty(series.shape); runmean.fill(np.NaN) # incomplete intervals at the beginning
+    runmean[:,interval-1:] = ( csum[:,interval:] - csum[:,:-interval] ) / interval
+    runmean[:,interval-1:][( cnan[:,interval:] - cnan[:,:-interval] ) > 0] = np.NaN # missing values in interval
+    if mode == 'max': return np.fmax.reduceat(runmean, offsets, axis=1)
+    elif mode == 'min': return np.fmin.reduceat(runmean, offsets, axis=1)
+    else: raise ArgumentError, mode
+  elif kernel == 'consecutive':
+    if threshold is None: raise ArgumentError, "The 'consecutive' kernel requires a threshold."
+    with np.errstate(invalid='ignore'): # NaN comparisons
+      if mode == 'above': levent = series > threshold
+      elif mode == 'below': levent = series < threshold
+      else: raise ArgumentError, mode
+    # length of run at each day: distance to the last day without an event
+    days = np.arange(series.shape[1])
+    counter = days - np.maximum.accumulate(np.where(levent, -1, days), axis=1)
+    runs = np.maximum.reduceat(counter, offsets, axis=1).astype(np.float64)
+    runs[np.logical_and.reduceat(np.isnan(series), offsets, axis=1)] = np.NaN # no valid values in month
+    return runs
+  else: raise ArgumentError, kernel
+
+
 ## functions to load a dataset
 
 # convenience function to invert variable name mappings
@@ -626,7 +797,8 @@ def loadEnsemble(names=None, name=None, title=None, varlist=None, aggregation=No
                  lensembleAxis=False, WRF_exps=None, CESM_exps=None, WRF_ens=None, CESM_ens=None, 
                  bias_correction=None, obs_list=observational_datasets, basin_list=None, aggargs=None, **kwargs):
   ''' a convenience function to load an ensemble of time-series, based on certain criteria; works 
-      with either stations or regions; seasonal/climatological aggregation is also supported '''
+      with either stations or regions; seasonal/climatological aggregation is also supported 
+      (a list of aggregations returns a dictionary of Ensembles/Datasets, computed in one pass) '''
   # prepare ensemble
   if varlist is not None:
     varlist = list(varlist)[:] # copy list
@@ -700,7 +872,13 @@ def loadEnsemble(names=None, name=None, title=None, varlist=None, aggregation=No
   if not ldataset and any([len(ds)==0 for ds in ensemble]): raise EmptyDatasetError(ensemble)
   # N.B.: the operations below should work with Ensembles as well as Datasets
   if aggargs is None: aggargs = dict()
-  if aggregation:
+  if isinstance(aggregation,(list,tuple)): 
+    # several statistics, computed in one pass: return a dictionary of Ensembles/Datasets 
+    if season is None:
+      ensemble = ensemble.climStats(stats=aggregation, taxis='time', **aggargs)
+    else:
+      ensemble = ensemble.seasonalStats(season=season, stats=aggregation, taxis='time', **aggargs)
+  elif aggregation:
     method = aggregation if aggregation.isupper() else aggregation.title() 
     if season is None:
       ensemble = getattr(ensemble,'clim'+method)(taxis='time', **aggargs)
@@ -30,6 +30,25 @@ from utils.misc import histogram, binedges, detrend, percentile, tabulate
 monthlyUnitsList = ('month','months','month of the year')
 # global casting rule (for operations between arrays of different type)
 casting_rule = 'same_kind' # default since NumPy 1.7
+# reduction operations for aggregation methods/statistics (seasonal*/clim* methods)
+aggregation_ops = dict(mean=nf.nanmean, sum=nf.nansum, std=nf.nanstd, sem=nf.nansem, var=nf.nanvar, 
+                       max=nf.nanmax, min=nf.nanmin)
+
+def reduceMultiple(operations, data, axis=-1, **kwargs):
+  ''' Apply several reduction operations to the same data array and return a list of results; 
+      nan-functions that can be computed from moments are evaluated together in a single pass 
+      over the data (see nf.nanstats), all other operations are applied individually. '''
+  stats = [nf.nanstats_functions.get(op,None) for op in operations]
+  if any(key != 'ddof' for key in kwargs): stats = [None]*len(operations) # other options are not supported
+  mstats = [stat for stat in stats if stat is not None]
+  if len(mstats) > 1: results = nf.nanstats(data, axis=axis, stats=mstats, ddof=kwargs.get('ddof',0))
+  else: results = dict()
+  rlist = []
+  for op,stat in zip(operations,stats):
+    if stat in results: # same dtype as operation
+      rlist.append(results[stat].astype(op(np.ones((2,1), dtype=data.dtype), axis=0).dtype))
+    else: rlist.append(op(data, axis=axis, **kwargs))
+  return rlist
 
 class UnaryCheckAndCreateVar(object):
   ''' Decorator class for unary arithmetic operations that implements some sanity checks and 
@@ -1307,6 +1326,8 @@ class Variable(object):
           'periodic'  reduce to one values representing each element of a block,
                       e.g. a monthly seasonal cycle from monthly data ;
                       specify a subset of block with blkidx, but use all elements in each block
+        If operation is a list of operations, all of them are applied to the same (reshaped) data 
+        and a list of results is returned. 
                       '''
     ## check input
     lblk = False; lperi = False; lall = False
@@ -1340,37 +1361,9 @@ class Variable(object):
     # more checks
     if ( lblk or lperi ) and axlen%blklen != 0: 
       raise NotImplementedError, 'Currently seasonal means only work for full years.'
-    if not self.data: self.load()
-    ## massage data
-    # get actual data and reshape
-    if data_view is None: odata = self.getArray()
-    else: odata = data_view
-    # move reduction axis to the end, so that it is fastes varying
-    if iax < self.ndim-1: odata = np.rollaxis(odata, axis=iax, start=self.ndim)
-    # reshape
-    oshape = odata.shape
-    # make length of blocks the last axis, the number of blocks second to last
-    if lblk or lperi: 
-      odata = odata.reshape(oshape[:-1]+(nblks,blklen,))
-      if lperi: odata = np.swapaxes(odata, -1, -2) # swap last and second to last
-    # predict resultign shape
-    if lblk: # use as is 
-      rshape = oshape[:-1] + (nblks,) # shape of results array
-    elif lperi or lall: 
-      rshape = oshape[:-1] + (blklen,) if blklen > 0 else oshape[:-1] # shape of results array
-    # extract block slice
-    if blkidx is not None: tdata = odata.take(blkidx, axis=-1)
-    else: tdata = odata
-    # N.B.: this does different things depending on the mode:
-    #       block: use a subset of elements from each block, but use all blocks
-    #       periodic: use a subset of blocks, but all elements in each block 
     ## apply operation
-    if fillValue is not None and self.masked: tdata = tdata.filled(fillValue)
-    rdata = operation(tdata, axis=-1, **kwargs)
-    assert rdata.shape == rshape
-    # return new variable
-    if iax < self.ndim-1 and blklen > 0: 
-      rdata = np.rollaxis(rdata, axis=self.ndim-1, start=iax) # move reduction axis back
+    rdata = self._reduceArray(operation, iax=iax, blklen=blklen, blkidx=blkidx, mode=mode, 
+                              fillValue=fillValue, data_view=data_view, **kwargs)
     # cast as variable
     if asVar:      
       # create new time axis (yearly)
@@ -1394,12 +1387,57 @@ class Variable(object):
       # create new variable
       vatts = self.atts.copy()
       if varatts is not None: vatts.update(varatts)
-      rvar = self.copy(data=rdata, axes=axes, atts=vatts)      
+      if isinstance(rdata,list): # one variable for each operation (with shared axes)
+        rvar = [self.copy(data=rdat, axes=axes, atts=vatts.copy()) for rdat in rdata]
+      else: rvar = self.copy(data=rdata, axes=axes, atts=vatts)      
     else: # just return data array 
       rvar = rdata
     # return results
     return rvar
   
+  def _reduceArray(self, operation, iax=None, blklen=None, blkidx=None, mode=None, fillValue=None, 
+                   data_view=None, **kwargs):
+    ''' Helper method for reduce that applies the operation to the data array (or data_view) and 
+        returns the reduced array; the reduction axis retains its position. '''
+    lblk = mode == 'block'; lperi = mode == 'periodic'; lall = mode == 'all'
+    ## massage data
+    # get actual data and reshape
+    if data_view is None: 
+      if not self.data: self.load()
+      odata = self.getArray()
+    else: odata = data_view
+    if lblk or lperi: nblks = odata.shape[iax]/blklen # number of blocks
+    # move reduction axis to the end, so that it is fastes varying
+    if iax < self.ndim-1: odata = np.rollaxis(odata, axis=iax, start=self.ndim)
+    # reshape
+    oshape = odata.shape
+    # make length of blocks the last axis, the number of blocks second to last
+    if lblk or lperi: 
+      odata = odata.reshape(oshape[:-1]+(nblks,blklen,))
+      if lperi: odata = np.swapaxes(odata, -1, -2) # swap last and second to last
+    # predict resultign shape
+    if lblk: # use as is 
+      rshape = oshape[:-1] + (nblks,) # shape of results array
+    elif lperi or lall: 
+      rshape = oshape[:-1] + (blklen,) if blklen > 0 else oshape[:-1] # shape of results array
+    # extract block slice
+    if blkidx is not None: tdata = odata.take(blkidx, axis=-1)
+    else: tdata = odata
+    # N.B.: this does different things depending on the mode:
+    #       block: use a subset of elements from each block, but use all blocks
+    #       periodic: use a subset of blocks, but all elements in each block 
+    ## apply operation
+    if fillValue is not None and self.masked: tdata = tdata.filled(fillValue)
+    lmulti = isinstance(operation,(list,tuple)) # several operations on the same data
+    if lmulti: rlist = reduceMultiple(operation, tdata, axis=-1, **kwargs)
+    else: rlist = [operation(tdata, axis=-1, **kwargs)]
+    for i,rdata in enumerate(rlist):
+      assert rdata.shape == rshape
+      if iax < self.ndim-1 and blklen > 0: 
+        rlist[i] = np.rollaxis(rdata, axis=self.ndim-1, start=iax) # move reduction axis back
+    # return reduced array
+    return rlist if lmulti else rlist[0]
+  
   def histogram(self, bins=None, binedgs=None, ldensity=True, asVar=True, name=None, axis=None, axis_idx=None, 
                 lflatten=False, lcheckVar=True, lcheckAxis=True, haxatts=None, hvaratts=None, fillValue=None, **kwargs):
     ''' Generate a histogram of along a given axis and preserve the other axes. '''
@@ -1867,10 +1905,13 @@ class Variable(object):
       if lcheckVar: raise VariableError, "Seasonal reduction does not work with string Variables!"
       else: return None
     data_view = self._getCompleteYears(taxis=taxis, ltrim=ltrim, asVar=False, lcheck=lstrict, lclim=lclim)
-    taxis = self.getAxis(taxis); tax = self.axisIndex(taxis.name); te = data_view.shape[tax]
+    # N.B.: data_view can be None, if the data are not loaded and can be read directly from file
+    taxis = self.getAxis(taxis); tax = self.axisIndex(taxis.name)
+    te = self.shape[tax] if data_view is None else data_view.shape[tax]
     assert te%12 == 0, data_view.shape # should be divisible by 12 now          
     # hadling of exceptions: some variables in Datasets should only be averaged
-    if mean_list is not None and self.name in mean_list: operation = np.nanmean    
+    if mean_list is not None and self.name in mean_list: 
+      operation = [np.nanmean]*len(operation) if isinstance(operation,(list,tuple)) else np.nanmean
     # modify variable
     if asVar:      
       # create new time axis (yearly)
@@ -1893,11 +1934,12 @@ class Variable(object):
                         asVar=asVar, axatts=tatts, varatts=varatts, data_view=data_view, 
                         lcheckVar=lcheckVar, lcheckAxis=lcheckAxis, **kwargs)
     # check shape of annual variable
-    assert avar.shape == self.shape[:tax]+(te/12,)+self.shape[tax+1:]
+    avars = avar if isinstance(avar,list) else [avar]
+    for av in avars: assert av.shape == self.shape[:tax]+(te/12,)+self.shape[tax+1:]
     # convert time coordinate to years (from month)
     if asVar:
       if tatts['units'].lower() == 'year' and taxis.units.lower() in monthlyUnitsList:
-        raxis = avar.getAxis(tatts['name'])
+        raxis = avars[0].getAxis(tatts['name']) # shared by all variables
         if taxis.coord[0]%12 == 1: # special treatment, if we start counting at 1(instead of 0)
           raxis.coord -= 1; raxis.coord /= 12; raxis.coord += 1  
         else: raxis.coord /= 12 # just divide by 12, assuming we count from 0
@@ -1932,6 +1974,11 @@ class Variable(object):
     ''' Return a time-series of annual averages of the specified season. '''    
     return self.reduceToAnnual(season=season, operation=nf.nanmin, **kwargs)
   
+  def seasonalStats(self, season='annual', stats=('mean','std'), **kwargs):
+    ''' Return a Dataset with time-series of several annual statistics of the specified season, 
+        computed in one pass over the data; Variables are named '<name>_<stat>'. '''    
+    return self._reduceStats(self.reduceToAnnual, stats, season=season, **kwargs)
+  
   def reduceToClimatology(self, operation, yridx=None, asVar=True, name=None, taxis='time', 
                           lcheckVar=True, lcheckAxis=True, checkUnits=True, taxatts=None, varatts=None, 
                           mean_list=None, ltrim=False, lstrict=True, **kwargs):
@@ -1945,9 +1992,11 @@ class Variable(object):
       else: return None
     data_view = self._getCompleteYears(taxis=taxis, ltrim=ltrim, asVar=False, lcheck=lstrict)
     taxis = self.getAxis(taxis); tax = self.axisIndex(taxis.name)
-    assert data_view.shape[self.axisIndex(taxis)]%12 == 0, data_view.shape # should be divisible by 12 now          
+    te = self.shape[tax] if data_view is None else data_view.shape[tax]
+    assert te%12 == 0, te # should be divisible by 12 now          
     # hadling of exceptions: some variables in Datasets should only be averaged
-    if mean_list is not None and self.name in mean_list: operation = np.nanmean    
+    if mean_list is not None and self.name in mean_list: 
+      operation = [np.nanmean]*len(operation) if isinstance(operation,(list,tuple)) else np.nanmean
     # modify variable
     if asVar:      
       # create new time axis (still monthly)
@@ -1965,11 +2014,12 @@ class Variable(object):
                         asVar=asVar, axatts=tatts, varatts=varatts, data_view=data_view, 
                         lcheckVar=lcheckVar, lcheckAxis=lcheckAxis, **kwargs)
     # check shape of annual variable
-    assert avar.shape == self.shape[:tax]+(12,)+self.shape[tax+1:]
+    avars = avar if isinstance(avar,list) else [avar]
+    for av in avars: assert av.shape == self.shape[:tax]+(12,)+self.shape[tax+1:]
     # construct time coordinate
     if asVar:
       if tatts['units'].lower() in monthlyUnitsList:
-        raxis = avar.getAxis(tatts['name'])
+        raxis = avars[0].getAxis(tatts['name']) # shared by all variables
         if raxis.coord[0] == 0: raxis.coord += 1 # customarily, month are counted, starting at 1, not 0 
     # return data
     return avar
@@ -2002,6 +2052,22 @@ class Variable(object):
     ''' Return a climatology of minima of monthly data. '''    
     return self.reduceToClimatology(yridx=yridx, operation=nf.nanmin, **kwargs)
   
+  def climStats(self, yridx=None, stats=('mean','std'), **kwargs):
+    ''' Return a Dataset with climatologies of several statistics of monthly data, computed in 
+        one pass over the data; Variables are named '<name>_<stat>'. '''    
+    return self._reduceStats(self.reduceToClimatology, stats, yridx=yridx, **kwargs)
+  
+  def _reduceStats(self, reduction, stats, asVar=True, **kwargs):
+    ''' Helper method that applies a reduction with a list of aggregation operations and returns a 
+        Dataset of Variables (or a dictionary of arrays, if asVar is False). '''
+    operations = [aggregation_ops[stat.lower()] for stat in stats]
+    rlist = reduction(operation=operations, asVar=asVar, **kwargs)
+    if rlist is None: return None # no time axis etc.
+    if asVar:
+      for rvar,stat in zip(rlist,stats): rvar.name = '{:s}_{:s}'.format(rvar.name,stat.lower())
+      return Dataset(name=self.dataset_name or self.name, varlist=rlist)
+    else: return {stat:rdata for stat,rdata in zip(stats,rlist)}
+  
   def reorderAxes(self, axes=None, asVar=True, linplace=False, lcheckAxis=False):
     ''' reorder the axes of a Variable and replace the data array with an array view with 
         appropriately reordered dimensions '''
@@ -2672,6 +2738,40 @@ class Axis(Variable):
     if not self.ascending: idx = self.len - idx -1 # flip again
     return idx 
 
+  def getIndexArray(self, values, mode='closest', outOfBounds=None):
+    ''' Vectorized version of getIndex: return an array of coordinate indices for an array of values; 
+        values that are out of bounds are indicated by -1 (instead of None). '''
+    if not self.data: raise DataError
+    if outOfBounds is None: outOfBounds = mode.lower() != 'closest'
+    values = np.asarray(values)
+    # check coordinate order
+    coord = self.coord
+    with np.errstate(invalid='ignore'): # NaN's are not out of bounds (consistent with getIndex)
+      if self.ascending: oob = np.logical_or(values < coord[0], values > coord[-1])
+      else: oob = np.logical_or(values > coord[0], values < coord[-1])
+    if not self.ascending: 
+      coord = coord[::-1] # reverse order
+      # also swap left and right
+      if mode.lower() == 'left': mode = 'right'
+      elif mode.lower() == 'right': mode = 'left'    
+    # behavior depends on mode (same as getIndex)
+    idx = coord.searchsorted(values, side='right')
+    if mode.lower() == 'left':
+      idx = np.maximum(idx-1, 0)
+    elif mode.lower() == 'right':    
+      idx = np.where(np.logical_and(idx > 0, coord[np.maximum(idx-1,0)] == values), idx-1, idx) # special case...
+    elif mode.lower() == 'closest':      
+      ic = np.clip(idx, 1, self.len-1) # only valid for interior points
+      dl = values - coord[ic-1]; dr = coord[ic] - values
+      with np.errstate(invalid='ignore'):
+        idx = np.where(idx <= 0, 0, np.where(idx >= self.len, self.len-1, np.where(dr < dl, ic, ic-1)))
+    else: 
+      raise ValueError, "Mode '{:s}' unknown.".format(mode)      
+    # return
+    if not self.ascending: idx = self.len - idx -1 # flip again
+    if outOfBounds: idx = np.where(oob, -1, idx)
+    return idx 
+
   def getIndices(self, coords):
     ''' Method to find occurences of coords and return their index values. '''
     if not self.data: self.load()
@@ -3318,6 +3418,42 @@ class Dataset(object):
     # create new dataset with regridded and old variables
     return self.copy(variables=newvars, atts=dsatts)
               
+  def seasonalStats(self, season='annual', stats=('mean','std'), **kwargs):
+    ''' Return a dictionary of Datasets with annual time-series of several statistics of the 
+        specified season (one per statistic); each Variable is only read/reduced once. '''
+    return self._reduceStats('reduceToAnnual', stats, season=season, **kwargs)
+  
+  def climStats(self, yridx=None, stats=('mean','std'), **kwargs):
+    ''' Return a dictionary of Datasets with climatologies of several statistics (one per 
+        statistic); each Variable is only read/reduced once. '''
+    return self._reduceStats('reduceToClimatology', stats, yridx=yridx, **kwargs)
+  
+  def _reduceStats(self, method, stats, asVar=True, dsatts=None, copyother=True, deepcopy=False, 
+                   lcheckVar=False, lcheckAxis=False, **kwargs):
+    ''' Helper method that applies a Variable reduction method with a list of aggregation operations
+        to all Variables and sorts the results into one Dataset for each statistic; Variable names 
+        are the same as in the original Dataset (as with the corresponding single-statistic methods). '''
+    operations = [aggregation_ops[stat.lower()] for stat in stats]
+    # separate axes from kwargs
+    axes = {axname:ax for axname,ax in kwargs.iteritems() if self.hasAxis(axname)}
+    for axname in axes.iterkeys(): del kwargs[axname] 
+    # loop over variables
+    newvars = {stat:dict() for stat in stats}
+    for varname,var in self.variables.iteritems():
+      tmpargs = kwargs.copy()
+      if axes: tmpargs.update({key:value for key,value in axes.iteritems() if var.hasAxis(key)})
+      rlist = getattr(var,method)(operation=operations, asVar=asVar, lcheckVar=lcheckVar, 
+                                  lcheckAxis=lcheckAxis, **tmpargs)
+      if rlist is not None:
+        for stat,rvar in zip(stats,rlist):
+          if asVar: rvar.name = varname # don't change names, since we are creating a new dataset
+          newvars[stat][varname] = rvar
+      elif copyother and asVar: # variables without time axis etc. are the same in all datasets 
+        for stat in stats: newvars[stat][varname] = var.copy(deepcopy=deepcopy)
+    # assemble new datasets
+    if asVar: return {stat:self.copy(variables=newvars[stat], atts=dsatts) for stat in stats}
+    else: return newvars # just return resulting dictionaries
+  
   def _apply_to_all(self, fctsdict, asVar=True, dsatts=None, copyother=True, deepcopy=False, 
                     lcheckVar=False, lcheckAxis=False, lkeepName=True, **kwargs):
     ''' Apply functions from fctsdict to variables in dataset and return a new dataset. '''
@@ -3636,6 +3772,10 @@ class Ensemble(object):
   def _recastList(self, fs):
     ''' internal helper method to decide if a list or Ensemble should be returned '''
     if all(f is None for f in fs): return None # suppress list of None's
+    elif all([isinstance(f, dict) and set(f.keys()) == set(fs[0].keys()) for f in fs]) and \
+         all([isinstance(v, (Variable,Dataset)) for f in fs for v in f.itervalues()]):
+      # dictionaries of Variables/Datasets (e.g. from seasonalStats) become dictionaries of Ensembles
+      return {key:self._recastList([f[key] for f in fs]) for key in fs[0].iterkeys()}
     elif all([not callable(f) and not isinstance(f, (Variable,Dataset)) for f in fs]): return fs  
     elif all([isinstance(f, (Variable,Dataset)) for f in fs]):
       # N.B.: technically, Variable instances are callable, but that's not what we want here...
@@ -15,13 +15,15 @@ import numpy.ma as ma
 from collections import OrderedDict
 import types  # needed to bind functions to objects
 import os, gzip # griddef pickles compress well
+import hashlib # for mask cache keys
+import scipy.sparse as sparse # for regridding weights
 try: import cPickle as pickle
 except: import pickle
 
 
 # gdal imports
 from osgeo import gdal, osr, ogr
-from utils.misc import flip
+from utils.misc import flip, saveNPZ, loadNPZ
 # register RAM driver
 ramdrv = gdal.GetDriverByName('MEM')
 # use exceptions (off by default)
@@ -46,6 +48,7 @@ if not os.path.exists(data_root):
 # standard folder for grids and shapefiles (imported by datasets.common)
 grid_folder = data_root + '/grids/' # folder for pickled grids
 shape_folder = data_root + '/shapes/' # folder for pickled grids
+mask_folder = data_root + '/masks/' # folder for cached rasterized shape masks
 
 # Earth's radius
 R = 6371000 # in meters, from Wikipedia
@@ -362,8 +365,127 @@ def gdalInterp(interpolation):
   elif interpolation == 'lanczos': gdal_interp = gdal.GRA_Lanczos
   elif interpolation == 'convolution': gdal_interp = gdal.GRA_Cubic # cubic convolution
   elif interpolation == 'cubicspline': gdal_interp = gdal.GRA_CubicSpline # cubic spline
+  elif interpolation == 'average': gdal_interp = gdal.GRA_Average # average of contributing cells
   else: raise GDALError, 'Unknown interpolation method: %s'%interpolation
   return gdal_interp
+
+
+## regridding plans: sparse weight matrices that map source grid points onto target grid points
+regrid_methods = ('nearest', 'bilinear', 'average') # interpolation methods supported by regridding plans
+regrid_cache = dict() # in-memory cache of regridding weights, keyed by regrid key
+regrid_pattern = '{0:s}_{1:s}_{2:s}_{3:s}_regrid.npz' # source grid, target grid, interpolation, key hash
+
+def clearRegridCache():
+  ''' clear the in-memory cache of regridding weights (does not affect cached files) '''
+  regrid_cache.clear()
+
+def regridSupersampling(srcgrd, tgtgrd, interpolation='average', supersample=None):
+  ''' determine the number of sampling points per target cell (in each direction); only 'average' 
+      uses more than one point: by default twice the ratio of target and source resolution '''
+  if interpolation != 'average': return 1
+  if supersample is None: 
+    supersample = int(min(max(np.ceil(2.*abs(tgtgrd.scale/srcgrd.scale)),1),16))
+  elif not isinstance(supersample,(int,np.integer)): raise TypeError(supersample)
+  return supersample
+
+def getRegridKey(srcgrd, tgtgrd, interpolation='bilinear', supersample=1):
+  ''' construct a key that uniquely identifies a regridding plan (source and target grid, 
+      interpolation method and supersampling factor) '''
+  key = ''
+  for grd in (srcgrd,tgtgrd):
+    key += '{0:s}|{1:s}|{2:s}|'.format(grd.name, printList(grd.geotransform), printList(grd.size))
+    key += '{0:s}|'.format(grd.projection.ExportToWkt())
+  key += '{0:s}|{1:d}'.format(interpolation, supersample)
+  return key
+
+def computeRegridWeights(srcgrd, tgtgrd, interpolation='bilinear', supersample=None):
+  ''' compute a sparse (CSR) weight matrix of shape (n_target, n_source) that maps the flattened 
+      (y,x) source grid onto the flattened target grid; weights are not normalized, so that missing 
+      values can be handled when the weights are applied (cf. processing.process.sparseShapeAverage) '''
+  if interpolation not in regrid_methods: 
+    raise GDALError, "Interpolation method '{:s}' is not supported by regridding plans.".format(interpolation)
+  sx0, sdx, s, sy0, t, sdy = srcgrd.geotransform
+  if s != 0 or t != 0 or tgtgrd.geotransform[2] != 0 or tgtgrd.geotransform[4] != 0: 
+    raise NotImplementedError, "Rotated grids are not supported by regridding plans."
+  snx, sny = srcgrd.size; tnx, tny = tgtgrd.size
+  tx0, tdx, s, ty0, t, tdy = tgtgrd.geotransform; del s,t
+  # sampling points within target cells (multiple points per cell for averaging)
+  k = regridSupersampling(srcgrd, tgtgrd, interpolation=interpolation, supersample=supersample)
+  offsets = ( np.arange(k) + 0.5 ) / k # relative to the cell corner
+  xs = tx0 + ( np.arange(tnx).reshape((tnx,1)) + offsets ).ravel()*tdx
+  ys = ty0 + ( np.arange(tny).reshape((tny,1)) + offsets ).ravel()*tdy
+  x2D, y2D = np.meshgrid(xs, ys) # (tny*k, tnx*k)
+  rows = ( (np.arange(tny*k)//k).reshape((tny*k,1))*tnx + np.arange(tnx*k)//k ).ravel()
+  xx = x2D.ravel().astype(np.float64); yy = y2D.ravel().astype(np.float64); del x2D, y2D
+  # transform sampling points to source coordinates (all at once)
+  if not srcgrd.projection.IsSame(tgtgrd.projection):
+    tx = osr.CoordinateTransformation(tgtgrd.projection, srcgrd.projection)
+    point_array = np.asarray(tx.TransformPoints(np.column_stack((xx,yy))), dtype=np.float64)
+    xx = point_array[:,0]; yy = point_array[:,1]; del point_array
+  # fractional source indices (relative to the lower left corner of the grid)
+  lperiodic = False
+  if not srcgrd.isProjected:
+    xx = sx0 + np.mod(xx - sx0, 360.) # longitudes relative to source origin
+    lperiodic = np.round(abs(sdx)*snx, decimals=2) == 360 # global grid
+  fi = ( xx - sx0 ) / sdx; fj = ( yy - sy0 ) / sdy; del xx, yy
+  finite = np.logical_and(np.isfinite(fi), np.isfinite(fj))
+  fi[~finite] = -1; fj[~finite] = -1 # will be removed
+  inside = np.logical_and(finite, np.logical_and(fj >= 0, fj < sny))
+  if not lperiodic: inside = np.logical_and(inside, np.logical_and(fi >= 0, fi < snx))
+  # assemble weights and indices of contributing source points
+  if interpolation == 'bilinear':
+    fi -= 0.5; fj -= 0.5 # relative to cell centers
+    i0 = np.floor(fi); j0 = np.floor(fj); wi = fi - i0; wj = fj - j0 
+    i0 = i0.astype(np.int64); j0 = j0.astype(np.int64)
+    corners = ((0,0,(1-wi)*(1-wj)), (1,0,wi*(1-wj)), (0,1,(1-wi)*wj), (1,1,wi*wj))
+  else:
+    i0 = np.floor(fi).astype(np.int64); j0 = np.floor(fj).astype(np.int64)
+    corners = ((0,0,np.ones_like(fi)/k**2),) # nearest neighbor or fraction of the cell
+  del fi, fj
+  ilist = []; jlist = []; wlist = []
+  for di,dj,w in corners:
+    ii = i0 + di; jj = j0 + dj
+    if lperiodic: ii = np.mod(ii, snx)
+    # N.B.: corners that fall outside the grid are dropped; the weights are renormalized later
+    valid = np.logical_and(inside, w > 0)
+    valid = np.logical_and(valid, np.logical_and(np.logical_and(ii >= 0, ii < snx), np.logical_and(jj >= 0, jj < sny)))
+    ilist.append(rows[valid]); jlist.append(jj[valid]*snx + ii[valid]); wlist.append(w[valid])
+  # N.B.: duplicate entries (e.g. several sampling points in the same cell) are summed up
+  weights = sparse.coo_matrix((np.concatenate(wlist),(np.concatenate(ilist),np.concatenate(jlist))), 
+                              shape=(tnx*tny,snx*sny))
+  return weights.tocsr()
+
+def getRegridWeights(srcgrd, tgtgrd, interpolation='bilinear', supersample=None, lcache=True, 
+                     cache_folder=None, ldebug=False):
+  ''' return the regridding weights for a pair of GridDefinitions, using the in-memory and on-disk 
+      cache, if possible; weights are only computed once and saved next to the pickled grids '''
+  supersample = regridSupersampling(srcgrd, tgtgrd, interpolation=interpolation, supersample=supersample)
+  if lcache:
+    key = getRegridKey(srcgrd, tgtgrd, interpolation=interpolation, supersample=supersample)
+    if key in regrid_cache: return regrid_cache[key]
+    # look for cached file
+    folder = grid_folder if cache_folder is None else cache_folder
+    filename = regrid_pattern.format(srcgrd.name or 'grid', tgtgrd.name or 'grid', interpolation, 
+                                     hashlib.md5(key).hexdigest()[:12])
+    filepath = os.path.join(folder, filename)
+    npz = loadNPZ(filepath) # None, if missing or unreadable
+    if npz is not None and str(npz.get('key')) == key: # check for hash collision or stale file
+      if ldebug: print(" - loaded regridding weights from '{:s}'".format(filepath))
+      weights = sparse.csr_matrix((npz['data'],npz['indices'],npz['indptr']), shape=tuple(npz['shape']))
+      regrid_cache[key] = weights
+      return weights
+  # compute weights
+  weights = computeRegridWeights(srcgrd, tgtgrd, interpolation=interpolation, supersample=supersample)
+  # save in cache
+  if lcache:
+    regrid_cache[key] = weights
+    if not os.path.exists(folder): 
+      try: os.makedirs(folder)
+      except OSError: pass # may have been created by another worker
+    saveNPZ(filepath, data=weights.data, indices=weights.indices, indptr=weights.indptr, # atomic (parallel workers)
+            shape=np.asarray(weights.shape), key=key)
+    if ldebug: print(" - saved regridding weights to '{:s}'".format(filepath))
+  return weights
          
 
 def getProjFromDict(projdict, name='', GeoCS='WGS84', convention='Proj4'):
@@ -1266,6 +1388,14 @@ def addGDALtoDataset(dataset, griddef=None, projection=None, geotransform=None,
   return dataset
   
 
+## cache for rasterized shapes (coverage counts are stored as uint8 in compressed .npz files)
+mask_cache = dict() # in-memory cache of coverage counts, keyed by mask cache key
+mask_pattern = '{0:s}_{1:s}_{2:s}.npz' # shape name, grid name, key hash
+
+def clearMaskCache():
+  ''' clear the in-memory mask cache (does not affect cached files) '''
+  mask_cache.clear()
+
 ## shapefile contianer class
 class Shape(object):
   ''' A wrapper class for shapefiles, with some added functionality and raster interface '''
@@ -1312,39 +1442,102 @@ class Shape(object):
     ''' return a layer from the shapefile '''
     return self.OGR.GetLayer(layer) # get shape layer
     
-  # rasterize shapefiles
-  def rasterize(self, griddef=None, layer=0, invert=False, asVar=False, ldebug=False):
-    ''' "burn" shapefile on a 2D raster; returns a 2D boolean array '''
-    if griddef.__class__.__name__ != GridDefinition.__name__: raise TypeError 
-    #if not isinstance(griddef,GridDefinition): raise TypeError # this is always False. probably due to pickling
-    if not isinstance(invert,(bool,np.bool)): raise TypeError
-    # fill values
-    if invert: inside, outside = 0,1
-    else: inside, outside = 1,0
+  def getMaskKey(self, griddef=None, layer=0, supersample=1):
+    ''' construct a key that uniquely identifies a rasterized mask (shapefile and modification time, 
+        layer, grid and supersampling factor) '''
+    key = '{0:s}|{1:.6f}|{2:d}|'.format(os.path.abspath(self.shapefile), os.path.getmtime(self.shapefile), layer)
+    key += '{0:s}|{1:s}|{2:s}|'.format(griddef.name, printList(griddef.geotransform), printList(griddef.size))
+    key += '{0:s}|{1:d}'.format(griddef.projection.ExportToWkt(), supersample)
+    return key
+  
+  def burnCoverage(self, griddef=None, layer=0, supersample=1, ldebug=False):
+    ''' "burn" shapefile on a (supersampled) 2D raster and count the number of sub-cells that 
+        are inside the shape; returns a 2D uint8 array in (y,x) order (values: 0 - supersample**2) '''
     shp_lyr = self.getLayer(layer) # get shape layer
     # create raster to burn shape onto
     if ldebug: print(' - creating raster')
-    msk_ds = ramdrv.Create(self.name, griddef.size[0], griddef.size[1], 1, gdal.GDT_Byte)
+    xe = griddef.size[0]*supersample; ye = griddef.size[1]*supersample
+    msk_ds = ramdrv.Create(self.name, xe, ye, 1, gdal.GDT_Byte)
     # N.B.: this is a special case: only one band (1) and always boolean (gdal.GDT_Byte)
-    # set projection parameters
-    msk_ds.SetGeoTransform(griddef.geotransform)  # does the order matter?
+    # set projection parameters (the supersampled grid has the same origin, but finer resolution)
+    geotransform = list(griddef.geotransform)
+    geotransform[1] /= float(supersample); geotransform[5] /= float(supersample)
+    msk_ds.SetGeoTransform(geotransform)  # does the order matter?
     msk_ds.SetProjection(griddef.projection.ExportToWkt())  # is .ExportToWkt() necessary?
     # initialize raster band        
     msk_rst = msk_ds.GetRasterBand(1) # only one anyway...
-    msk_rst.Fill(outside); msk_rst.SetNoDataValue(outside) # fill with zeros
+    msk_rst.Fill(0); msk_rst.SetNoDataValue(0) # fill with zeros
     # burn shape layer onto raster band
     if ldebug: print(' - burning layer to raster')
-    err = gdal.RasterizeLayer(msk_ds, [1], shp_lyr, burn_values = [inside]) # None, None, [1] # burn_value = 1
+    err = gdal.RasterizeLayer(msk_ds, [1], shp_lyr, burn_values = [1]) # None, None, [1] # burn_value = 1
     # use argument ['ALL_TOUCHED=TRUE'] like so: None, None, [1], ['ALL_TOUCHED=TRUE']
     if err != 0: raise GDALError, 'ERROR CODE %i'%err
     #msk_ds.FlushCash()  
     # retrieve mask array from raster band
     if ldebug: print(' - retrieving mask')
-    mask = msk_ds.GetRasterBand(1).ReadAsArray()
+    counts = msk_ds.GetRasterBand(1).ReadAsArray()
+    # sum up sub-cells in each grid cell
+    if supersample > 1:
+      counts = counts.reshape((griddef.size[1],supersample,griddef.size[0],supersample)).sum(axis=3).sum(axis=1)
+    return counts.astype(np.uint8)
+  
+  def getCoverage(self, griddef=None, layer=0, supersample=1, lcache=True, cache_folder=None, ldebug=False):
+    ''' return the number of covered sub-cells for each grid cell, using the in-memory and on-disk 
+        cache, if possible; OGR is only used, if the mask is not cached; the returned array is a copy, 
+        so that callers can not modify cached masks '''
+    if lcache:
+      key = self.getMaskKey(griddef=griddef, layer=layer, supersample=supersample)
+      if key in mask_cache: return mask_cache[key].copy()
+      # look for cached file
+      folder = mask_folder if cache_folder is None else cache_folder
+      filename = mask_pattern.format(self.name, griddef.name or 'grid', hashlib.md5(key).hexdigest()[:12])
+      filepath = os.path.join(folder, filename)
+      npz = loadNPZ(filepath) # None, if missing or unreadable
+      if npz is not None and str(npz.get('key')) == key: # check for hash collision or stale file
+        if ldebug: print(" - loaded cached mask from '{:s}'".format(filepath))
+        mask_cache[key] = npz['counts']
+        return mask_cache[key].copy()
+    # rasterize shape using OGR
+    counts = self.burnCoverage(griddef=griddef, layer=layer, supersample=supersample, ldebug=ldebug)
+    # save in cache
+    if lcache:
+      mask_cache[key] = counts.copy()
+      if not os.path.exists(folder): 
+        try: os.makedirs(folder)
+        except OSError: pass # may have been created by another worker
+      saveNPZ(filepath, counts=counts, key=key, supersample=supersample) # atomic (parallel workers)
+      if ldebug: print(" - saved mask to cache '{:s}'".format(filepath))
+    return counts
+  
+  # rasterize shapefiles
+  def rasterize(self, griddef=None, layer=0, invert=False, asVar=False, supersample=None, lcache=True, 
+                cache_folder=None, ldebug=False):
+    ''' "burn" shapefile on a 2D raster; returns a 2D boolean array; if a supersampling factor is 
+        given, the fractional coverage of each grid cell is returned instead (as float32); 
+        rasterized masks are cached on disk and in memory (keyed by shapefile and grid) '''
+    if griddef.__class__.__name__ != GridDefinition.__name__: raise TypeError 
+    #if not isinstance(griddef,GridDefinition): raise TypeError # this is always False. probably due to pickling
+    if not isinstance(invert,(bool,np.bool)): raise TypeError
+    if supersample is None: supersample = 1
+    elif not isinstance(supersample,(int,np.integer)): raise TypeError(supersample)
+    elif not 0 < supersample < 16: raise ValueError(supersample) # counts are stored as uint8
+    # get sub-cell counts (cached or rasterized)
+    counts = self.getCoverage(griddef=griddef, layer=layer, supersample=supersample, lcache=lcache, 
+                              cache_folder=cache_folder, ldebug=ldebug)
+    # fill values
+    if supersample == 1:
+      if invert: mask = 1 - counts; outside = 1 # new array 
+      else: mask = counts; outside = 0 # already a copy
+      dtype = np.bool; units = 'mask'
+    else:
+      mask = counts.astype(np.float32) / supersample**2 # fractional coverage
+      if invert: mask = 1. - mask
+      outside = 1. if invert else 0.
+      dtype = np.float32; units = 'fraction'
     # convert to Variable object, is desired
     if asVar: 
-      mask = Variable(name=self.name, units='mask', axes=(griddef.ylat,griddef.xlon), data=mask, 
-                      dtype=np.bool, mask=None, fillValue=outside, atts=None, plot=None)
+      mask = Variable(name=self.name, units=units, axes=(griddef.ylat,griddef.xlon), data=mask, 
+                      dtype=dtype, mask=None, fillValue=outside, atts=None, plot=None)
       mask = addGDALtoVar(mask, griddef=griddef,) # add GDAL to mask       
     # return mask array
     return mask  
@@ -8,9 +8,10 @@ A module that provides access to NetCDF datasets for GeoData datasets and variab
 
 # external imports
 import numpy as np
+import numpy.ma as ma
 import collections as col
 import netCDF4 as nc # netcdf python module
-import os, functools
+import os, functools, itertools
 
 # import all base functionality from PyGeoDat
 # from nctools import * # my own netcdf toolkit
@@ -18,6 +19,222 @@ from geodata.base import Variable, Axis, Dataset, ApplyTestOverList
 from geodata.misc import checkIndex, isEqual, joinDicts
 from geodata.misc import DatasetError, DataError, AxisError, NetCDFError, PermissionError, FileError, VariableError, ArgumentError 
 from utils.nctools import coerceAtts, writeNetCDF, add_var, add_coord, checkFillValue
+import utils.nanfunctions as nf
+
+# streaming reductions
+stream_memory = 1024 # memory budget (in MB) above which reductions of VarNC are streamed from file
+# nan-aware operations that can be accumulated block-by-block, and the statistic they compute
+stream_ops = nf.nanstats_functions
+
+
+## read-through block cache for VarNC
+
+class BlockCache(object):
+  ''' 
+    A least-recently-used cache for blocks (chunks) of NetCDF variables, keyed by (file, variable, 
+    chunk index); the memory budget (in MB) is shared by all VarNC instances (in read-only mode) and 
+    hit/miss statistics are recorded. A budget of zero disables the cache. Blocks of a file are 
+    discarded, when its modification time, size or inode change (i.e. the file has been rewritten).
+  '''
+  block_size = 1 # target size of blocks (in MB) for contiguous (unchunked) variables
+  
+  def __init__(self, memory=0):
+    ''' initialize empty cache with memory budget (in MB) '''
+    self.memory = memory
+    self._blocks = col.OrderedDict() # LRU order: oldest first
+    self._stamps = dict() # file identity (modification time, size, inode) when blocks were cached
+    self.nbytes = 0
+    self.resetStats()
+    
+  @property
+  def enabled(self): return self.memory > 0
+    
+  def resetStats(self):
+    ''' reset hit/miss statistics '''
+    self.hits = 0; self.misses = 0; self.evictions = 0; self.bypassed = 0
+    
+  def stats(self):
+    ''' return a dictionary with cache statistics '''
+    nreq = self.hits + self.misses
+    return dict(hits=self.hits, misses=self.misses, hit_rate=float(self.hits)/nreq if nreq else np.NaN,
+                evictions=self.evictions, bypassed=self.bypassed, blocks=len(self._blocks), 
+                nbytes=self.nbytes, memory=self.memory)
+    
+  def get(self, key):
+    ''' return a block and mark it as recently used (or None, if not present) '''
+    block = self._blocks.pop(key, None)
+    if block is None: self.misses += 1
+    else:
+      self.hits += 1
+      self._blocks[key] = block # re-insert as most recent
+    return block
+  
+  def put(self, key, block):
+    ''' add a block and evict least recently used blocks to stay within the memory budget '''
+    budget = self.memory*1024.**2
+    if block.nbytes > budget: return # can not be cached
+    if key in self._blocks: self.nbytes -= self._blocks.pop(key).nbytes
+    while self._blocks and self.nbytes + block.nbytes > budget:
+      self.nbytes -= self._blocks.popitem(last=False)[1].nbytes
+      self.evictions += 1
+    self._blocks[key] = block; self.nbytes += block.nbytes
+    
+  def clear(self, filepath=None, varname=None):
+    ''' remove all blocks, or only the blocks of a given file and/or variable '''
+    for key in self._blocks.keys():
+      if ( filepath is None or key[0] == filepath ) and ( varname is None or key[1] == varname ):
+        self.nbytes -= self._blocks.pop(key).nbytes
+    if varname is None:
+      if filepath is None: self._stamps.clear()
+      else: self._stamps.pop(filepath, None)
+    
+  def checkFile(self, filepath):
+    ''' discard the blocks of a file, if it has changed since they were cached '''
+    try: 
+      stat = os.stat(filepath); stamp = (stat.st_mtime, stat.st_size, stat.st_ino)
+    except (OSError,TypeError): return # not a local file
+    if self._stamps.get(filepath,stamp) != stamp: self.clear(filepath=filepath)
+    self._stamps[filepath] = stamp
+    
+  def resize(self, memory):
+    ''' change memory budget (in MB) and evict blocks, if necessary '''
+    self.memory = memory; budget = memory*1024.**2
+    while self._blocks and self.nbytes > budget:
+      self.nbytes -= self._blocks.popitem(last=False)[1].nbytes
+      self.evictions += 1
+    
+  def chunkShape(self, ncvar):
+    ''' chunk shape of a NetCDF variable; for contiguous variables, blocks of records are used '''
+    chunks = ncvar.chunking() 
+    if isinstance(chunks,(list,tuple)): return tuple(chunks)
+    recsize = np.prod(ncvar.shape[1:])*ncvar.dtype.itemsize
+    return (max(int(self.block_size*1024.**2/recsize),1),) + ncvar.shape[1:]
+    
+  def read(self, ncvar, slcs, filepath=None):
+    ''' read an array from a NetCDF variable through the cache; slcs has to be a list of slices with 
+        positive step and integers (one for each dimension); returns None if the request can not be 
+        served from the cache (e.g. if it is too large), so that it has to be read directly '''
+    shape = ncvar.shape; ndim = len(shape)
+    if ndim == 0 or len(slcs) != ndim or not isinstance(ncvar.dtype,np.dtype): return None
+    cshape = self.chunkShape(ncvar)
+    # determine covered range of chunks and the index within this region
+    crng = []; idx = []
+    for slc,n,cs in zip(slcs,shape,cshape):
+      if isinstance(slc,slice):
+        start, stop, step = slc.indices(n)
+        if step < 1 or stop <= start: return None
+        last = start + step*((stop-start-1)//step)
+      elif isinstance(slc,(int,np.integer)):
+        start = slc+n if slc < 0 else slc; last = start; step = None
+        if not 0 <= start < n: return None
+      else: return None # not supported
+      c0 = start//cs; c1 = last//cs; r0 = c0*cs
+      crng.append(xrange(c0,c1+1))
+      idx.append(start-r0 if step is None else slice(start-r0,last-r0+1,step))
+    # check size of request (large requests are not cached)
+    rshape = tuple(min(rng[-1]*cs+cs,n)-rng[0]*cs for rng,n,cs in zip(crng,shape,cshape))
+    if np.prod(rshape)*ncvar.dtype.itemsize > self.memory*1024.**2/2.: 
+      self.bypassed += 1; return None
+    # assemble region from chunks
+    self.checkFile(filepath)
+    region = None; mask = None
+    for cidx in itertools.product(*crng):
+      key = (filepath, ncvar._name, cidx)
+      block = self.get(key)
+      if block is None:
+        block = ncvar[tuple(slice(c*cs,min(c*cs+cs,n)) for c,cs,n in zip(cidx,cshape,shape))]
+        self.put(key, block)
+      if region is None: region = np.empty(rshape, dtype=block.dtype)
+      rslc = tuple(slice((c-rng[0])*cs,(c-rng[0])*cs+l) for c,rng,cs,l in zip(cidx,crng,cshape,block.shape))
+      region[rslc] = block
+      if isinstance(block,ma.MaskedArray):
+        if mask is None: mask = np.zeros(rshape, dtype=np.bool)
+        mask[rslc] = ma.getmaskarray(block); fillValue = block.fill_value
+    # extract requested elements
+    data = region[tuple(idx)] 
+    if mask is not None: data = ma.masked_array(data, mask=mask[tuple(idx)], fill_value=fillValue)
+    return data.copy() if data.base is not None else data # don't return views of the region
+
+# the cache instance that is shared by all VarNC instances (disabled by default)
+block_cache = BlockCache(memory=0)
+
+def setBlockCache(memory=None, lreset=False):
+  ''' set the memory budget (in MB) of the block cache for VarNC (zero disables the cache) and/or 
+      reset statistics; returns the cache statistics '''
+  if memory is not None: block_cache.resize(memory)
+  if memory == 0: block_cache.clear()
+  if lreset: block_cache.resetStats()
+  return block_cache.stats()
+
+
+## slice composition and coalesced reads
+
+def isFullSlice(slc):
+  ''' check if an index selection selects everything (None or an empty slice) '''
+  return slc is None or ( isinstance(slc,slice) and slc == slice(None) )
+
+def selectionLength(slc, n):
+  ''' length of an index selection along a dimension of length n (None for scalar indices) '''
+  if isinstance(slc,(int,np.integer)): return None
+  elif isFullSlice(slc): return n
+  elif isinstance(slc,slice): return len(xrange(*slc.indices(n)))
+  else: return len(np.arange(n)[np.asarray(slc)])
+
+def composeSlices(outer, inner, n):
+  ''' compose two index selections along a dimension of length n, where 'inner' selects from the result 
+      of 'outer'; two slices are merged into a new slice, otherwise the result is an integer or an index 
+      array (relative to the original dimension) '''
+  if isFullSlice(inner): return slice(None) if outer is None else outer
+  elif isFullSlice(outer): return inner
+  elif isinstance(outer,(int,np.integer)): 
+    raise AxisError("Can not apply index selection to a scalar index ({}).".format(outer))
+  if isinstance(outer,slice) and isinstance(inner,slice):
+    # merge slices arithmetically
+    start, stop, step = outer.indices(n)
+    istart, istop, istep = inner.indices(len(xrange(start,stop,step)))
+    m = len(xrange(istart,istop,istep)); start += istart*step; step *= istep
+    if m == 0: return slice(0,0) # empty selection
+    stop = start + (m-1)*step + (1 if step > 0 else -1)
+    return slice(start, None if stop < 0 else stop, step)
+  else: 
+    # resolve index lists
+    if isinstance(inner,(list,tuple)): inner = np.asarray(inner)
+    idx = np.arange(n)[outer if isinstance(outer,slice) else np.asarray(outer)][inner]
+    return int(idx) if np.ndim(idx) == 0 else idx
+
+def indexRuns(idx):
+  ''' split a sorted array of unique indices into slices of consecutive indices '''
+  breaks = np.flatnonzero(np.diff(idx) != 1) + 1
+  return [slice(int(run[0]),int(run[-1])+1) for run in np.split(idx, breaks)]
+
+def readNetCDF(ncvar, slcs, lcache=True):
+  ''' read from a NetCDF variable; index lists/arrays are coalesced into runs of consecutive indices, 
+      which are read as hyperslabs (instead of reading individual indices), and the block cache is 
+      used, if enabled and possible '''
+  if isinstance(slcs,list):
+    for i,slc in enumerate(slcs):
+      if isinstance(slc,(list,tuple,np.ndarray)):
+        idx = np.asarray(slc)
+        if idx.dtype == np.bool_: idx = np.flatnonzero(idx)
+        if idx.ndim != 1 or idx.size == 0: break # leave it to the NetCDF module
+        idx = np.where(idx < 0, idx+ncvar.shape[i], idx)
+        uidx, inverse = np.unique(idx, return_inverse=True)
+        # read runs recursively (to handle several index lists) and concatenate
+        parts = [readNetCDF(ncvar, slcs[:i]+[run]+slcs[i+1:], lcache=lcache) for run in indexRuns(uidx)]
+        iax = i - len([slc for slc in slcs[:i] if isinstance(slc,(int,np.integer))]) # scalars are squeezed
+        if any(isinstance(part,ma.MaskedArray) for part in parts): data = ma.concatenate(parts, axis=iax)
+        else: data = np.concatenate(parts, axis=iax)
+        # restore original order (and duplicates)
+        if len(uidx) != len(idx) or np.any(np.diff(inverse) != 1): data = data.take(inverse, axis=iax)
+        return data
+  if lcache and block_cache.enabled and isinstance(slcs,list):
+    try: filepath = ncvar.group().filepath()
+    except (ValueError,AttributeError): filepath = None # e.g. MFDataset
+    if filepath is not None:
+      slcs = slcs + [slice(None)]*(ncvar.ndim-len(slcs)) # pad slices 
+      data = block_cache.read(ncvar, slcs, filepath=filepath)
+      if data is not None: return data
+  return ncvar.__getitem__(slcs) # regular read
 
 
 def asVarNC(var=None, ncvar=None, mode='rw', axes=None, deepcopy=False, **kwargs):
@@ -226,7 +443,12 @@ class VarNC(Variable):
       data = super(VarNC,self).__getitem__(slcs) # load actual data using parent method      
     else:
       # provide direct access to netcdf data on file
-      if isinstance(slcs,(list,tuple)):
+      if self.slices:
+        # compose with existing slicing directive (slcs refer to the axes of this variable)
+        if not isinstance(slcs,(list,tuple)): slcs = [slcs,]*self.ndim
+        elif len(slcs) != self.ndim: raise AxisError(slcs)
+        slcs = self._mergeSlices(slcs)
+      elif isinstance(slcs,(list,tuple)):
         if (not self.ncstrvar and len(slcs) != self.ncvar.ndim) or (self.ncstrvar and len(slcs)+1 != self.ncvar.ndim): 
           raise AxisError(slcs)
         slcs = list(slcs) # need to insert items
@@ -247,15 +469,8 @@ class VarNC(Variable):
         else:
             for i in xrange(self.ncvar.ndim):
               if self.ncvar.shape[i] == 1: slcs.insert(i, 0) # '0' automatically squeezes out this dimension upon retrieval
-      # check for existing slicing directive
-      if self.slices:
-        assert isinstance(self.slices,(list,tuple)) and isinstance(slcs,list)
-        # substitute None-slices with the preset slicing directive
-        slcs = [sslc if oslc == slice(None) else oslc for oslc,sslc in zip(slcs,self.slices)]
-        # set slices to None, since they unneccessary now, and cause problems when slicing
-        self.slices = None
-      # finally, get data!
-      data = self.ncvar.__getitem__(slcs) # exceptions handled by netcdf module
+      # finally, get data! (through the block cache, if enabled and not in write mode)
+      data = readNetCDF(self.ncvar, slcs, lcache='w' not in self.mode) # exceptions handled by netcdf module
       if self.dtype is not None and not np.issubdtype(data.dtype,self.dtype):
         if 'scale_factor' in self.ncvar.ncattrs():
             self.dtype = data.dtype # data was scaled automatically in NetCDF module
@@ -289,6 +504,26 @@ class VarNC(Variable):
     # return data
     return data
   
+  def _mergeSlices(self, slcs, ndim=None):
+    ''' Compose index selections relative to the axes of this variable with the existing slicing 
+        directive, so that the result refers to the NetCDF variable (without singleton dimensions, if 
+        squeezed); ndim is the number of axes the selections refer to (default: current axes). '''
+    if not self.slices: return list(slcs)
+    if ndim is None: ndim = self.ndim
+    shape = self.ncvar.shape[:-1] if self.ncstrvar else self.ncvar.shape
+    if self.squeezed: shape = tuple(n for n in shape if n > 1)
+    if len(shape) != len(self.slices): raise AxisError(self.slices)
+    # figure out which dimensions were removed by scalar indices or by squeezing
+    lens = [selectionLength(sslc, n) for sslc,n in zip(self.slices,shape)]
+    dims = [i for i,l in enumerate(lens) if l is not None]
+    if len(dims) > ndim: dims = [i for i in dims if lens[i] > 1] # squeezed
+    if len(dims) != ndim or len(slcs) != ndim: raise AxisError(slcs)
+    newslcs = list(self.slices)
+    for i,n in enumerate(shape):
+      if lens[i] == 1 and i not in dims: newslcs[i] = composeSlices(self.slices[i], 0, n) # squeezed
+    for i,slc in zip(dims,slcs): newslcs[i] = composeSlices(self.slices[i], slc, shape[i])
+    return newslcs
+  
   def slicing(self, lidx=None, lrng=None, years=None, listAxis=None, asVar=None, lsqueeze=True, 
               lcheck=False, lcopy=False, lslices=False, linplace=False, asNC=None, **axes):
     ''' This method implements access to slices via coordinate values and returns Variable objects. 
@@ -307,30 +542,20 @@ class VarNC(Variable):
     asNC = ( isinstance(newvar,Variable) and not linplace and not self.data ) if asNC is None else asNC
     if asNC:
       #for ax in newvar.axes: ax.unload() # will retain its slice, just for test
-      axes = []
-      for newax,slc in zip(newvar.axes,slcs):
+      axes = []; axslcs = {ax.name:slc for ax,slc in zip(self.axes,slcs)}
+      for newax in newvar.axes:
         if self.hasAxis(newax.name):
           ncax = self.getAxis(newax.name) # transform to sliced NetCDF
           if isinstance(ncax,AxisNC):
-            axes.append(asAxisNC(newax, ncvar=ncax.ncvar, mode=ncax.mode, slices=(slc,)))
+            axslc = ncax._mergeSlices((axslcs[newax.name],)) if ncax.slices else (axslcs[newax.name],)
+            axes.append(asAxisNC(newax, ncvar=ncax.ncvar, mode=ncax.mode, slices=axslc))
           else: axes.append(newax) # keep as is
         else: axes.append(newax) # this can be a coordinate list axis
       # figure out slices
       if self.data: 
           slcs = None # slices cause problems when data is already loaded
       elif self.slices and slcs:
-          assert len(self.slices) == len(slcs)
-          newslcs = []
-          for sslc,slc in zip(self.slices,slcs):
-              lsslc = sslc not in (None,slice(None))
-              lslc = slc not in (None,slice(None))
-              if lsslc and lslc: 
-                  # if both slices are non-empty, merging is not trivial... 
-                  raise NotImplementedError("Resolving two actual slices for the same dimension is not implemented at the moment.")
-              elif lsslc: newslcs.append(sslc) # use old slice
-              elif lslc: newslcs.append(slc) # use new slice
-              else: newslcs.append(slice(None)) # empty slice
-          slcs = newslcs
+          slcs = self._mergeSlices(slcs) # compose slices of slices
       # create new VarNC instance with different slices
       newvar = asVarNC(newvar, self.ncvar, mode=self.mode, axes=axes, slices=slcs, squeeze=lsqueeze,
                        scalefactor=self.scalefactor, offset=self.offset, transform=self.transform)
@@ -345,6 +570,111 @@ class VarNC(Variable):
     if not self.data: self.load()       
     return super(VarNC,self).getArray(axes=axes, broadcast=broadcast, unmask=unmask, dtype=dtype, 
                                       fillValue=fillValue, copy=copy) # just call superior
+  
+  def checkStream(self, memory=None):
+    ''' Check if data should be streamed from file, i.e. the data is not loaded, exceeds the memory 
+        budget (in MB; default: stream_memory), and can be read in blocks. '''
+    if self.data or self.ncstrvar: return False
+    if self.squeezed and self.ncvar.ndim != self.ndim: return False # can't read blocks 
+    if memory is None: memory = stream_memory
+    return np.prod(self.shape)*self.dtype.itemsize > memory*1024.**2
+    
+  def iterBlocks(self, axis=None, blksize=None, blkmul=1, start=None, stop=None, memory=None):
+    ''' Generator that reads data in blocks along an axis and yields the index of the first record 
+        and the data block; the block size is chosen to fit into the memory budget (in MB; default:
+        stream_memory) and is a multiple of 'blkmul'. '''
+    iax = self.axisIndex(axis)
+    start = 0 if start is None else start
+    stop = self.shape[iax] if stop is None else stop 
+    if blksize is None:
+      if memory is None: memory = stream_memory
+      recsize = np.prod(self.shape[:iax]+self.shape[iax+1:])*self.dtype.itemsize # size of one record
+      blksize = max(int(memory*1024.**2/recsize)//blkmul,1)*blkmul 
+    elif blksize%blkmul != 0: raise ArgumentError(blksize)
+    slcs = [slice(None)]*self.ndim
+    for i0 in xrange(start,stop,blksize):
+      slcs[iax] = slice(i0,min(i0+blksize,stop))
+      yield i0, self.__getitem__(tuple(slcs)) # read from file, if not loaded
+  
+  def _getCompleteYears(self, taxis='time', ltrim=False, lfront=True, lback=True, asVar=False, 
+                        lcheck=True, lclim=False):
+    ''' VarNC version: if data is not loaded and no trimming or padding is necessary, return None, 
+        so that reductions can read data directly from file. '''
+    if not self.data and not asVar and self.hasAxis(taxis):
+      tcoord = self.getAxis(taxis).coord
+      if lclim: offset = (tcoord[0]-1)%12; over = tcoord[-1]%12
+      else: offset = tcoord[0]%12; over = (tcoord[-1]+1)%12
+      if offset == 0 and over == 0:
+        if lcheck: self._checkMonthlyAxis(taxis=taxis, lbegin=not lfront, lclim=lclim)
+        return None # use all data
+    return super(VarNC,self)._getCompleteYears(taxis=taxis, ltrim=ltrim, lfront=lfront, lback=lback, 
+                                               asVar=asVar, lcheck=lcheck, lclim=lclim)
+  
+  def _reduceArray(self, operation, iax=None, blklen=None, blkidx=None, mode=None, fillValue=None, 
+                   data_view=None, lstream=None, memory=None, **kwargs):
+    ''' VarNC version: if the data is not loaded and exceeds the memory budget (in MB), it is streamed 
+        from file in blocks; statistics from stream_ops are accumulated block-by-block along the 
+        reduction axis, other operations are applied to blocks along an outer axis; with a list of 
+        operations, the data are also only read once. '''
+    if lstream is None: lstream = data_view is None and self.checkStream(memory=memory)
+    elif lstream and ( self.data or data_view is not None ): 
+      raise ArgumentError("Streaming requires that data is not loaded and no data_view is passed.")
+    if not lstream or self.ndim == 1: # can't split 1D arrays along an outer axis
+      return super(VarNC,self)._reduceArray(operation, iax=iax, blklen=blklen, blkidx=blkidx, mode=mode, 
+                                            fillValue=fillValue, data_view=data_view, **kwargs)
+    # apply reduction to data blocks
+    lmulti = isinstance(operation,(list,tuple)) # several operations from the same blocks
+    operations = operation if lmulti else [operation]
+    reduce = functools.partial(super(VarNC,self)._reduceArray, operation, blklen=blklen, blkidx=blkidx, 
+                               mode=mode, fillValue=fillValue, **kwargs)
+    stats = [stream_ops.get(op,None) for op in operations]
+    if any(key != 'ddof' for key in kwargs): stats = [None] # other options are not supported
+    def concatBlocks(rlist, axis):
+      ''' concatenate the reduced blocks, separately for each operation '''
+      if not lmulti: rlist = [[rblk] for rblk in rlist]
+      rdata = []
+      for rblks in zip(*rlist):
+        lmasked = any(isinstance(rblk,ma.MaskedArray) for rblk in rblks)
+        rdata.append(ma.concatenate(rblks, axis=axis) if lmasked else np.concatenate(rblks, axis=axis))
+      return rdata
+    if mode == 'block':
+      # blocks are independent, hence the operation can be applied to each data block directly
+      rlist = [reduce(iax=iax, data_view=data) for i0,data in self.iterBlocks(axis=iax, blkmul=blklen, memory=memory)]
+      rdata = concatBlocks(rlist, axis=iax)
+    elif all(stat is not None for stat in stats) and ( mode == 'periodic' or blklen == 0 ):
+      # accumulate moments along the reduction axis (once for all operations)
+      lperi = mode == 'periodic'; rax = -2 if lperi else -1 # blocks are second to last in periodic mode
+      lextrema = any(stat in ('min','max') for stat in stats)
+      acc = None
+      for i0,data in self.iterBlocks(axis=iax, blkmul=blklen if lperi else 1, memory=memory):
+        data = np.rollaxis(data, axis=iax, start=self.ndim) # move reduction axis to the end
+        if lperi: 
+          data = data.reshape(data.shape[:-1]+(data.shape[-1]//blklen,blklen))
+          i0 //= blklen # index of first block
+        if blkidx is not None: # select elements (all) or blocks (periodic)
+          idx = blkidx[( blkidx >= i0 ) & ( blkidx < i0+data.shape[rax] )] - i0
+          if idx.size == 0: continue
+          data = data.take(idx, axis=rax)
+        if fillValue is not None and isinstance(data,ma.MaskedArray): data = data.filled(fillValue)
+        acc = nf.merge_moments(acc, nf.nanmoments(data, axis=rax, lextrema=lextrema))
+      if acc is None: raise ArgumentError(blkidx)
+      rdata = []
+      for op,stat in zip(operations,stats):
+        rdat = nf.moments_to_stat(acc, stat, ddof=kwargs.get('ddof',0))
+        rdat = rdat.astype(op(np.ones((2,1), dtype=self.dtype), axis=0).dtype) # same dtype as operation
+        if self.masked and fillValue is None: rdat = ma.masked_where(acc['cnt'] == 0, rdat)
+        if lperi and iax < self.ndim-1: 
+          rdat = np.rollaxis(rdat, axis=self.ndim-1, start=iax) # move reduction axis back
+        rdata.append(rdat)
+    else: 
+      # apply operation to blocks along an outer axis, which contain the entire reduction axis
+      oax = 1 if iax == 0 else 0
+      rlist = [reduce(iax=iax, data_view=data) for i0,data in self.iterBlocks(axis=oax, memory=memory)]
+      if blklen == 0 and oax > iax: oax -= 1 # reduction axis was removed
+      rdata = concatBlocks(rlist, axis=oax)
+    if not lmulti: rdata = rdata[0]
+    # return reduced array
+    return rdata
    
   def squeeze(self, **kwargs):
     ''' A method to remove singleton dimensions; special handling of __getitem__() is necessary, 
@@ -409,21 +739,21 @@ class VarNC(Variable):
     
   def load(self, data=None, **kwargs):
     ''' Method to load data from NetCDF file into RAM. '''
-    slcs = self.slices
     # optional slicing
     if any([self.hasAxis(ax) for ax in kwargs.iterkeys()]):
-      if slcs is not None: raise NotImplementedError, "Currently, VarNC instances can only be sliced once."
       # extract axes; remove axes from kwargs to avoid slicing again in super-call
       axes = {ax:kwargs.pop(ax) for ax in kwargs.iterkeys() if self.hasAxis(ax)}
       if len(axes) > 0: 
+        ndim = self.ndim
         self, slcs = self.slicing(asVar=True, lslices=True, linplace=True, **axes) # this is poorly tested...
         if data is not None and data.shape != self.shape: data = data.__getitem__(slcs) # slice input data, if appropriate 
+        elif not self.data: self.slices = self._mergeSlices(slcs, ndim=ndim) if self.slices else slcs # compose slices
     if data is None:
       if self.data: 
         return self # do nothing         
-      else: # use slices to load data
-        if slcs is None: slcs = slice(None)
-        data = self.__getitem__(slcs) # load everything
+      else: # use slices to load data (composed in __getitem__)
+        data = self.__getitem__(slice(None)) # load everything
+        self.slices = None # slices are unnecessary now, and cause problems when slicing
     elif isinstance(data,np.ndarray):
       data = data
     elif all(checkIndex(data)):
@@ -452,6 +782,7 @@ class VarNC(Variable):
       else: 
         raise NetCDFError, "Cannot write to NetCDF variable: array shape in memory and on disk are inconsistent!"
       if self.data:
+        if block_cache.enabled: block_cache.clear(varname=ncvar._name) # invalidate cached blocks
         fillValue = self.fillValue
         # special handling of some data types
         if isinstance(self.data_array,np.bool_): 
@@ -997,6 +1328,20 @@ class DatasetNetCDF(Dataset):
     if 'w' in self.mode: self.sync() # 'if mode' is a precaution 
     # close files
     for ds in self.datasets: ds.close()
+    
+  def reopen(self):
+    ''' Reopen the NetCDF files after close() (e.g. after forking worker processes) and reattach variables 
+        and axes to the new file handles; files in write mode are reopened in append mode. '''
+    if not self.filelist or len(self.filelist) != len(self.datasets) or \
+       any(isinstance(ds,nc.MFDataset) for ds in self.datasets): 
+      raise NetCDFError("Can only reopen datasets that were opened from a list of single files.")
+    ncmode = 'a' if 'w' in self.mode else 'r'
+    datasets = [nc.Dataset(filename, mode=ncmode) for filename in self.filelist]
+    dsmap = {id(oldds):newds for oldds,newds in zip(self.datasets,datasets)}
+    for var in self.variables.values() + self.axes.values():
+      if isinstance(var,VarNC) and id(var.ncvar.group()) in dsmap:
+        var.__dict__['ncvar'] = dsmap[id(var.ncvar.group())].variables[var.ncvar._name]
+    self.__dict__['datasets'] = datasets
 
 ## run a test    
 if __name__ == '__main__':
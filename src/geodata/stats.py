@@ -12,6 +12,7 @@ subclasses for handling distribution functions over grid points.
 import numpy as np
 import numpy.ma as ma
 import scipy.stats as ss
+from scipy.special import gamma as gamma_function, gammaln as gammaln_function, ndtr as ndtr_function
 from numpy.linalg.linalg import LinAlgError
 from processing.multiprocess import apply_along_axis
 import functools
@@ -139,6 +140,13 @@ def ks_2samp_wrapper(data, size1=None, ignoreNaN=True):
   D, pval = ss.ks_2samp(data1, data2); del D
   return pval  
 
+# vectorized version of ks_2samp_wrapper
+def ks_2samp_vectorized(data1, data2, ignoreNaN=True):
+  ''' Apply the Kolmogorov-Smirnov Test to all points at once (along the last axis); the p-value 
+      is based on the asymptotic distribution of the statistic (as in older SciPy versions). '''
+  D, pval = myss.ks_2samp_array(data1, data2, ignoreNaN=ignoreNaN); del D
+  return pval
+
 
 # Stundent's T-test for two independent samples
 def ttest_ind(sample1, sample2, equal_var=True, lstatistic=False, ignoreNaN=True, **kwargs):
@@ -172,6 +180,13 @@ def ttest_ind_wrapper(data, size1=None, axis=None, ignoreNaN=True, equal_var=Tru
   D, pval = ss.ttest_ind(data1, data2, axis=axis, equal_var=equal_var); del D
   return pval  
 
+# vectorized version of ttest_ind_wrapper
+def ttest_ind_vectorized(data1, data2, ignoreNaN=True, equal_var=True):
+  ''' Apply the Stundent's T-test to all points at once (along the last axis), removing NaN's 
+      from each sample independently. '''
+  t, pval = myss.ttest_ind_array(data1, data2, equal_var=equal_var, ignoreNaN=ignoreNaN); del t
+  return pval
+
 # Mann-Whitney Rank Test on 2 samples
 def mannwhitneyu(sample1, sample2, ignoreNaN=True, lonesided=False, lstatistic=False, 
                  use_continuity=True, **kwargs):
@@ -302,6 +317,19 @@ def pearsonr_wrapper(data, size1=None, lpval=False, lrho=True, ignoreNaN=True, l
   elif lpval: return pval
   else: raise ArgumentError  
 
+# vectorized version of pearsonr_wrapper
+def pearsonr_vectorized(data1, data2, lpval=False, lrho=True, ignoreNaN=True, lstandardize=False, 
+                        lsmooth=False, window_len=11, window='hanning', ldetrend=False, dof=None):
+  ''' Compute the Pearson's Correlation Coefficient for all points at once (along the last axis); 
+      standardization does not change the result, but smoothing and detrending are not vectorized. '''
+  if lsmooth or ldetrend: raise NotImplementedError, "Smoothing and detrending are not vectorized."
+  rho, pval = myss.pearsonr_array(data1, data2, dof=dof, ignoreNaN=ignoreNaN)
+  # select output
+  if lrho and lpval: return np.stack((rho,pval), axis=-1)
+  elif lrho: return rho
+  elif lpval: return pval
+  else: raise ArgumentError  
+
 
 # Spearman's Rank-order Correlation Coefficient between two samples
 def spearmanr(sample1, sample2, lpval=False, lrho=True, ignoreNaN=True, lstandardize=False,
@@ -361,14 +389,52 @@ def spearmanr_wrapper(data, size1=None, axis=None, lpval=False, lrho=True, ignor
   elif lpval: return pval
   else: raise ArgumentError  
 
+# vectorized version of spearmanr_wrapper
+def spearmanr_vectorized(data1, data2, lpval=False, lrho=True, ignoreNaN=True, lstandardize=False, 
+                         lsmooth=False, window_len=11, window='hanning', ldetrend=False, dof=None):
+  ''' Compute the Spearman's Rank-order Correlation Coefficient for all points at once (along the 
+      last axis); ranks are computed with argsort, so that standardization does not change the 
+      result, but smoothing and detrending are not vectorized. '''
+  if lsmooth or ldetrend: raise NotImplementedError, "Smoothing and detrending are not vectorized."
+  rho, pval = myss.spearmanr_array(data1, data2, dof=dof, ignoreNaN=ignoreNaN)
+  # select output
+  if lrho and lpval: return np.stack((rho,pval), axis=-1)
+  elif lrho: return rho
+  elif lpval: return pval
+  else: raise ArgumentError  
+
+
+# vectorized implementations of apply-along-axis wrappers for 2 sample tests
+vectorized_2samp_tests = {ks_2samp_wrapper:ks_2samp_vectorized, ttest_ind_wrapper:ttest_ind_vectorized, 
+                          pearsonr_wrapper:pearsonr_vectorized, spearmanr_wrapper:spearmanr_vectorized}
+
+# look up a vectorized implementation of a 2 sample test function
+def vectorize_2samp(fct):
+  ''' Return a vectorized version of a 2 sample test function (a partial of an apply-along-axis 
+      wrapper), with the same arguments, or None, if no vectorized implementation is available. '''
+  if isinstance(fct, functools.partial) and not fct.args and fct.func in vectorized_2samp_tests:
+    return functools.partial(vectorized_2samp_tests[fct.func], **(fct.keywords or dict()))
+  else: return None
+
+# apply a vectorized 2 sample test function in blocks of points
+def apply_vectorized_2samp(fct, data1, data2, maxsize=2**22):
+  ''' Apply a vectorized 2 sample test function along the last axis; points are processed in blocks,
+      so that the size of temporary arrays is limited to approximately maxsize elements. '''
+  rshape = data1.shape[:-1]; npts = int(np.prod(rshape))
+  data1 = data1.reshape((npts,data1.shape[-1])); data2 = data2.reshape((npts,data2.shape[-1]))
+  bs = max(1, maxsize//(data1.shape[-1]+data2.shape[-1])) # block size
+  res = np.concatenate([fct(data1[i:i+bs,:], data2[i:i+bs,:]) for i in xrange(0,npts,bs)], axis=0)
+  return res.reshape(rshape+res.shape[1:])
+
 
 # generic applicator function for 2 sample statistical tests
 def apply_stat_test_2samp(sample1, sample2, fct=None, axis=None, axis_idx=None, axes=None, name=None, laax=True, 
                           lflatten=False, fillValue=None, lpval=True, lrho=False, asVar=None, keepdims=False,
-                          lcheckVar=True, lcheckAxis=True, pvaratts=None, rvaratts=None, **kwargs):
+                          lcheckVar=True, lcheckAxis=True, pvaratts=None, rvaratts=None, lvectorize=True, **kwargs):
   ''' Apply a bivariate statistical test or function to two sample Variables and return the result 
       as a Variable object; the function will be applied along the specified axis or over flattened arrays. 
-      This function can return both, the p-value and the function result (other than the p-value). '''
+      This function can return both, the p-value and the function result (other than the p-value). 
+      If lvectorize is True, a vectorized implementation of the test function is used, if available. '''
   # some input checking
   if axes is not None and axis is not None: raise ArgumentError
   elif axes and axis is None: axis = axes
@@ -484,12 +550,19 @@ def apply_stat_test_2samp(sample1, sample2, fct=None, axis=None, axis_idx=None,
   data1 = preprocess(sample1, axis_idx1)
   data2 = preprocess(sample2, axis_idx2)
   assert lflatten or data1.shape[:-1] == data2.shape[:-1]
+  # apply vectorized test to all points at once (if available)
+  res = None; vecfct = vectorize_2samp(fct) if lvectorize else None
+  if vecfct is not None:
+    try: res = apply_vectorized_2samp(vecfct, data1, data2)
+    except NotImplementedError: res = None # fall back to apply_along_axis
   # apply test (serial)
   if lflatten:
     assert data1.ndim == 1 and data2.ndim == 1
-    # merge sample arrays, save dividing index 'size1' (only one argument array per point along axis)
-    data_array = np.concatenate((data1, data2), axis=0) 
-    res = fct(data_array, size1=data1.size) # evaluate function
+    if res is None:
+      # merge sample arrays, save dividing index 'size1' (only one argument array per point along axis)
+      data_array = np.concatenate((data1, data2), axis=0) 
+      res = fct(data_array, size1=data1.size) # evaluate function
+    elif res.ndim == 0: res = res[()] # return scalar
     # disentagle results
     if lrho and lpval:
       rvar, pvar = res[0],res[1]
@@ -499,12 +572,14 @@ def apply_stat_test_2samp(sample1, sample2, fct=None, axis=None, axis_idx=None,
       raise NotImplementedError, "Cannot return a single scalar as a Variable object."
   # apply test (parallel)
   else: 
-    axis_idx = data1.ndim-1; size1 = data1.shape[-1] # shorcuts
-    # merge sample arrays, save dividing index 'size1' (only one argument array per point along axis)
-    data_array = np.concatenate((data1, data2), axis=axis_idx) 
-    # select test and set parameters
-    fct = functools.partial(fct, size1=size1)
-    res = apply_along_axis(fct, axis_idx, data_array, chunksize=500000//len(data_array), laax=laax) # apply test in parallel, distributing the data
+    if res is None:
+      axis_idx = data1.ndim-1; size1 = data1.shape[-1] # shorcuts
+      # merge sample arrays, save dividing index 'size1' (only one argument array per point along axis)
+      data_array = np.concatenate((data1, data2), axis=axis_idx) 
+      # select test and set parameters
+      fct = functools.partial(fct, size1=size1)
+      res = apply_along_axis(fct, axis_idx, data_array, chunksize=500000//len(data_array), laax=laax, 
+                             lshared=True) # apply test in parallel, sharing the data with a persistent pool
     # handle masks etc.
     if (lvar1 and sample1.masked) or (lvar2 and sample1.masked): 
       res = ma.masked_invalid(res, copy=False) 
@@ -546,6 +621,135 @@ def apply_stat_test_2samp(sample1, sample2, fct=None, axis=None, axis_idx=None,
   elif lrho: return rvar
   else: ArgumentError
 
+## field significance and multiple testing
+
+# Benjamini-Hochberg false discovery rate correction
+def fdr_correction(pvals, name=None):
+  ''' Adjust p-values for multiple testing over all points of a field, using the false discovery rate 
+      procedure of Benjamini & Hochberg (1995); missing values are ignored. A point is significant at 
+      a false discovery rate alpha, if its adjusted p-value is smaller than alpha. '''
+  lvar = isinstance(pvals, Variable)
+  data = pvals.getArray(unmask=True, fillValue=np.NaN, dtype=np.float64) if lvar else np.asarray(pvals, dtype=np.float64)
+  flat = data.ravel(); valid = np.where(np.isfinite(flat))[0]
+  idx = valid[np.argsort(flat[valid], kind='mergesort')]; m = len(idx)
+  adjusted = np.zeros_like(flat) + np.NaN
+  if m > 0:
+    qvals = flat[idx] * m / np.arange(1, m+1, dtype=np.float64)
+    adjusted[idx] = np.minimum(np.minimum.accumulate(qvals[::-1])[::-1], 1.)
+  adjusted = adjusted.reshape(data.shape)
+  if lvar: 
+    name = name or '{:s}_fdr'.format(pvals.name)
+    adjusted = pvals.copy(data=ma.masked_invalid(adjusted) if pvals.masked else adjusted, name=name)
+  return adjusted
+
+# Walker test for field significance
+def walker_test(pvals):
+  ''' Return the field significance of a field of p-values according to the Walker test (Wilks, 2006): 
+      the p-value of the smallest local p-value, given the number of (independent) tests, 
+      i.e. 1 - (1 - p_min)**N; missing values are ignored. '''
+  data = pvals.getArray(unmask=True, fillValue=np.NaN, dtype=np.float64) if isinstance(pvals, Variable) else np.asarray(pvals, dtype=np.float64)
+  data = data[np.isfinite(data)]
+  if data.size == 0: return np.NaN
+  return 1. - ( 1. - data.min() )**data.size
+
+# statistics for permutation tests (larger values are less likely under the null hypothesis)
+def _perm_ttest(data1, data2): return np.abs(myss.ttest_ind_array(data1, data2)[0])
+def _perm_kstest(data1, data2): return myss.ks_2samp_array(data1, data2)[0]
+def _perm_meandiff(data1, data2): 
+  with np.errstate(invalid='ignore'): return np.abs(np.nanmean(data1, axis=-1) - np.nanmean(data2, axis=-1))
+def _perm_pearsonr(data1, data2): return np.abs(myss.pearsonr_array(data1, data2)[0])
+def _perm_spearmanr(data1, data2): return np.abs(myss.spearmanr_array(data1, data2)[0])
+permutation_statistics = dict(ttest=_perm_ttest, kstest=_perm_kstest, meandiff=_perm_meandiff, 
+                              pearsonr=_perm_pearsonr, spearmanr=_perm_spearmanr)
+paired_statistics = ('pearsonr','spearmanr') # only the second sample is permuted
+
+# apply-along-axis function for permutation tests
+def permutation_kernel(data, size1=None, axis=None, stat='ttest', perm=None, batch=100):
+  ''' Compute a two-sample statistic for the original samples and for a set of permutations of the
+      sample axis (the last axis); the same permutations are used at every point and replicates are 
+      computed in batches. Returns an array with the observed statistic in the first and the replicates 
+      in the following elements of the last axis. '''
+  statfct = permutation_statistics[stat]
+  data1 = data[...,:size1]; data2 = data[...,size1:]
+  res = np.zeros(data.shape[:-1]+(len(perm)+1,)) + np.NaN
+  res[...,0] = statfct(data1, data2)
+  for i in xrange(0, len(perm), batch):
+    idx = perm[i:i+batch,:] # shared by all points
+    if stat in paired_statistics: 
+      res[...,i+1:i+1+len(idx)] = statfct(data1[...,np.newaxis,:], data2[...,idx])
+    else:
+      pooled = data[...,idx]
+      res[...,i+1:i+1+len(idx)] = statfct(pooled[...,:size1], pooled[...,size1:])
+  return res
+
+# Monte Carlo permutation test on 2 samples
+def permutation_test_2samp(sample1, sample2, stat='ttest', axis=None, axis_idx=None, nperm=1000, batch=100, 
+                           seed=None, NP=0, name=None, lnull=True, asVar=True, ldebug=False):
+  ''' Apply a Monte Carlo permutation test to two samples at every point of a field: the sample axis 
+      is permuted jointly for all points (preserving spatial covariance), and the statistic is computed
+      for nperm replicates in vectorized batches; points are distributed over a process pool. 
+      Available statistics are 'ttest', 'kstest', 'meandiff' (difference of means), 'pearsonr' and 
+      'spearmanr'; for correlations only the second sample is permuted. 
+      Returns local p-values, p-values corrected for multiple testing using the maximum statistic over 
+      the field (family-wise error rate; Westfall & Young, 1993), and (if lnull is True) the replicate 
+      null distributions (with a new 'permutation' axis in front). '''
+  if stat not in permutation_statistics: raise ArgumentError, "Unknown statistic '{:s}'.".format(stat)
+  lvar1 = isinstance(sample1, Variable); lvar2 = isinstance(sample2, Variable)
+  if not lvar1 and not lvar2: asVar = False
+  # prepare data: move sample axis to the end and flatten remaining axes
+  def preprocess(sample, lvar):
+    if lvar:
+      if axis is not None: 
+        if not sample.hasAxis(axis): raise AxisError, "Variable '{:s}' has no axis '{:s}'.".format(sample.name, axis)
+        idx = sample.axisIndex(axis)
+      elif axis_idx is not None: idx = axis_idx
+      else: raise ArgumentError, "Need to specify a sample axis."
+      data = sample.getArray(unmask=True, fillValue=np.NaN, dtype=np.float64)
+    else:
+      if axis_idx is None: raise ArgumentError, "Need to specify an axis index for array samples."
+      idx = axis_idx; data = ma.filled(np.ma.asarray(sample, dtype=np.float64), np.NaN)
+    return np.rollaxis(data, axis=idx, start=data.ndim)
+  data1 = preprocess(sample1, lvar1); data2 = preprocess(sample2, lvar2)
+  rshape = data1.shape[:-1]; size1 = data1.shape[-1]; size2 = data2.shape[-1]
+  if rshape != data2.shape[:-1]: raise AxisError, "Samples need to have same shape (except sample axis)."
+  if stat in paired_statistics and size1 != size2: 
+    raise AxisError, "Samples need to have the same size for correlations."
+  npts = int(np.prod(rshape))
+  data = np.concatenate((data1.reshape((npts,size1)),data2.reshape((npts,size2))), axis=1); del data1, data2
+  # draw all permutations in the parent process (reproducible and independent of NP)
+  rng = np.random.RandomState(seed)
+  nidx = size2 if stat in paired_statistics else size1+size2
+  perm = np.asarray([rng.permutation(nidx) for i in xrange(nperm)], dtype=np.int64).reshape((nperm,nidx))
+  # compute statistics for observed samples and replicates in parallel
+  fct = functools.partial(permutation_kernel, size1=size1, stat=stat, perm=perm, batch=batch)
+  chunksize = max(1, 2**22//(batch*(size1+size2))) # limit size of temporary arrays
+  res = apply_along_axis(fct, 1, data, NP=NP, chunksize=chunksize, laax=False, ldebug=ldebug)
+  obs = res[:,0]; null = res[:,1:]; del res
+  # local and family-wise (maximum statistic) p-values
+  with np.errstate(invalid='ignore'):
+    pval = ( 1. + np.sum(null >= obs[:,np.newaxis], axis=1) ) / ( nperm + 1. )
+    nullmax = np.max(np.where(np.isnan(null), -np.inf, null), axis=0) # maximum over field for each replicate
+    fwer = ( 1. + np.sum(nullmax[np.newaxis,:] >= obs[:,np.newaxis], axis=1) ) / ( nperm + 1. )
+  pval[np.isnan(obs)] = np.NaN; fwer[np.isnan(obs)] = np.NaN
+  pval = pval.reshape(rshape); fwer = fwer.reshape(rshape)
+  null = np.rollaxis(null, axis=1, start=0).reshape((nperm,)+rshape)
+  if asVar:
+    var = sample1 if lvar1 else sample2
+    sname = name or ( '{:s}_{:s}'.format(sample1.name,sample2.name) if lvar1 and lvar2 else var.name )
+    axname = axis if axis is not None else var.axes[axis_idx].name
+    newaxes = tuple(ax for ax in var.axes if ax.name != axname)
+    def makeVar(data, name, long_name, axes=newaxes):
+      atts = dict(name=name, long_name=long_name, units='')
+      return Variable(data=ma.masked_invalid(data), axes=axes, atts=atts, plot=getPlotAtts(name=name, units=''))
+    pval = makeVar(pval, sname+'_pval', 'Permutation p-value ({:s})'.format(stat))
+    fwer = makeVar(fwer, sname+'_pval_fwer', 'Field-wise Permutation p-value ({:s})'.format(stat))
+    if lnull:
+      permax = Axis(name='permutation', units='#', coord=np.arange(nperm))
+      null = makeVar(null, sname+'_null', 'Permutation Null Distribution ({:s})'.format(stat), axes=(permax,)+newaxes)
+  # return results
+  if lnull: return pval, fwer, null
+  else: return pval, fwer
+
 ## distribution variable classes 
 
 # dictionary with distribution definitions for common variables  
@@ -624,8 +828,10 @@ def asDistVar(var, axis='time', dist=None, lflatten=False, name=None, atts=None,
   varatts['sample_axis'] = axis # preserve record of data
   varatts['sample_size'] = var.data_array.size if lflatten else len(var.axes[iaxis])
   # create DistVar instance
-  if dist.lower() == 'kde': dvar = VarKDE(samples=var.data_array, axis=iaxis, axes=axes, nsamples=nsamples, 
-                                          lflatten=lflatten, atts=varatts, **dist_args)
+  if dist.lower() == 'kde': 
+    dist_args = {key:value for key,value in dist_args.items() if key != 'fit_method'} # only for VarRV
+    dvar = VarKDE(samples=var.data_array, axis=iaxis, axes=axes, nsamples=nsamples, 
+                  lflatten=lflatten, atts=varatts, **dist_args)
   elif hasattr(ss,dist):
     dvar = VarRV(dist=dist, samples=var.data_array, axis=iaxis, axes=axes, nsamples=nsamples,
                  lflatten=lflatten, atts=varatts, lcrossval=lcrossval, ncv=ncv, **dist_args)
@@ -647,13 +853,15 @@ class DistVar(Variable):
 
   def __init__(self, name=None, units=None, axes=None, samples=None, nsamples=None, params=None, axis=None, 
                dtype=None, lflatten=False, masked=None, mask=None, fillValue=None, atts=None, ldebug=False, 
-               lbootstrap=False, nbs=1000, bootstrap_axis='bootstrap', 
-               lcrossval=False, ncv=0.2, crossval_mode='random', **kwargs):
+               lbootstrap=False, nbs=1000, bootstrap_axis='bootstrap', bootstrap_batch=None, 
+               lcrossval=False, ncv=0.2, crossval_mode='random', seed=None, **kwargs):
     '''
       This method creates a new DisVar instance from data and parameters. If data is provided, a sample
       axis has to be specified or the last (innermost) axis is assumed to be the sample axis.
       An estimation/fit will be performed at every grid point and stored in an array.
       Note that 'dtype' and 'units' refer to the sample data, not the distribution.
+      Bootstrap samples are drawn from one index matrix and fitted in batches of 'bootstrap_batch' 
+      replicates (default: all at once); 'seed' (or a RandomState) makes resampling reproducible.
     '''
     # if parameters are provided
     if params is not None:
@@ -710,66 +918,60 @@ class DistVar(Variable):
       if nsamples is None: nsamples = sz
       if nsamples < 2: raise ValueError, nsamples # check samples[:] as well!
       if nsamples > sz: raise ValueError, sz  
-      ## add bootstrap axis and generate bootstrap samples
+      ## random number generator (seedable, for reproducible resampling)
+      rng = seed if isinstance(seed,np.random.RandomState) else np.random.RandomState(seed)
+      # N.B.: all random indices are drawn here, so that results do not depend on the number of processes
+      ## add bootstrap axis and draw bootstrap indices
       if lbootstrap:
         # create and add bootstrap axis
         bsatts = dict(name=bootstrap_axis,units='',long_name='Bootstrap Samples')
         bsax = Axis(coord=np.arange(nbs), atts=bsatts)
         axes = (bsax,) + axes # add this axis as outer-most
-        shape = (nbs,) + samples.shape
-        # resample the samples (nbs times)
-        bootstrap = np.zeros(shape, dtype=samples.dtype) # allocate memory
-        if lns: # select a random subset (without replacement)
-          bootstrap[0,:] = np.apply_along_axis(np.random.choice, -1, samples, size=nsamples, replace=False)
-        else: bootstrap[0,:] = samples # first element is the real sample data
-        for i in xrange(1,nbs): # take random draws with replacement
-          bootstrap[i,:] = np.apply_along_axis(np.random.choice, -1, samples, size=nsamples, replace=True)
-          #idx = np.random.randint(sz, size=nsamples) # select random indices
-          #bootstrap[i,:] = samples.take(idx, axis=-1) # write random sample into array
-        samples = bootstrap
+        # one (nbs, nsamples) index matrix is used for all grid points (preserves spatial covariance)
+        idx_rng = np.empty((nbs,nsamples), dtype=np.intp) 
+        if lns: idx_rng[0,:] = rng.choice(sz, size=nsamples, replace=False) # select a random subset (without replacement)
+        else: idx_rng[0,:] = np.arange(sz) # first element is the real sample data
+        idx_rng[1:,:] = rng.randint(sz, size=(nbs-1,nsamples)) # take random draws with replacement
         # N.B.: from here one everything should proceed normally, with the extra bootstrap axis in the 
         #       resulting DistVar object; obtain confidence intervalls as percentiles along this axis
-        # N.B.: In order to save memory, this could be inplemented more efficiently within the fit-       
-        #       functions, so that the resampling only occurs immediately before fitting.
-        #       Essentially, there would be two separate estimations, one with the original sample 
-        #       vector, and a given number of estimations with prior resampling; these would then be 
-        #       stacked along the bootstrap axis.
-        # N.B.: Performing resampling and estimation iteratively, one by one, would also save memory, 
-        #       but prevent parallelization of the bootstrap process.
       elif lns: 
         # select a random subset (without replacement)
-        samples = np.apply_along_axis(np.random.choice, -1, samples, size=nsamples, replace=False)
-      sz = samples.shape[-1] # update
+        samples = samples.take(rng.choice(sz, size=nsamples, replace=False), axis=-1)
+      sz = nsamples # update
       ## exclude a regular subset/fraction for cross-validation 
       if lcrossval:
-        idx_dtype = np.int16 if sz < 32767 else (np.int32 if sz < 2147483647 else np.int64) # save some memory
         #ncv = 3 if lcrossval is True else int(lcrossval)
         if 1 < ncv < 2: raise ValueError, lcrossval
         if crossval_mode.lower() == 'random': # default: use a random subset
           if ncv < 1: nncv = int(np.round((1-ncv)*sz)) # convert fraction to number of elements
           else: nncv = int(sz - np.round(sz/ncv)) # treat as denominator of fraction used for validation
-          idx_rng = np.tile(np.arange(sz, dtype=idx_dtype), samples.shape[:-1]+(1,))
-          idx_rng = np.apply_along_axis(np.random.choice, -1, idx_rng, size=nncv, replace=False)
+          cv_idx = rng.choice(sz, size=nncv, replace=False) # same subset for all grid points
           # save cross-validation mask
-          crossval_mask = np.ones(samples.shape, dtype=np.bool8, order='C')
-          apply_over_arrays(np.put, crossval_mask, idx_rng, v=np.bool(0), mode='raise')
-          check_mask = crossval_mask.sum(axis=-1)
-          assert crossval_mask.shape == samples.shape
-          assert check_mask.min() == check_mask.max(), (check_mask.min(),check_mask.max()) 
-          assert check_mask.mean() == sz-nncv, (check_mask.mean(),nncv) 
+          crossval_mask = np.ones(((nbs,) if lbootstrap else ())+samples.shape[:-1]+(sz,), dtype=np.bool8, order='C')
+          crossval_mask[...,cv_idx] = False
         else:
           # a deterministic subset 
           if ncv < 1: raise ValueError, lcrossval # denominator of fraction used for validation
-          idx_rng = []
+          cv_idx = []
           for icv in xrange(0,sz,ncv):
-            idx_rng += np.arange(icv,min(icv+ncv-1,sz), order='C', dtype=idx_dtype)
-          idx_rng = np.concatenate(idx_rng)
-        #idx_rng = np.random.randint(saxlen, size=saxlen)[idx_rng] # use a randome sample...
-        subsample = np.zeros_like(idx_rng, dtype=samples.dtype, order='C', subok=True) # allocate subsample
-        apply_over_arrays(np.take, samples, idx_rng, axis=-1, out=subsample, mode='raise')
-        samples = subsample # use subsample instead of full sample
+            cv_idx.append(np.arange(icv,min(icv+ncv-1,sz), dtype=np.intp))
+          cv_idx = np.concatenate(cv_idx)
+        # use subsample instead of full sample
+        if lbootstrap: idx_rng = idx_rng[:,cv_idx]
+        else: samples = samples.take(cv_idx, axis=-1)
       # estimate distribution parameters
-      params = self._estimate_distribution(samples, ldebug=ldebug, **kwargs)
+      if lbootstrap:
+        # gather bootstrap samples in batches and fit immediately, to limit memory use
+        bsbatch = bootstrap_batch or nbs
+        params = []
+        for i in xrange(0,nbs,bsbatch):
+          idx = idx_rng[i:i+bsbatch].reshape((-1,)+(1,)*(samples.ndim-1)+(idx_rng.shape[-1],))
+          bootstrap = np.take_along_axis(samples.reshape((1,)+samples.shape), idx, axis=-1)
+          params.append(self._estimate_distribution(bootstrap, ldebug=ldebug, **kwargs))
+          del bootstrap
+        params = params[0] if len(params) == 1 else np.concatenate(params, axis=0)
+      else:
+        params = self._estimate_distribution(samples, ldebug=ldebug, **kwargs)
       # N.B.: the method estimate() should be implemented by specific child classes      
       # N.B.: 'ic' are initial guesses for parameter values; 'kwargs' are for the estimator algorithm 
     # sample fillValue
@@ -1131,15 +1333,77 @@ def kde_cdf(kde, support=None, n=0, fillValue=np.NaN):
       fct = lambda s: kde[0].integrate_box_1d(-1*np.inf,s)
       res = np.asarray([fct(s) for s in support])
     return res
+
+# array-native KDE representation: bandwidth and sorted sample vector (NaN-padded) for each point
+# N.B.: this is equivalent to a 1D scipy gaussian_kde, but can be computed with broadcasting over all 
+#       points at once and is stored as a plain float array (with a parameter axis)
+
+# estimate bandwidth and store samples
+def kde_array_estimate(samples, bw_method=None):
+  ''' return an array with the kernel bandwidth (standard deviation) in the first element and the 
+      sorted samples (NaN's at the end) along the last axis; bandwidth rules follow gaussian_kde '''
+  samples = np.sort(samples, axis=-1) # NaN's are sorted to the end
+  n = np.sum(np.isfinite(samples), axis=-1).astype(np.float)
+  if bw_method is None or bw_method == 'scott': factor = n**(-1./5.)
+  elif bw_method == 'silverman': factor = (n*3./4.)**(-1./5.)
+  elif np.isscalar(bw_method) and not isinstance(bw_method, basestring): factor = float(bw_method)
+  else: raise ArgumentError, "Unsupported bandwidth method: {}".format(bw_method)
+  with np.errstate(invalid='ignore', divide='ignore'):
+    mean = np.nansum(samples, axis=-1) / n
+    std = np.sqrt( np.nansum((samples-mean[...,np.newaxis])**2, axis=-1) / (n-1.) )
+    bw = factor * std
+  bw = np.where(bw > 0, bw, np.NaN) # degenerate kernels
+  return np.concatenate([bw[...,np.newaxis], samples], axis=-1)
+
+# evaluate PDF or CDF of array-native KDEs
+def kde_array_eval(params, support=None, fct_type='pdf', fillValue=np.NaN, maxsize=2**22):
+  ''' evaluate the PDF or CDF of array-native KDEs over a support vector; points are processed in 
+      chunks, so that the intermediate (points, support, samples) array does not exceed maxsize '''
+  shape = params.shape[:-1]; params = params.reshape((-1,params.shape[-1]))
+  support = np.asarray(support, dtype=np.float).ravel(); nsup = len(support)
+  if fct_type == 'pdf': kernel = lambda z: np.exp(-0.5*z**2) / np.sqrt(2.*np.pi)
+  elif fct_type == 'cdf': kernel = ndtr_function
+  else: raise ArgumentError, fct_type
+  res = np.empty((len(params),nsup))
+  chunk = max(1, maxsize // ( nsup * (params.shape[-1]-1) ))
+  for i in xrange(0,len(params),chunk):
+    bw = params[i:i+chunk,0,np.newaxis,np.newaxis]; samples = params[i:i+chunk,np.newaxis,1:]
+    n = np.sum(np.isfinite(samples), axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+      z = ( support[np.newaxis,:,np.newaxis] - samples ) / bw
+      k = np.where(np.isnan(samples), 0., kernel(z))
+      tmp = np.sum(k, axis=-1) / n
+      if fct_type == 'pdf': tmp /= bw[...,0]
+    res[i:i+chunk,:] = np.where(np.isnan(bw[...,0]), fillValue, tmp)
+  return res.reshape(shape+(nsup,))
+
+# draw samples from array-native KDEs
+def kde_array_resample(params, n=None, fillValue=np.NaN, dtype=np.float):
+  ''' draw n random samples from array-native KDEs (random sample plus Gaussian kernel noise) '''
+  shape = params.shape[:-1]; params = params.reshape((-1,params.shape[-1]))
+  bw = params[:,0]; samples = params[:,1:]
+  nvalid = np.sum(np.isfinite(samples), axis=-1)
+  # N.B.: valid samples are at the beginning, since they are sorted
+  idx = np.floor(np.random.uniform(size=(len(params),n)) * nvalid[:,np.newaxis]).astype(np.intp)
+  idx = np.minimum(idx, samples.shape[-1]-1)
+  res = np.take_along_axis(samples, idx, axis=-1) + np.random.normal(size=idx.shape) * bw[:,np.newaxis]
+  res = np.where(np.isnan(bw)[:,np.newaxis], fillValue, res)
+  return np.asarray(res, dtype=dtype).reshape(shape+(n,))
   
 # Subclass of DistVar implementing Kernel Density Estimation
 class VarKDE(DistVar):
-  ''' A subclass of DistVar implementing Kernel Density Estimation (scipy.stats.kde) ''' 
+  ''' A subclass of DistVar implementing Kernel Density Estimation (scipy.stats.kde); by default KDEs are 
+      stored as an array of bandwidths and samples (with a parameter axis), otherwise (lvectorize=False) 
+      as an object array of scipy gaussian_kde instances ''' 
   dist_type = 'kde'
   
   # distribution-specific method; should be overloaded by subclass
-  def _estimate_distribution(self, samples, ic_shape=None, ic_args=None, ic_loc=None, ic_scale=None, ldebug=False, **kwargs):
+  def _estimate_distribution(self, samples, ic_shape=None, ic_args=None, ic_loc=None, ic_scale=None, ldebug=False, 
+                             lvectorize=True, bw_method=None, **kwargs):
     ''' esimtate/fit distribution from sample array for each grid point and return parameters as ndarray  '''
+    if lvectorize and not kwargs and not callable(bw_method):
+      return kde_array_estimate(samples, bw_method=bw_method)
+    if bw_method is not None: kwargs['bw_method'] = bw_method
     fct = functools.partial(kde_estimate, ldebug=ldebug, **kwargs)
     kernels = apply_along_axis(fct, samples.ndim-1, samples, chunksize=100//len(samples)).squeeze()
     assert samples.shape[:-1] == kernels.shape
@@ -1150,6 +1414,8 @@ class VarKDE(DistVar):
   def _density_distribution(self, support):
     ''' compute PDF at given support points for each grid point and return as ndarray '''
     n = len(support); fillValue = self.fillValue or np.NaN
+    if self.paramAxis is not None: # array-native KDE
+      return kde_array_eval(self.data_array, support=support, fct_type='pdf', fillValue=fillValue)
     data = self.data_array.reshape(self.data_array.shape+(1,)) # expand
     fct = functools.partial(kde_eval, support=support, n=n, fillValue=fillValue)
     pdf = apply_along_axis(fct, self.ndim, data, chunksize=100//n)
@@ -1161,6 +1427,8 @@ class VarKDE(DistVar):
     ''' draw n samples from the distribution for each grid point and return as ndarray '''
     n = len(support) # in order to use _get_dist(), we have to pass a dummy support
     fillValue = self.fillValue or np.NaN # for masked values
+    if self.paramAxis is not None: # array-native KDE
+      return kde_array_resample(self.data_array, n=n, fillValue=fillValue, dtype=self.dtype)
     data = self.data_array.reshape(self.data_array.shape+(1,)) # expand
     fct = functools.partial(kde_resample, support=support, n=n, fillValue=fillValue, dtype=self.dtype)
     samples = apply_along_axis(fct, self.ndim, data, chunksize=100//n)
@@ -1172,6 +1440,8 @@ class VarKDE(DistVar):
   def _cumulative_distribution(self, support):
     ''' integrate PDF over given support to produce a CDF and return as ndarray '''
     n = len(support); fillValue = self.fillValue or np.NaN
+    if self.paramAxis is not None: # array-native KDE
+      return kde_array_eval(self.data_array, support=support, fct_type='cdf', fillValue=fillValue)
     data = self.data_array.reshape(self.data_array.shape+(1,))
     fct = functools.partial(kde_cdf, support=support, n=n, fillValue=fillValue)
     cdf = apply_along_axis(fct, self.ndim, data, chunksize=100//n)
@@ -1247,6 +1517,174 @@ def rv_fit(sample, dist_type=None, ic_shape=None, ic_args=None, ic_loc=None, ic_
       res = (np.NaN,)*plen
   return res # already is a tuple
 
+# vectorized estimators (L-moments and batched Newton refinement) for a fast path in VarRV
+# N.B.: these operate on the entire (points x samples) array at once, instead of point by point
+
+# distributions with closed-form/approximate L-moment estimators
+lmoment_distributions = ('norm','gumbel_r','genextreme','gamma','genpareto','lognorm')
+
+# compute sample L-moments along the last axis
+def sample_lmoments(samples, nmom=3):
+  ''' compute the first three sample L-moments (l1, l2, l3) along the last axis, ignoring NaN's; 
+      returns an array with an additional last dimension of length nmom and the sample count '''
+  if nmom > 3: raise NotImplementedError, nmom
+  samples = np.sort(samples, axis=-1) # NaN's are sorted to the end
+  n = np.sum(np.isfinite(samples), axis=-1).astype(np.float)[...,np.newaxis]
+  samples = np.where(np.isfinite(samples), samples, 0.)
+  j = np.arange(samples.shape[-1], dtype=np.float) # j-1 in the usual notation
+  with np.errstate(divide='ignore', invalid='ignore'):
+    w0 = np.where(j < n, 1., 0.) / n
+    b0 = np.sum(w0*samples, axis=-1)
+    w1 = w0 * j / (n-1.) 
+    b1 = np.sum(w1*samples, axis=-1)
+    w2 = w1 * (j-1.) / (n-2.)
+    b2 = np.sum(w2*samples, axis=-1)
+  lmom = np.stack([b0, 2*b1-b0, 6*b2-6*b1+b0][:nmom], axis=-1)
+  return lmom, n[...,0]
+
+# estimate distribution parameters from L-moments
+def rv_fit_lmoments(samples, dist_type=None, plen=None, lpositiveShape=False, lnegativeShape=False, f0=None):
+  ''' vectorized L-moment estimator (Hosking & Wallis, 1997) for common distributions; returns a 
+      parameter array with scipy conventions (shape, loc, scale) and NaN where the estimate fails '''
+  if dist_type not in lmoment_distributions: raise NotImplementedError, dist_type
+  lmom, n = sample_lmoments(samples, nmom=3)
+  l1, l2, l3 = lmom[...,0], lmom[...,1], lmom[...,2]
+  params = np.zeros(samples.shape[:-1]+(plen,)) + np.NaN
+  with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+    t3 = l3 / l2 # L-skewness
+    if dist_type == 'norm':
+      params[...,1] = l2 * np.sqrt(np.pi); params[...,0] = l1
+    elif dist_type == 'gumbel_r':
+      scale = l2 / np.log(2.); params[...,1] = scale
+      params[...,0] = l1 - np.euler_gamma * scale
+    elif dist_type == 'genextreme':
+      z = 2. / ( 3. + t3 ) - np.log(2.) / np.log(3.)
+      c = 7.8590 * z + 2.9554 * z**2 # N.B.: scipy's c is Hosking's k
+      c = np.where(np.abs(c) < 1e-6, 1e-6, c) # avoid singularity at Gumbel limit
+      g = gamma_function(1.+c)
+      scale = l2 * c / ( ( 1. - 2.**(-c) ) * g )
+      params[...,0] = c; params[...,2] = scale
+      params[...,1] = l1 - scale * ( 1. - g ) / c
+      zero = ( l1 - np.euler_gamma * l2 / np.log(2.), l2 / np.log(2.) ) # Gumbel limit
+    elif dist_type == 'genpareto':
+      k = ( 1. - 3. * t3 ) / ( 1. + t3 ) # Hosking's k; scipy's c = -k
+      params[...,0] = -k; params[...,2] = ( 1. + k ) * ( 2. + k ) * l2
+      params[...,1] = l1 - ( 2. + k ) * l2
+      zero = ( l1 - 2. * l2, 2. * l2 ) # exponential limit
+    elif dist_type == 'gamma':
+      # Pearson type III estimate; only valid for positive skewness
+      at3 = np.abs(t3); z = np.where(at3 < 1./3., 3. * np.pi * t3**2, 1. - at3)
+      alpha = np.where(at3 < 1./3., 
+                       ( 1. + 0.2906 * z ) / ( z + 0.1882 * z**2 + 0.0442 * z**3 ),
+                       ( 0.36067 * z - 0.59567 * z**2 + 0.25361 * z**3 ) / ( 1. - 2.78861 * z + 2.56096 * z**2 - 0.77045 * z**3 ))
+      sigma = l2 * np.sqrt(np.pi) * np.sqrt(alpha) * np.exp(gammaln_function(alpha) - gammaln_function(alpha+0.5))
+      scale = sigma / np.sqrt(alpha)
+      alpha = np.where(t3 > 0, alpha, np.NaN)
+      params[...,0] = alpha; params[...,2] = scale; params[...,1] = l1 - alpha * scale
+    elif dist_type == 'lognorm':
+      # generalized normal estimate; only valid for positive skewness
+      t32 = t3**2
+      k = -t3 * ( 2.0466534 - 3.6544371 * t32 + 1.8396733 * t32**2 - 0.20360244 * t32**3 ) / \
+                ( 1. - 2.0182173 * t32 + 1.2420401 * t32**2 - 0.21741801 * t32**3 )
+      k = np.where(t3 > 0, k, np.NaN)
+      alpha = l2 * k * np.exp(-k**2/2.) / ( 1. - 2. * ss.norm.cdf(-k/np.sqrt(2.)) )
+      xi = l1 - alpha / k * ( 1. - np.exp(k**2/2.) )
+      params[...,0] = -k; params[...,2] = -alpha / k; params[...,1] = xi + alpha / k
+    # fix shape parameter at zero, if requested or if the sign is unrealistic
+    if dist_type in ('genextreme','genpareto'):
+      if f0 == 0: fix = np.ones(l1.shape, dtype=np.bool)
+      elif lnegativeShape: fix = params[...,0] > 0
+      elif lpositiveShape: fix = params[...,0] < 0
+      else: fix = np.zeros(l1.shape, dtype=np.bool)
+      params[fix,0] = 0.; params[fix,1] = zero[0][fix]; params[fix,2] = zero[1][fix]
+    # invalid estimates
+    invalid = ( n < plen ) | ~( l2 > 0 ) | ~( params[...,-1] > 0 )
+  params[invalid,:] = np.NaN
+  return params
+
+# log-likelihood for an entire array of samples and parameters
+def rv_loglikelihood(samples, params, dist_type=None):
+  ''' log-likelihood along the last axis for an array of samples and corresponding parameters '''
+  dist = getattr(ss,dist_type)
+  args = [params[...,i,np.newaxis] for i in xrange(params.shape[-1]-2)]
+  with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+    ll = dist.logpdf(samples, *args, loc=params[...,-2,np.newaxis], scale=params[...,-1,np.newaxis])
+    ll = np.where(np.isnan(samples), 0., ll) # ignore missing values
+    ll = np.sum(ll, axis=-1)
+  return np.where(np.isnan(ll), -np.inf, ll)
+
+# batched Newton refinement of the likelihood
+def rv_fit_newton(samples, params, dist_type=None, fixed=None, niter=20, tol=1e-6, h=1e-4):
+  ''' refine distribution parameters for all points at once by maximizing the likelihood with a damped 
+      Newton method (derivatives from finite differences); 'fixed' is a list of parameter indices that 
+      are held constant; points where the initial guess has no finite likelihood are left unchanged '''
+  result = params.copy(); plen = params.shape[-1]
+  free = [i for i in xrange(plen) if not fixed or i not in fixed]
+  # optimize log(scale) and loc normalized by scale, so that the problem is well-scaled
+  params = result; scale0 = params[...,-1].copy()
+  def toParams(theta):
+    p = params.copy()
+    for k,i in enumerate(free): p[...,i] = theta[...,k]
+    p[...,-2] *= scale0; p[...,-1] = np.exp(p[...,-1]) * scale0
+    return p
+  theta = params[...,free].copy()
+  if plen-2 in free: theta[...,free.index(plen-2)] /= scale0
+  if plen-1 in free: theta[...,free.index(plen-1)] = 0.
+  # only refine points where the likelihood is finite
+  f0 = rv_loglikelihood(samples, toParams(theta), dist_type=dist_type)
+  if plen-2 in free and not np.all(np.isfinite(f0)):
+    # try to move the support of the distribution, so that it includes all sample values
+    p = toParams(theta); dist = getattr(ss,dist_type); args = [p[...,i] for i in xrange(plen-2)]
+    with np.errstate(invalid='ignore'):
+      lower = dist.ppf(0., *args, loc=p[...,-2], scale=p[...,-1]) - np.nanmin(samples, axis=-1)
+      upper = np.nanmax(samples, axis=-1) - dist.ppf(1., *args, loc=p[...,-2], scale=p[...,-1])
+    shift = np.where(lower >= 0, -lower/p[...,-1] - 0.01, 0.) + np.where(upper >= 0, upper/p[...,-1] + 0.01, 0.)
+    shift = np.where(np.isfinite(f0) | ~np.isfinite(shift), 0., shift)
+    theta[...,free.index(plen-2)] += shift
+    f0 = rv_loglikelihood(samples, toParams(theta), dist_type=dist_type)
+  active = np.isfinite(f0) & np.all(np.isfinite(theta), axis=-1)
+  if not np.any(active): return result
+  samples = samples[active]; theta = theta[active]; f0 = f0[active]; scale0 = scale0[active]
+  params = result[active] # N.B.: toParams uses the current binding
+  fct = lambda th: rv_loglikelihood(samples, toParams(th), dist_type=dist_type)
+  nf = len(free); eye = np.eye(nf) * h
+  for _ in xrange(niter):
+    # gradient and Hessian from central differences
+    fp = [fct(theta+eye[i]) for i in xrange(nf)]
+    fm = [fct(theta-eye[i]) for i in xrange(nf)]
+    grad = np.stack([(fp[i]-fm[i])/(2*h) for i in xrange(nf)], axis=-1)
+    hess = np.zeros(theta.shape+(nf,))
+    for i in xrange(nf):
+      hess[...,i,i] = ( fp[i] - 2*f0 + fm[i] ) / h**2
+      for j in xrange(i+1,nf):
+        hess[...,i,j] = ( fct(theta+eye[i]+eye[j]) - fct(theta+eye[i]-eye[j]) - 
+                          fct(theta-eye[i]+eye[j]) + fct(theta-eye[i]-eye[j]) ) / (4*h**2)
+        hess[...,j,i] = hess[...,i,j]
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+      # Newton step with absolute eigenvalues of the Hessian, so that it is always an ascent direction
+      # parameters with non-finite derivatives (e.g. location at the boundary of the support) are held 
+      # constant in this step, so that the remaining parameters can still be refined
+      diag = np.arange(nf); frozen = ~np.isfinite(grad) | ~np.isfinite(hess[...,diag,diag])
+      hess[frozen[...,:,np.newaxis] | frozen[...,np.newaxis,:] | ~np.isfinite(hess)] = 0.; grad[frozen] = 0.
+      hess[...,diag,diag] = np.where(frozen, -1., hess[...,diag,diag])
+      try: 
+        w, v = np.linalg.eigh(hess); w = np.abs(w)
+        w = np.maximum(w, 1e-8*np.max(w, axis=-1, keepdims=True))
+        step = np.einsum('...ij,...j->...i', v, np.einsum('...ji,...j->...i', v, grad) / w)
+      except LinAlgError: step = np.zeros_like(grad)
+      step = np.where(np.isfinite(step), step, 0.)
+    # backtracking line search: only accept steps that improve the likelihood
+    accept = np.zeros(f0.shape, dtype=np.bool); alpha = 1.
+    for _ in xrange(16):
+      f1 = fct(theta + alpha*step)
+      new = ~accept & np.isfinite(f1) & ( f1 >= f0 )
+      theta[new] += alpha*step[new]; f0[new] = f1[new]; accept |= new
+      if np.all(accept): break
+      alpha /= 2.
+    if not np.any(accept) or np.max(np.abs(step[accept])) < tol: break
+  result[active] = toParams(theta)
+  return result
+
 # evaluate a RV distribution type over a given support with given parameters
 def rv_eval(params, dist_type=None, fct_type=None, support=None, n=None, fillValue=np.NaN):
   if np.any(np.isnan(params)): res = np.zeros(len(support))+fillValue 
@@ -1302,8 +1740,10 @@ class VarRV(DistVar):
   
   # initial guesses for shape parameter
   def __init__(self, dist='', ic_shape=None, ic_args=None, ic_loc=None, ic_scale=None, 
-               lcrossval=False, samples=None, axis=None, **kwargs):
-    ''' initialize a random variable distribution of type 'dist' '''
+               lcrossval=False, samples=None, axis=None, fit_method='mle', **kwargs):
+    ''' initialize a random variable distribution of type 'dist'; 'fit_method' selects the estimator: 
+        'mle' (scipy fit at every point), 'lmoments' (vectorized L-moment estimate), or 'newton' 
+        (L-moment estimate, refined with a vectorized Newton method for the likelihood) '''
     # some aliases
     if dist.lower() in ('genextreme', 'gev'): dist = 'genextreme' 
     elif dist.lower() in ('genpareto', 'gpd'): dist = 'genpareto' # 'pareto' is something else!
@@ -1317,6 +1757,7 @@ class VarRV(DistVar):
       raise ArgumentError, "No distribution '{:s}' in module scipy.stats!".format(dist)
     # N.B.: the distribution info will be available to the _estimate_distribution-method
     # initialize distribution variable
+    if samples is not None: kwargs['fit_method'] = fit_method # only used for estimation
     super(VarRV,self).__init__(ic_shape=ic_shape, ic_args=ic_args, ic_loc=ic_loc, ic_scale=ic_scale, 
                                lcrossval=lcrossval, samples=samples, axis=axis, **kwargs)
     # N.B.: ic-parameters and kwargs are passed one to _estimate_distribution-method
@@ -1350,14 +1791,23 @@ class VarRV(DistVar):
     return attr
   
   # distribution-specific method; should be overloaded by subclass
-  def _estimate_distribution(self, samples, ic_shape=None, ic_args=None, ic_loc=None, ic_scale=None, lpersist=False, ldebug=False, **kwargs):
+  def _estimate_distribution(self, samples, ic_shape=None, ic_args=None, ic_loc=None, ic_scale=None, lpersist=False, 
+                             ldebug=False, fit_method='mle', **kwargs):
     ''' esimtate/fit distribution from sample array for each grid point and return parameters as ndarray  '''
+    plen = self.dist_class.numargs + 2 # infer number of parameters
+    # vectorized fast path (falls back to MLE for unsupported distributions and fit arguments)
+    fit_method = ( fit_method or 'mle' ).lower()
+    if fit_method in ('lmom','lmoments','newton') and self.dist_type in lmoment_distributions:
+      lshape = self.dist_type in ('genextreme','genpareto') # shape constraints are supported
+      if all(key in ('lpositiveShape','lnegativeShape','f0') for key in kwargs) and \
+         ( lshape or not any(kwargs.values()) ) and kwargs.get('f0',0) == 0:
+        return self._estimate_vectorized(samples, plen=plen, lnewton=fit_method=='newton', **kwargs)
+    elif fit_method not in ('mle','lmom','lmoments','newton'): raise ArgumentError, fit_method
     if lpersist: # reset global parameters
       global_loc   = None # location parameter ("mean")
       global_scale = None # scale parameter ("standard deviation")
       global_shape = None # single shape parameter
       global_args  = None # multiple shape parameters
-    plen = self.dist_class.numargs + 2 # infer number of parameters
     fct = functools.partial(rv_fit, ic_shape=ic_shape, ic_args=ic_args, ic_loc=ic_loc, ic_scale=ic_scale, plen=plen, 
                             dist_type=self.dist_type, lpersist=lpersist, ldebug=ldebug, **kwargs)
     params = apply_along_axis(fct, samples.ndim-1, samples, chunksize=100//plen//len(samples))
@@ -1370,6 +1820,30 @@ class VarRV(DistVar):
     # return an array of kernels
     return params
 
+  def _estimate_vectorized(self, samples, plen=None, lnewton=False, lpositiveShape=False, lnegativeShape=False, f0=None):
+    ''' estimate distribution parameters for all grid points at once using L-moments, optionally followed 
+        by a vectorized Newton refinement of the likelihood '''
+    shape = samples.shape[:-1]
+    samples = samples.reshape((-1,samples.shape[-1]))
+    params = rv_fit_lmoments(samples, dist_type=self.dist_type, plen=plen, f0=f0,
+                             lpositiveShape=lpositiveShape, lnegativeShape=lnegativeShape)
+    if lnewton:
+      # points where the shape parameter has been fixed at zero are refined separately
+      zero = params[:,0] == 0 if plen == 3 else np.zeros(len(params), dtype=np.bool)
+      if np.any(~zero): 
+        params[~zero] = rv_fit_newton(samples[~zero], params[~zero], dist_type=self.dist_type)
+        # re-apply shape constraints after refinement
+        if lnegativeShape: wrong = params[:,0] > 0
+        elif lpositiveShape: wrong = params[:,0] < 0
+        else: wrong = None
+        if wrong is not None and np.any(wrong):
+          params[wrong] = rv_fit_lmoments(samples[wrong], dist_type=self.dist_type, plen=plen, f0=0)
+          zero |= wrong
+      if np.any(zero):
+        params[zero] = rv_fit_newton(samples[zero], params[zero], dist_type=self.dist_type, fixed=[0])
+    params = params.reshape(shape+(plen,))
+    return params
+
   # universal RV method applicator for distributions
   def _compute_distribution(self, *args, **kwargs):
     ''' compute a given distribution type over the given support points for each grid point and return as ndarray '''
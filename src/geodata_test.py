@@ -21,6 +21,7 @@ from geodata.misc import isZero, isOne, isEqual, isNumber
 from geodata.base import Variable, Axis, Dataset, Ensemble, concatVars, concatDatasets
 from geodata.stats import VarKDE, VarRV, asDistVar
 from geodata.stats import kstest, ttest, mwtest, wrstest, pearsonr, spearmanr
+from geodata.stats import fdr_correction, walker_test, permutation_test_2samp
 from datasets.common import data_root
 from wrfavg.wrfout_average import ldebug
 
@@ -232,6 +233,62 @@ class BaseVarTest(unittest.TestCase):
     var.data_array += 1 # test if we have a true copy and not just a reference 
     assert not isEqual(var.data_array,self.var.data_array)
     
+  def testBootstrap(self):
+    ''' test reproducible bootstrap resampling (in batches) '''
+    t = self.axes[0]
+    # same seed has to give the same result, independent of batch size
+    bsvar = self.var.fitDist(dist='norm', axis=t.name, lbootstrap=True, nbs=20, seed=42)
+    assert bsvar.shape == (20,)+self.var.shape[1:]+(2,)
+    tmp = self.var.fitDist(dist='norm', axis=t.name, lbootstrap=True, nbs=20, seed=42, bootstrap_batch=7)
+    assert isEqual(bsvar.data_array, tmp.data_array)
+    # first element is the fit to the actual sample
+    tmp = self.var.fitDist(dist='norm', axis=t.name)
+    assert isEqual(bsvar.data_array[0], tmp.data_array)
+    
+  def testFitMethods(self):
+    ''' compare vectorized L-moment/Newton estimates with scipy's MLE '''
+    t,y,x = self.axes
+    rng = np.random.RandomState(1)
+    for dist,args in (('norm',()), ('gumbel_r',()), ('genextreme',(-0.1,)), ('lognorm',(0.5,)), 
+                      ('gamma',(2.,)), ('genpareto',(0.1,))):
+      rv = getattr(ss,dist)
+      data = rv.rvs(*args, loc=10., scale=2., size=(200,)+self.size[1:], random_state=rng)
+      var = Variable(name='sample', units='n/a', axes=(Axis(name='sample', coord=np.arange(200)),y,x), data=data)
+      lmvar = var.fitDist(dist=dist, axis='sample', fit_method='lmoments')
+      nwvar = var.fitDist(dist=dist, axis='sample', fit_method='newton')
+      assert lmvar.shape == nwvar.shape == self.size[1:]+(len(args)+2,)
+      mle = np.apply_along_axis(lambda s: rv.fit(s), 0, data)
+      mle = np.rollaxis(mle, 0, mle.ndim)
+      # the Newton estimate should be at least as likely as scipy's MLE
+      loglik = lambda p: np.sum(rv.logpdf(data, *np.rollaxis(p,-1)[:-2], loc=p[...,-2], scale=p[...,-1]), axis=0)
+      assert np.all(loglik(nwvar.data_array) >= loglik(mle) - 0.05)
+      if dist in ('gamma','genpareto'):
+        # shape and location are poorly constrained (and scipy's MLE can be degenerate), so only
+        # check that the L-moment estimate reproduces the sample mean
+        lm = lmvar.data_array
+        assert np.allclose(rv.mean(*np.rollaxis(lm,-1)[:-2], loc=lm[...,-2], scale=lm[...,-1]), data.mean(axis=0))
+      else:
+        assert np.allclose(nwvar.data_array, mle, rtol=1e-2, atol=1e-2)
+        assert np.allclose(lmvar.data_array, mle, rtol=0.2, atol=0.2) # just an estimate
+    
+  def testKDE(self):
+    ''' compare array-native KDEs with scipy's gaussian_kde '''
+    t,y,x = self.axes
+    data = np.random.RandomState(1).normal(size=self.size)
+    data[:5,0,0] = np.NaN # test missing values
+    var = Variable(name='test', units='n/a', axes=self.axes, data=data)
+    kde = var.kde(axis=t.name) # array-native (default)
+    ref = var.kde(axis=t.name, lvectorize=False) # object array of gaussian_kde instances
+    assert kde.shape == self.size[1:]+(self.size[0]+1,) and ref.shape == self.size[1:]
+    support = np.linspace(-3,3,25)
+    assert np.allclose(kde.PDF(support=support, asVar=False), ref.PDF(support=support, asVar=False))
+    assert np.allclose(kde.CDF(support=support, asVar=False), ref.CDF(support=support, asVar=False))
+    assert kde.resample(N=10).shape == self.size[1:]+(10,)
+    # array-native KDEs can be pickled as plain arrays
+    import pickle
+    tmp = pickle.loads(pickle.dumps(kde.data_array, protocol=2))
+    assert np.allclose(tmp, kde.data_array, equal_nan=True)
+    
   def testDistributionVariables(self):
     ''' test DistVar instances on different data '''
     # get test objects
@@ -685,6 +742,15 @@ class BaseVarTest(unittest.TestCase):
       cvar = var.climMean(lstrict=lstrict)
       assert len(cvar.getAxis('time')) == 12
       assert cvar.shape == var.shape[:tax]+(12,)+var.shape[tax+1:]      
+      # multiple statistics in one pass
+      sset = var.seasonalStats('jj', stats=('mean','std','max'), lstrict=lstrict)
+      assert sset.hasVariable(var.name+'_std') and sset.hasAxis('year')
+      assert isEqual(sset[var.name+'_mean'].getArray(), yvar.getArray())
+      assert isEqual(sset[var.name+'_std'].getArray(), var.seasonalStd('jj', asVar=False, lstrict=lstrict))
+      assert isEqual(sset[var.name+'_max'].getArray(), var.seasonalMax('jj', asVar=False, lstrict=lstrict))
+      cdict = var.climStats(stats=('mean','var'), asVar=False, lstrict=lstrict)
+      assert isEqual(cdict['mean'], cvar.getArray())
+      assert isEqual(cdict['var'], var.climVar(asVar=False, lstrict=lstrict))
     if self.__class__ is BaseVarTest:
       # this only works with a specially prepared data field
       yfake = np.ones((var.shape[0]/12,)+var.shape[1:])
@@ -853,6 +919,70 @@ class BaseVarTest(unittest.TestCase):
     assert pvar.data_array.mean() > 0.25 # not all tests are that accurate...
     assert rvar.shape == var.shape[1:] # this will usually be close to zero, since none of these are normally distributed
     
+  def testVectorizedStatsTests(self):
+    ''' compare vectorized 2 sample tests with SciPy's implementation at every point '''
+    t,y,x = self.axes
+    rng = np.random.RandomState(1)
+    data1 = rng.normal(size=self.size); data2 = 0.5*data1 + rng.normal(size=self.size)
+    var1 = Variable(name='test1', units='n/a', axes=self.axes, data=data1)
+    var2 = Variable(name='test2', units='n/a', axes=self.axes, data=data2)
+    # reference values from SciPy (sample axis first)
+    def reference(fct, data1=data1, data2=data2, **kwargs):
+      ref = [fct(data1[:,i,j], data2[:,i,j], **kwargs) for i in xrange(len(y)) for j in xrange(len(x))]
+      return np.asarray(ref).reshape(self.size[1:]+(2,))
+    pvar = ttest(var1, var2, axis=t.name)
+    assert np.allclose(pvar.data_array, reference(ss.ttest_ind)[...,1])
+    pvar = ttest(var1, var2, axis=t.name, equal_var=False)
+    assert np.allclose(pvar.data_array, reference(ss.ttest_ind, equal_var=False)[...,1])
+    pvar = kstest(var1, var2, axis=t.name)
+    assert pvar.shape == self.size[1:] and np.all(pvar.data_array >= 0) and np.all(pvar.data_array <= 1)
+    assert np.allclose(pvar.data_array, kstest(var1, var2, axis=t.name, lvectorize=False).data_array)
+    for fct,ref in ((pearsonr,ss.pearsonr),(spearmanr,ss.spearmanr)):
+      rvar,pvar = fct(var1, var2, lpval=True, lrho=True, axis=t.name)
+      assert np.allclose(rvar.data_array, reference(ref)[...,0])
+      assert np.allclose(pvar.data_array, reference(ref)[...,1])
+    # rounded samples with many ties
+    from utils.stats import rankdata_array, ks_2samp_array
+    idata1 = np.round(data1*2.); idata2 = np.round(data2*2.)
+    ivar1 = Variable(name='test1', units='n/a', axes=self.axes, data=idata1)
+    ivar2 = Variable(name='test2', units='n/a', axes=self.axes, data=idata2)
+    ranks = np.apply_along_axis(ss.rankdata, 0, idata1)
+    assert np.allclose(rankdata_array(np.rollaxis(idata1, 0, idata1.ndim)), np.rollaxis(ranks, 0, ranks.ndim))
+    D = ks_2samp_array(np.rollaxis(idata1, 0, idata1.ndim), np.rollaxis(idata2, 0, idata2.ndim))[0]
+    assert np.allclose(D, reference(ss.ks_2samp, data1=idata1, data2=idata2)[...,0])
+    pvar = kstest(ivar1, ivar2, axis=t.name)
+    assert np.allclose(pvar.data_array, kstest(ivar1, ivar2, axis=t.name, lvectorize=False).data_array)
+    rvar,pvar = spearmanr(ivar1, ivar2, lpval=True, lrho=True, axis=t.name)
+    assert np.allclose(rvar.data_array, reference(ss.spearmanr, data1=idata1, data2=idata2)[...,0])
+    assert np.allclose(pvar.data_array, reference(ss.spearmanr, data1=idata1, data2=idata2)[...,1])
+    # vectorized and apply_along_axis versions have to give the same result (also with missing values)
+    var1.data_array[:3,0,0] = np.NaN
+    for lvectorize in (True,False):
+      rvar = pearsonr(var1, var2, axis=t.name, lvectorize=lvectorize)
+      if lvectorize: tmp = rvar.data_array.copy()
+    assert np.allclose(tmp, rvar.data_array)
+    
+  def testFieldSignificance(self):
+    ''' test multiple-testing corrections and permutation tests over a field '''
+    t,y,x = self.axes
+    rng = np.random.RandomState(1)
+    data1 = rng.normal(size=self.size); data2 = rng.normal(size=self.size)
+    data2[:,0,0] += 3. # one point with a significant difference
+    var1 = Variable(name='test1', units='n/a', axes=self.axes, data=data1)
+    var2 = Variable(name='test2', units='n/a', axes=self.axes, data=data2)
+    # Benjamini-Hochberg and Walker test
+    pvar = ttest(var1, var2, axis=t.name)
+    fdrvar = fdr_correction(pvar)
+    assert fdrvar.shape == pvar.shape and np.all(fdrvar.data_array >= pvar.data_array)
+    assert fdrvar.data_array[0,0] < 0.05
+    assert 0 <= walker_test(pvar) < 0.05
+    # permutation test (results must not depend on batch size)
+    pvar, fwvar, nullvar = permutation_test_2samp(var1, var2, stat='ttest', axis=t.name, nperm=99, seed=42)
+    assert pvar.shape == fwvar.shape == self.size[1:] and nullvar.shape == (99,)+self.size[1:]
+    assert np.all(fwvar.data_array >= pvar.data_array) and fwvar.data_array[0,0] <= 0.01 
+    tmp = permutation_test_2samp(var1, var2, stat='ttest', axis=t.name, nperm=99, seed=42, batch=10, lnull=False)[0]
+    assert isEqual(pvar.data_array, tmp.data_array)
+    
   def testUnaryArithmetic(self):
     ''' test in-place and unary arithmetic functions and ufuncs'''
     # get test objects
@@ -1505,6 +1635,23 @@ class NetCDFVarTest(BaseVarTest):
     var.load()
     assert self.size == var.shape
     assert isEqual(self.data*2+100., var.data_array)
+    
+  def testStreamReduce(self):
+    ''' test streaming of reductions from file in blocks '''
+    # get test objects
+    var = self.var # loaded variable as reference
+    ncvar = VarNC(self.ncvar, axes=self.axes) # not loaded
+    axis = var.axes[0]; blklen = len(axis)/3 # three blocks
+    memory = 2.*np.prod(ncvar.shape[1:])*ncvar.dtype.itemsize/1024.**2 # two records per block
+    # compare streamed reductions with reductions of loaded data
+    for op in (nf.nanmean, nf.nanstd, nf.nansem, nf.nanmax, np.nanmedian):
+      for mode,blk,idx in (('all',0,None),('periodic',blklen,[0,2]),('block',blklen,[1,2])):
+        ref = var.reduce(op, blklen=blk, blkidx=idx, axis=axis.name, mode=mode, asVar=False)
+        tst = ncvar.reduce(op, blklen=blk, blkidx=idx, axis=axis.name, mode=mode, asVar=False, 
+                           lstream=True, memory=memory)
+        assert ref.shape == tst.shape
+        assert isEqual(ma.masked_invalid(ref), ma.masked_invalid(tst), eps=1e-4)
+    assert not ncvar.data
   
 
 class DatasetNetCDFTest(BaseDatasetTest):  
@@ -1609,6 +1756,138 @@ class DatasetNetCDFTest(BaseDatasetTest):
     print(dataset)
     dataset.close()
 
+  def testStreamBiasCorrection(self):
+    ''' test block-wise application of a bias-correction to a NetCDF dataset '''
+    from processing.bc_methods import Delta, QuantileMapping
+    srcfile = self.folder + 'test.nc'; tgtfile = self.folder + 'test_bc.nc'
+    for filename in (srcfile,tgtfile):
+      if os.path.exists(filename): os.remove(filename)
+    # create a monthly time-series on file
+    shape = (48,4,5); nrec = np.prod(shape[1:])
+    time = Axis(name='time', units='month', coord=np.arange(shape[0]))
+    y = Axis(name='y', units='', coord=np.arange(shape[1])) 
+    x = Axis(name='x', units='', coord=np.arange(shape[2]))
+    data = rnd.rand(*shape) + 1.
+    dataset = DatasetNetCDF(filelist=[srcfile],mode='w')
+    dataset.addVariable(Variable(name='T2', units='K', axes=(time,y,x), data=data))
+    dataset.addVariable(Variable(name='precip', units='mm/day', axes=(time,y,x), data=data))
+    dataset.close()
+    dataset = DatasetNetCDF(filelist=[srcfile],mode='r')
+    # a seasonal cycle of corrections (difference and ratio)
+    BC = Delta(varlist=['T2','precip'])
+    clim = rnd.rand(*((12,)+shape[1:]))
+    BC._correction = dict(T2=clim, precip=clim+1.)
+    # stream in blocks of 5 records, so that blocks are not aligned with years
+    sink = DatasetNetCDF(filelist=[tgtfile],mode='w')
+    BC.correctNC(dataset, sink, memory=5.5*nrec*data.itemsize/1024.**2)
+    assert not dataset['T2'].data and not sink['T2'].data # nothing was loaded
+    sink.close(); dataset.close()
+    # check results
+    sink = DatasetNetCDF(filelist=[tgtfile],mode='r',load=True)
+    cycle = np.tile(clim, (shape[0]/12,1,1))
+    assert isEqual(sink['T2'].getArray(), data + cycle)
+    assert isEqual(sink['precip'].getArray(), data * (cycle+1.))
+    sink.close()
+    # detrended quantile mapping: trends are estimated from the entire time-series
+    dataset = DatasetNetCDF(filelist=[srcfile],mode='r')
+    obs = Dataset(varlist=[Variable(name='T2', units='K', axes=(time,y,x), data=data)])
+    sim = Dataset(varlist=[Variable(name='T2', units='K', axes=(time,y,x), 
+                                    data=data*2. + np.arange(shape[0]).reshape((-1,1,1))*0.1)])
+    BC = QuantileMapping(varlist=['T2'], ldetrend=True)
+    BC.train(sim, obs)
+    sink = DatasetNetCDF(filelist=[tgtfile],mode='w')
+    BC.correctNC(dataset, sink, memory=5.5*nrec*data.itemsize/1024.**2)
+    sink.close(); dataset.close()
+    sink = DatasetNetCDF(filelist=[tgtfile],mode='r',load=True)
+    dataset = DatasetNetCDF(filelist=[srcfile],mode='r',load=True)
+    assert isEqual(sink['T2'].getArray(), BC.correct(dataset)['T2'].getArray())
+    sink.close(); dataset.close()
+    
+  def testBlockCache(self):
+    ''' test the read-through block cache for VarNC slicing '''
+    from geodata.netcdf import setBlockCache, block_cache
+    filename = self.folder + 'test.nc'
+    if os.path.exists(filename): os.remove(filename)
+    # create a dataset on file with some masked values
+    shape = (30,6,7)
+    time = Axis(name='time', units='day', coord=np.arange(shape[0]))
+    y = Axis(name='y', units='', coord=np.arange(shape[1])) 
+    x = Axis(name='x', units='', coord=np.arange(shape[2]))
+    data = ma.masked_less(rnd.rand(*shape), 0.1)
+    dataset = DatasetNetCDF(filelist=[filename],mode='w')
+    dataset.addVariable(Variable(name='test', units='', axes=(time,y,x), data=data))
+    dataset.close()
+    # use small blocks, so that slices span several blocks
+    block_size = block_cache.block_size; block_cache.block_size = 4*np.prod(shape[1:])*8/1024.**2
+    try:
+      setBlockCache(memory=1, lreset=True)
+      dataset = DatasetNetCDF(filelist=[filename],mode='r')
+      var = dataset['test']
+      slices = [(slice(None),)*3, (slice(3,17),slice(None),slice(None)), (slice(2,25,3),slice(1,5),slice(None)), 
+                (7,slice(None),slice(None)), (-1,slice(None),3), (slice(5,9),2,slice(0,7,2))]
+      for slcs in slices:
+        assert isEqual(var[slcs], data[slcs], masked_equal=True)
+        assert isEqual(ma.getmaskarray(var[slcs]), ma.getmaskarray(data[slcs]))
+      stats = block_cache.stats()
+      assert stats['misses'] > 0 and stats['blocks'] > 0
+      # repeated reads are served from the cache
+      for slcs in slices: var[slcs]
+      assert block_cache.stats()['hits'] > stats['hits'] 
+      assert block_cache.stats()['misses'] == stats['misses']
+      dataset.close()
+      # blocks of a rewritten file are not served from the cache
+      os.remove(filename)
+      time = Axis(name='time', units='day', coord=np.arange(shape[0]+2))
+      data = ma.masked_less(rnd.rand(*((shape[0]+2,)+shape[1:])), 0.1)
+      dataset = DatasetNetCDF(filelist=[filename],mode='w')
+      dataset.addVariable(Variable(name='test', units='', axes=(time,y,x), data=data))
+      dataset.close()
+      dataset = DatasetNetCDF(filelist=[filename],mode='r')
+      for slcs in slices:
+        assert isEqual(dataset['test'][slcs], data[slcs], masked_equal=True)
+      dataset.close()
+    finally:
+      block_cache.block_size = block_size
+      setBlockCache(memory=0, lreset=True) # disable cache again
+    assert block_cache.nbytes == 0 and len(block_cache._blocks) == 0
+    
+  def testSliceComposition(self):
+    ''' test slices of slices, strided and list selections of VarNC instances without loading '''
+    filename = self.folder + 'test.nc'
+    if os.path.exists(filename): os.remove(filename)
+    # create a monthly time-series on file
+    shape = (48,6,7)
+    time = Axis(name='time', units='month', coord=np.arange(shape[0]))
+    y = Axis(name='y', units='', coord=np.arange(shape[1])) 
+    x = Axis(name='x', units='', coord=np.arange(shape[2]))
+    data = rnd.rand(*shape)
+    dataset = DatasetNetCDF(filelist=[filename],mode='w')
+    dataset.addVariable(Variable(name='test', units='', axes=(time,y,x), data=data))
+    dataset.close()
+    dataset = DatasetNetCDF(filelist=[filename],mode='r')
+    var = dataset['test']
+    # select a range of years, and then JJA months and a strided subset of x
+    jja = [m for m in xrange(36) if m%12 in (5,6,7)]
+    slcvar = var(time=slice(12,48))(time=jja, x=slice(1,7,2), lidx=True)
+    ref = data[12:48][jja][:,:,1:7:2]
+    assert not slcvar.data and slcvar.shape == ref.shape
+    assert isEqual(slcvar.getAxis('time').coord, np.arange(12,48)[jja])
+    assert isEqual(slcvar[:], ref)
+    assert isEqual(slcvar[1:7:2,-1,[2,0]], ref[1:7:2,-1][:,[2,0]])
+    # scalar index and a station subset (list selection)
+    ptvar = slcvar(y=2, lidx=True)
+    assert ptvar.shape == (len(jja),3) and isEqual(ptvar[:], ref[:,2,:])
+    lstvar = ptvar(x=[2,0], lidx=True)
+    assert isEqual(lstvar.getAxis('x').coord, np.asarray([5,1]))
+    assert isEqual(lstvar.load().data_array, ref[:,2,[2,0]])
+    # read sliced variable in blocks
+    blocks = [blk for i0,blk in slcvar.iterBlocks(axis='time', blksize=4)]
+    assert isEqual(np.concatenate(blocks), ref)
+    # slicing at the dataset level
+    slcds = dataset(time=slice(12,48))(time=jja, lidx=True)
+    assert isEqual(slcds['test'][:], data[12:48][jja])
+    dataset.close()
+    
   def testStringVar(self):
     ''' test behavior of string variables in a netcdf dataset '''
     filename = self.folder + 'test.nc'
@@ -61,10 +61,31 @@ class MultiProcessTest(unittest.TestCase):
       assert isZero(res.mean(axis=axis)+kw) and isZero(res.std(axis=axis)-1.)
       # final test
       assert isEqual(pres, res) 
+      # shared memory implementation (persistent pool); also for other axes and uneven chunks
+      sres = apply_along_axis(ff, axis, data, NP=2, chunksize=30, ldebug=False, laax=laax, lshared=True)
+      assert sres.dtype == pres.dtype and isEqual(sres, pres)
+      if laax:
+        sres = apply_along_axis(ff, 0, data, NP=2, chunksize=7, laax=laax, lshared=True)
+        assert sres.shape == data.shape and isEqual(sres, np.apply_along_axis(ff, 0, data))
       
     # run tests 
     run_test(test_noaax, kw=1, laax=False) # without Numpy's apply_along_axis
     run_test(test_aax, kw=1, laax=True) # Numpy's apply_along_axis
+    
+    # output dtype is not taken from the first row: integer input and results only for some rows
+    from processing.multiprocess import closeWorkerPool, test_int_fct
+    data = np.arange(3000, dtype='int32').reshape((300,10))
+    res = np.apply_along_axis(np.mean, 1, data)
+    sres = apply_along_axis(np.mean, 1, data, NP=2, chunksize=50, lshared=True)
+    assert sres.dtype == np.float64 and isEqual(sres, res)
+    data = np.arange(3000, dtype='float64').reshape((300,10))
+    sres = apply_along_axis(test_int_fct, 1, data, NP=2, chunksize=50, laax=False, lshared=True)
+    assert sres.dtype == np.float64 and isZero(sres[:50]) 
+    assert isEqual(sres[50:], data[50:].mean(axis=1)) # not truncated
+    # explicit output dtype and reduction to a scalar
+    sres = apply_along_axis(np.sum, 1, data, NP=2, chunksize=50, lshared=True, outdtype=np.float32)
+    assert sres.dtype == np.float32 and sres.shape == (300,) and isEqual(sres, data.sum(axis=1))
+    closeWorkerPool()
 
   
   def testAsyncPool(self):
@@ -78,6 +99,385 @@ class MultiProcessTest(unittest.TestCase):
     assert ec == 4
     ec = asyncPoolEC(test_func_ec, args, kwargs, NP=NP, ldebug=ldebug, ltrialnerror=False)
     assert ec == 0
+    # largest jobs first, fresh worker for each job, and per-job statistics
+    ec, stats = asyncPoolEC(test_func_ec, args, kwargs, NP=NP, ldebug=ldebug, ltrialnerror=True, 
+                            costs=[n for n, in args], maxtasksperchild=1, lstats=True)
+    assert ec == 4 and len(stats) == len(args)
+    assert [s['job'] for s in stats] == range(len(args))
+    assert sum(s['ec'] > 0 for s in stats) == ec
+    
+
+class ProcessingTest(unittest.TestCase):  
+   
+  def setUp(self):
+    ''' create some test data '''
+    self.shape = (12,10,15) # time, y, x
+    self.data = np.random.randn(*self.shape)
+    # two overlapping masks and one empty mask 
+    masks = np.zeros((3,)+self.shape[1:], dtype=np.bool)
+    masks[0,2:6,3:9] = True; masks[1,5:,:7] = True
+    self.masks = masks
+      
+  def tearDown(self):
+    ''' clean up '''
+    gc.collect()
+  
+  def testSparseShapeAverage(self):
+    ''' test vectorized shape averaging with sparse weight matrix '''    
+    from processing.process import shapeWeights, sparseShapeAverage
+    import numpy.ma as ma
+    data = self.data; masks = self.masks
+    nt,ny,nx = self.shape
+    weights = shapeWeights(masks)
+    assert weights.shape == (len(masks),ny*nx)
+    assert weights.nnz == masks.sum()
+    # simple averages
+    avg = sparseShapeAverage(weights, data.reshape((nt,ny*nx)))
+    assert avg.shape == (len(masks),nt)
+    for i in xrange(2):
+      assert isEqual(avg[i,:], data[:,masks[i,:,:]].mean(axis=1))
+    assert np.all(np.isnan(avg[2,:])) # empty shape
+    # masked values and NaN's
+    mdata = ma.masked_less(data, -1.)
+    mdata[0,3,4] = np.NaN
+    avg = sparseShapeAverage(weights, mdata.reshape((nt,ny*nx)))
+    for i in xrange(2):
+      ref = ma.masked_invalid(mdata[:,masks[i,:,:]]).mean(axis=1)
+      assert isEqual(avg[i,:], ref.filled(np.NaN))
+    # latitude metric
+    weights = shapeWeights(masks, metric=np.linspace(0.5,1.,ny))
+    avg = sparseShapeAverage(weights, data[0,:,:].flatten())
+    assert avg.shape == (len(masks),)
+    metric = np.linspace(0.5,1.,ny).reshape((ny,1)).repeat(nx,axis=1)
+    ref = ( data[0,:,:]*metric )[masks[0,:,:]].sum() / metric[masks[0,:,:]].sum()
+    assert isEqual(avg[0], ref)
+    
+  def testCycleSums(self):
+    ''' test vectorized climatology kernel with incomplete cycles and masks '''
+    from processing.process import cycleSums
+    import numpy.ma as ma
+    data = np.random.randn(*((40,)+self.shape[1:])) # 3 years and 4 month
+    data = ma.masked_less(data, -2.)
+    sums, cnt, valid = cycleSums(data.swapaxes(0,1), interval=12, axis=1, lvalid=True)
+    sums = sums.swapaxes(0,1); valid = valid.swapaxes(0,1)
+    assert sums.shape == (12,)+self.shape[1:]
+    assert np.all(cnt[:4] == 4) and np.all(cnt[4:] == 3)
+    for m in xrange(12):
+      assert isEqual(sums.data[m,:], data[m::12,:].filled(0).sum(axis=0))
+      assert np.all(sums.mask[m,:] == data.mask[m::12,:].any(axis=0))
+      assert np.all(valid[m,:] == (~data.mask[m::12,:]).sum(axis=0))
+    
+  def testConcurrentProcessing(self):
+    ''' compare serial and concurrent processing of variables (climatology with valid record counts) '''
+    import tempfile, shutil
+    import numpy.ma as ma
+    from geodata.netcdf import DatasetNetCDF
+    from geodata.gdal import addGDALtoDataset
+    from processing.process import CentralProcessingUnit
+    folder = tempfile.mkdtemp()
+    try:
+      # create a source file with monthly data on a lat/lon grid
+      ncfile = folder + '/source.nc'; nt = 36; ny,nx = self.shape[1:]
+      time = Axis(name='time', units='month', coord=np.arange(nt))
+      lat = Axis(name='lat', units='deg N', coord=np.linspace(40.,50.,ny))
+      lon = Axis(name='lon', units='deg E', coord=np.linspace(-80.,-70.,nx))
+      source = DatasetNetCDF(filelist=[ncfile], mode='w')
+      varlist = ['var{:d}'.format(i) for i in xrange(5)]
+      for varname in varlist:
+        data = ma.masked_less(np.random.randn(nt,ny,nx), -1.)
+        source.addVariable(Variable(name=varname, units='', axes=(time,lat,lon), data=data))
+      source.close()
+      # process serially and with process and thread pools
+      results = dict()
+      for executor in (None,'process','thread'):
+        source = addGDALtoDataset(DatasetNetCDF(filelist=[ncfile], mode='r'))
+        CPU = CentralProcessingUnit(source, varlist=varlist, tmp=True, feedback=False)
+        CPU.Climatology(period=3, offset=0, lcount=True, executor=executor, NP=2)
+        results[executor] = CPU.target # temporary dataset
+        assert isEqual(source['var0'][:], source['var0'][:]) # source is still accessible
+        source.close()
+      serial = results[None]
+      for executor in ('process','thread'):
+        dataset = results[executor]
+        assert set(dataset.variables.keys()) == set(serial.variables.keys())
+        for varname in varlist:
+          assert dataset[varname+'_cnt'].units == '#'
+          assert isEqual(dataset[varname+'_cnt'][:], serial[varname+'_cnt'][:])
+          assert isEqual(dataset[varname][:], serial[varname][:], masked_equal=True)
+          assert dataset[varname].gdal == serial[varname].gdal == True
+    finally: shutil.rmtree(folder)
+    
+  def testStreamClimatology(self):
+    ''' compare climatologies streamed from file with loaded data (strided slices are always loaded) '''
+    import tempfile, shutil
+    from geodata.netcdf import DatasetNetCDF
+    from processing.process import CentralProcessingUnit
+    folder = tempfile.mkdtemp()
+    try:
+      ncfile = folder + '/source.nc'; nt = 48; ny,nx = self.shape[1:]
+      time = Axis(name='time', units='month', coord=np.arange(nt))
+      lat = Axis(name='lat', units='deg N', coord=np.linspace(40.,50.,ny))
+      lon = Axis(name='lon', units='deg E', coord=np.linspace(-80.,-70.,nx))
+      data = np.random.randn(nt,ny,nx)
+      source = DatasetNetCDF(filelist=[ncfile], mode='w')
+      source.addVariable(Variable(name='test', units='', axes=(time,lat,lon), data=data))
+      source.close()
+      source = DatasetNetCDF(filelist=[ncfile], mode='r')
+      CPU = CentralProcessingUnit(source, varlist=['test'], tmp=True, feedback=False)
+      climAxis = Axis(name='time', units='month', coord=np.arange(1,13))
+      memory = 2.5*12*ny*nx*data.itemsize/1024.**2 # smaller than the variable
+      for timeSlice in (slice(12,48), slice(0,48,2)):
+        assert not source['test'].data and source['test'].checkStream(memory=memory)
+        clim = CPU.processClimatology(source['test'], climAxis=climAxis, timeSlice=timeSlice, memory=memory)
+        assert not source['test'].data or timeSlice.step is not None # streamed, not loaded
+        tsdata = data[timeSlice]; ref = np.stack([tsdata[m::12].mean(axis=0) for m in xrange(12)])
+        assert isEqual(clim.getArray(), ref)
+        source['test'].unload()
+      source.close()
+    finally: shutil.rmtree(folder)
+    
+  def testRegridWeights(self):
+    ''' test regridding with precomputed sparse weights '''
+    from geodata.gdal import GridDefinition, getRegridWeights, regrid_methods
+    from processing.process import sparseShapeAverage
+    src = GridDefinition(name='src', geotransform=(0.,1.,0.,-90.,0.,1.), size=(360,180))
+    tgt = GridDefinition(name='tgt', geotransform=(-180.,2.5,0.,-90.,0.,2.5), size=(144,72))
+    data = np.sin(np.deg2rad(src.lon2D)) * np.cos(np.deg2rad(src.lat2D)) # smooth global field
+    ref = np.sin(np.deg2rad(tgt.lon2D)) * np.cos(np.deg2rad(tgt.lat2D))
+    for interp,eps in zip(regrid_methods,(1e-2,1e-3,1e-2)):
+      weights = getRegridWeights(src, tgt, interpolation=interp, lcache=False)
+      assert weights.shape == (144*72,360*180)
+      tgtdata = sparseShapeAverage(weights, data.flatten()).reshape((72,144))
+      assert np.all(np.abs(tgtdata - ref) < eps), interp
+    # identity
+    weights = getRegridWeights(src, src, interpolation='bilinear', lcache=False)
+    assert weights.nnz == 360*180 and isEqual(weights.diagonal(), np.ones(360*180))
+    # file cache: hits, and bad files are treated as misses
+    import tempfile, shutil
+    from geodata.gdal import regrid_cache, clearRegridCache
+    folder = tempfile.mkdtemp()
+    try:
+      clearRegridCache()
+      weights = getRegridWeights(src, tgt, interpolation='average', cache_folder=folder)
+      cachefiles = os.listdir(folder)
+      assert len(cachefiles) == 1 and cachefiles[0].endswith('.npz') and len(regrid_cache) == 1
+      clearRegridCache() # load from file
+      cached = getRegridWeights(src, tgt, interpolation='average', cache_folder=folder)
+      assert cached.shape == weights.shape and (cached != weights).nnz == 0
+      clearRegridCache() # truncated file is recomputed and replaced
+      with open(os.path.join(folder,cachefiles[0]), 'wb') as filehandle: filehandle.write('PK\x03\x04')
+      cached = getRegridWeights(src, tgt, interpolation='average', cache_folder=folder)
+      assert (cached != weights).nnz == 0 and os.listdir(folder) == cachefiles
+      clearRegridCache()
+      cached = getRegridWeights(src, tgt, interpolation='average', cache_folder=folder)
+      assert (cached != weights).nnz == 0
+    finally: 
+      clearRegridCache(); shutil.rmtree(folder)
+    
+  def testJobCost(self):
+    ''' test job cost estimates from source file sizes (without loading any datasets) '''
+    import tempfile, shutil
+    import datasets.CRU as CRU
+    from datasets.common import getFileName
+    from processing.misc import getJobCost
+    folder = tempfile.mkdtemp(); avgfolder = CRU.avgfolder
+    try:
+      CRU.avgfolder = folder
+      dataargs = dict(resolution=None, grid=None, period=(1979,1994), varlist=None)
+      assert getJobCost('CRU', 'climatology', dataargs) == 0 # missing file
+      filename = getFileName(grid=None, period=(1979,1994), name='CRU', filetype='climatology')
+      with open(os.path.join(folder,filename), 'wb') as filehandle: filehandle.write('0'*1000)
+      assert getJobCost('CRU', 'climatology', dataargs) == 1000
+      assert getJobCost('CRU', 'annual-mean', dataargs) == 1000 # same source file as climatology
+      assert getJobCost('CRU', 'time-series', dataargs) == 0
+      assert getJobCost('NoDataset', 'climatology', dataargs) == 0 # errors are reported later
+      assert dataargs == dict(resolution=None, grid=None, period=(1979,1994), varlist=None) # not modified
+    finally: 
+      CRU.avgfolder = avgfolder; shutil.rmtree(folder)
+    
+  def testShapeMaskCache(self):
+    ''' test rasterization of shapes with supersampling and the mask cache (hits, misses and bad files) '''
+    import tempfile, shutil
+    from osgeo import ogr, osr
+    from geodata.gdal import GridDefinition, Shape, mask_cache, clearMaskCache
+    folder = tempfile.mkdtemp()
+    try:
+      # create a rectangular shape in a shapefile
+      shapefile = folder + '/rect.shp'
+      srs = osr.SpatialReference(); srs.SetWellKnownGeogCS('WGS84')
+      shpds = ogr.GetDriverByName('ESRI Shapefile').CreateDataSource(shapefile)
+      layer = shpds.CreateLayer('rect', srs, ogr.wkbPolygon)
+      feature = ogr.Feature(layer.GetLayerDefn())
+      feature.SetGeometry(ogr.CreateGeometryFromWkt('POLYGON ((2.5 1,6.5 1,6.5 4,2.5 4,2.5 1))'))
+      layer.CreateFeature(feature); feature = None; shpds = None # close file
+      shape = Shape(shapefile=shapefile)
+      griddef = GridDefinition(name='test', geotransform=(0.,1.,0.,0.,0.,1.), size=(10,8))
+      # fractional coverage with supersampling 
+      ref = np.zeros((8,10)); ref[1:4,3:6] = 1.; ref[1:4,2] = ref[1:4,6] = 0.5
+      clearMaskCache()
+      frac = shape.rasterize(griddef=griddef, supersample=2, cache_folder=folder)
+      assert frac.dtype == np.float32 and isEqual(frac, ref.astype(np.float32))
+      mask = shape.rasterize(griddef=griddef, cache_folder=folder)
+      assert mask.dtype == np.bool and np.all(mask == (ref > 0.5))
+      cachefiles = [f for f in os.listdir(folder) if f.endswith('.npz')]
+      assert len(cachefiles) == 2 and len(mask_cache) == 2
+      # modifying returned arrays does not affect the cache
+      mask[:] = True; shape.getCoverage(griddef=griddef, supersample=2, cache_folder=folder)[:] = 0
+      assert isEqual(shape.rasterize(griddef=griddef, supersample=2, cache_folder=folder), frac)
+      assert np.all(shape.rasterize(griddef=griddef, cache_folder=folder) == (ref > 0.5))
+      # cache hits (memory and file) don't rasterize again
+      burnCoverage = shape.burnCoverage
+      def noBurn(**kwargs): raise AssertionError('cache miss')
+      shape.burnCoverage = noBurn
+      assert isEqual(shape.rasterize(griddef=griddef, supersample=2, cache_folder=folder), frac)
+      clearMaskCache()
+      assert isEqual(shape.rasterize(griddef=griddef, supersample=2, cache_folder=folder), frac)
+      # a truncated file is a cache miss and is replaced
+      shape.burnCoverage = burnCoverage
+      for cachefile in cachefiles: 
+        with open(folder+'/'+cachefile, 'wb') as f: f.write('PK\x03\x04')
+      clearMaskCache()
+      assert isEqual(shape.rasterize(griddef=griddef, supersample=2, cache_folder=folder), frac)
+      shape.burnCoverage = noBurn; clearMaskCache()
+      assert isEqual(shape.rasterize(griddef=griddef, supersample=2, cache_folder=folder), frac)
+      # a modified shapefile is a cache miss
+      shape.burnCoverage = burnCoverage
+      os.utime(shapefile, (os.path.getatime(shapefile), os.path.getmtime(shapefile)+10))
+      assert isEqual(shape.rasterize(griddef=griddef, supersample=2, cache_folder=folder), frac)
+      assert len([f for f in os.listdir(folder) if f.endswith('.npz')]) == 3
+      assert not any(f.endswith('.tmp') for f in os.listdir(folder)) # no temporary files left
+    finally: 
+      clearMaskCache(); shutil.rmtree(folder)
+    
+  def testStationIndices(self):
+    ''' test vectorized station index search against Axis.getIndex '''
+    from geodata.base import Axis
+    from processing.process import stationIndices
+    nt,ny,nx = self.shape
+    xlon = Axis(name='lon', units='deg E', coord=np.linspace(-100.,-50.,nx))
+    ylat = Axis(name='lat', units='deg N', coord=np.linspace(60.,40.,ny)) # descending
+    lons = np.random.uniform(-110.,-40.,200); lats = np.random.uniform(35.,65.,200)
+    zs = np.random.uniform(0.,1000.,(ny,nx)); stn_zs = np.random.uniform(0.,1000.,200)
+    # horizontally closest point
+    ixlon, iylat, istn, zs_err = stationIndices(lons, lats, xlon=xlon, ylat=ylat, laltcorr=False)
+    assert len(zs_err) == 0 and len(istn) == len(ixlon) == len(iylat) > 0
+    for i,j,n in zip(ixlon,iylat,istn):
+      assert i == xlon.getIndex(lons[n], mode='closest', outOfBounds=True)
+      assert j == ylat.getIndex(lats[n], mode='closest', outOfBounds=True)
+    # smallest elevation error among surrounding points
+    ixlon, iylat, istn, zs_err = stationIndices(lons, lats, xlon=xlon, ylat=ylat, zs=zs, stn_zs=stn_zs)
+    for i,j,n,ze in zip(ixlon,iylat,istn,zs_err):
+      ip = xlon.getIndex(lons[n], mode='left', outOfBounds=True); jp = ylat.getIndex(lats[n], mode='left', outOfBounds=True)
+      zerr = [zs[jj,ii]-stn_zs[n] for ii in (max(ip-1,0),ip) for jj in (max(jp-1,0),jp)]
+      assert ze == zs[j,i]-stn_zs[n] and np.abs(ze) == np.min(np.abs(zerr))
+    
+  def testStationWeights(self):
+    ''' test bilinear and inverse-distance interpolation weights for station extraction '''
+    from geodata.base import Axis
+    from processing.process import stationWeights, sparseShapeAverage
+    nt,ny,nx = self.shape
+    xlon = Axis(name='lon', units='deg E', coord=np.linspace(-100.,-50.,nx))
+    ylat = Axis(name='lat', units='deg N', coord=np.linspace(60.,40.,ny)) # descending
+    lons = np.random.uniform(-100.,-50.,50); lats = np.random.uniform(40.,60.,50)
+    field = 2.*xlon.coord.reshape((1,nx)) + 3.*ylat.coord.reshape((ny,1)) # linear field
+    # bilinear interpolation is exact for linear fields
+    weights = stationWeights(lons, lats, xlon=xlon, ylat=ylat, interpolation='bilinear')
+    assert weights.shape == (50,ny*nx) and np.diff(weights.indptr).max() <= 4
+    assert isEqual(sparseShapeAverage(weights, field.flatten()), 2.*lons+3.*lats)
+    # inverse distance weighting: stations on grid points only use that point
+    lons[0] = xlon.coord[3]; lats[0] = ylat.coord[4]
+    weights = stationWeights(lons, lats, xlon=xlon, ylat=ylat, interpolation='idw', nidw=4, lgeographic=True)
+    assert weights[0,:].nnz == 1 and np.all(np.diff(weights.indptr)[1:] == 4)
+    stndata = sparseShapeAverage(weights, field.flatten())
+    assert stndata[0] == field[4,3]
+    assert np.all(stndata >= field.min()) and np.all(stndata <= field.max())
+    
+  def testNanStats(self):
+    ''' test single-pass, block-wise NaN-aware statistics against Numpy '''
+    import utils.nanfunctions as nf
+    import numpy.ma as ma
+    data = self.data.astype(np.float32); data[:4,0,0] = np.NaN; data[:,1,1] = np.NaN
+    for axis in (None,0,2):
+      for keepdims in (False,True):
+        stats = nf.nanstats(data, axis=axis, stats=('count','mean','var','std','max'), ddof=1, 
+                            keepdims=keepdims, blocksize=5)
+        assert np.all(stats['count'] == np.sum(np.isfinite(data), axis=axis, keepdims=keepdims))
+        for stat,ref in (('mean',np.nanmean),('var',np.nanvar),('std',np.nanstd),('max',np.nanmax)):
+          kwargs = dict(ddof=1) if stat in ('var','std') else dict()
+          refdata = ref(data.astype(np.float64), axis=axis, keepdims=keepdims, **kwargs)
+          assert stats[stat].dtype == np.float32 and np.shape(stats[stat]) == np.shape(refdata)
+          assert np.allclose(stats[stat], refdata, rtol=1e-5, equal_nan=True)
+        assert np.allclose(nf.nanvar(data, axis=axis, ddof=1, keepdims=keepdims), stats['var'], equal_nan=True)
+    # masked arrays
+    mdata = ma.masked_invalid(data)
+    mean = nf.nanmean(mdata, axis=0)
+    assert isinstance(mean, ma.MaskedArray) and mean.mask[1,1] and not mean.mask[0,0]
+    assert np.allclose(mean.filled(0), np.nan_to_num(np.nanmean(data, axis=0)), rtol=1e-5)
+    
+  def testQuantileMapping(self):
+    ''' test vectorized quantile mapping bias-correction '''
+    from processing.bc_methods import QuantileMapping, mapQuantiles
+    # interpolation in quantile tables (compare to Numpy)
+    qsrc = np.sort(np.random.randn(21,5), axis=0); qtgt = np.sort(np.random.randn(21,5), axis=0)*2.+1.
+    x = np.random.randn(30,5)*0.5
+    xbc = mapQuantiles(x, qsrc, qtgt)
+    for i in xrange(5):
+      lin = ( x[:,i] >= qsrc[0,i] ) & ( x[:,i] <= qsrc[-1,i] )
+      assert np.allclose(xbc[lin,i], np.interp(x[lin,i], qsrc[:,i], qtgt[:,i]))
+    # tied quantiles (e.g. zero precipitation) are mapped to the middle of the tie range
+    qsrc = np.sort(np.random.gamma(1., size=(101,3)), axis=0); qtgt = np.sort(np.random.gamma(1., size=(101,3)), axis=0)
+    qsrc[:31,0] = 0.; qtgt[:21,0] = 0. # fewer dry days in target
+    qsrc[:61,1] = 0.; qtgt[:21,1] = 0. # more dry days in source
+    qsrc[50:60,2] = qsrc[50,2] # interior tie
+    x = np.asarray([[0.,0.,qsrc[50,2]],[np.NaN,0.,0.]])
+    xbc = mapQuantiles(x, qsrc, qtgt, lratio=True)
+    assert xbc[0,0] == 0. and xbc[0,1] == qtgt[30,1] and xbc[1,1] == qtgt[30,1]
+    assert np.isclose(xbc[0,2], (qtgt[54,2]+qtgt[55,2])/2.) and xbc[1,2] == 0. # extrapolated ratio
+    assert np.isnan(xbc[1,0])
+    # a linear bias is removed exactly, with a monthly time axis in any position
+    time = Axis(name='time', units='month', coord=np.arange(120))
+    y = Axis(name='y', units='', coord=np.arange(4)); x = Axis(name='x', units='', coord=np.arange(5))
+    obsdata = np.random.randn(4,120,5)
+    obs = Dataset(varlist=[Variable(name='T2', units='K', axes=(y,time,x), data=obsdata)])
+    sim = Dataset(varlist=[Variable(name='T2', units='K', axes=(y,time,x), data=obsdata*2.+1.)])
+    for bcargs in (dict(), dict(lmonthly=False), dict(lparametric=True)):
+      BC = QuantileMapping(varlist=['T2'], **bcargs)
+      BC.train(sim, obs)
+      assert BC._correction['T2'].shape == (2,12 if BC.lmonthly else 1,101,4,5)
+      assert BC._correction['T2'].dtype == np.float32
+      bcdata = BC.correct(sim)['T2'].getArray()
+      assert bcdata.shape == obsdata.shape 
+      assert isEqual(bcdata, obsdata, eps=1e-4)
+    
+  def testBiasCorrectionFiles(self):
+    ''' test compact storage of bias-correction parameters and loading of old pickles '''
+    from processing.bc_methods import Delta, QuantileMapping, loadBiasCorrection, CorrectionFile
+    import tempfile, shutil, gzip, pickle
+    time = Axis(name='time', units='month', coord=np.arange(24))
+    y = Axis(name='y', units='', coord=np.arange(4)); x = Axis(name='x', units='', coord=np.arange(5))
+    obsdata = np.random.randn(24,4,5)
+    obs = Dataset(varlist=[Variable(name='T2', units='K', axes=(time,y,x), data=obsdata),
+                           Variable(name='Ts', units='K', axes=(time,y,x), data=obsdata)])
+    sim = Dataset(varlist=[Variable(name='T2', units='K', axes=(time,y,x), data=obsdata*2.+1.),
+                           Variable(name='Ts', units='K', axes=(time,y,x), data=obsdata)])
+    folder = tempfile.mkdtemp()
+    try:
+      for BC in (Delta(), QuantileMapping(ldetrend=True)):
+        BC.train(sim, obs)
+        assert BC._correction['Ts'] is None # identical
+        bcdata = BC.correct(sim)['T2'].getArray()
+        for ext in ('.nc','.npz'):
+          filepath = BC.save(os.path.join(folder,'bias_test'+ext))
+          newbc = loadBiasCorrection(filepath)
+          assert newbc.__class__ is BC.__class__ and newbc.name == BC.name
+          assert isinstance(newbc._correction, CorrectionFile) and len(newbc._correction._cache) == 0
+          assert isEqual(newbc.correct(sim, varlist=['T2'])['T2'].getArray(), bcdata)
+          assert newbc._correction.keys() == ['T2','Ts'] and newbc._correction['Ts'] is None
+        # backwards-compatibility with pickles
+        picklepath = os.path.join(folder,'bias_test.pickle.gz')
+        with gzip.open(picklepath, 'wb') as filehandle: pickle.dump(BC, filehandle, protocol=-1)
+        assert isEqual(loadBiasCorrection(picklepath).correct(sim)['T2'].getArray(), bcdata)
+    finally: shutil.rmtree(folder)
     
 
   
@@ -300,6 +700,180 @@ class DatasetsTest(unittest.TestCase):
 #     gevens = [ens.fitDist(lflatten=True, axis=None) for ens in enslst]
 #     print(''); print(gevens[0][0])
 
+  def testMonthlyExtremes(self):
+    ''' test batched computation of monthly extremes against a simple loop over months and days '''
+    from datasets.common import monthLengths, monthlyExtremes, extremesKernel
+    from geodata.misc import ArgumentError
+    ns = 5; coord = np.arange(11,11+14) # Dec 1979 - Jan 1981, including a leap year
+    lengths = monthLengths(coord, year0=1979)
+    assert lengths[0] == 31 and lengths[2] == 29 and lengths.sum() == 31+366+31
+    data = np.random.uniform(-5, 5, size=(ns,len(coord),31)) 
+    for m,lmon in enumerate(lengths): data[:,m,lmon:] = np.NaN # padding
+    data[0,:,:][np.random.uniform(size=data.shape[1:]) < 0.2] = np.NaN # random missing values
+    data[1,3,:] = np.NaN # all-NaN month
+    data[2,4:6,:] = np.NaN # two all-NaN months
+    # reference: loop over months and days of the continuous series (runs and intervals cross months)
+    def reference(kernel, mode, interval=None, threshold=None):
+      ref = np.empty((ns,len(coord))); ref.fill(np.NaN)
+      fct = np.nanmin if mode == 'min' else np.nanmax # longest runs
+      for s in xrange(ns):
+        series = np.concatenate([data[s,m,:lmon] for m,lmon in enumerate(lengths)])
+        run = 0; d = 0
+        for m,lmon in enumerate(lengths):
+          values = []
+          for day in xrange(d,d+lmon):
+            if kernel == 'extrema': values.append(series[day])
+            elif kernel == 'runmean': 
+              values.append(series[day-interval+1:day+1].mean() if day >= interval-1 else np.NaN)
+            elif kernel == 'consecutive':
+              levent = series[day] > threshold if mode == 'above' else series[day] < threshold
+              run = run + 1 if levent else 0 # NaN interrupts runs
+              values.append(run if not np.isnan(series[day]) else np.NaN)
+          d += lmon
+          if not np.all(np.isnan(values)): ref[s,m] = fct(values)
+      return ref
+    def check(res, ref): 
+      assert res.shape == ref.shape and np.all(np.isnan(res) == np.isnan(ref)), (res, ref)
+      assert isEqual(res[~np.isnan(ref)], ref[~np.isnan(ref)]) 
+    for mode in ('max','min'):
+      check(monthlyExtremes(data, lengths, kernel='extrema', mode=mode), reference('extrema', mode))
+      check(monthlyExtremes(data, lengths, kernel='runmean', mode=mode, interval=5), 
+            reference('runmean', mode, interval=5))
+    for mode in ('above','below'):
+      check(monthlyExtremes(data, lengths, kernel='consecutive', mode=mode, threshold=1.), 
+            reference('consecutive', mode, threshold=1.))
+    # all-NaN months are NaN for all kernels
+    for kernel,mode in (('extrema','max'),('runmean','max'),('consecutive','above')):
+      res = monthlyExtremes(data, lengths, kernel=kernel, mode=mode, interval=3, threshold=0.)
+      assert np.isnan(res[1,3]) and np.all(np.isnan(res[2,4:6])) and not np.isnan(res[3,3])
+    # parameters are required (and taken from the class defaults)
+    self.assertRaises(ArgumentError, monthlyExtremes, data, lengths, kernel='runmean', mode='max')
+    class TestExtrema(object):
+      def __init__(self, var, mode, interval=7, threshold=0, name=None): pass
+    assert extremesKernel(TestExtrema, 'runmean', 'max') == dict(kernel='runmean', mode='max', interval=7)
+    assert extremesKernel(TestExtrema, 'consecutive', 'below', threshold=273.15) == dict(kernel='consecutive', 
+                                                                                         mode='below', threshold=273.15)
+    class TestNoDefaults(object):
+      def __init__(self, var, mode, **kwargs): pass
+    assert extremesKernel(TestNoDefaults, 'runmean', 'max') is None
+    assert extremesKernel(TestNoDefaults, 'extrema', 'max') == dict(kernel='extrema', mode='max')
+
+  def testRecordCache(self):
+    ''' test the binary cache of parsed station records: hits and invalidation (size, mtime and checksum) '''
+    import tempfile, shutil
+    from datasets.common import getRecordCacheFile, checkRecordCache, refreshRecordCache
+    from datasets.common import loadRecordCache, saveRecordCache
+    folder = tempfile.mkdtemp()
+    try:
+      filename = os.path.join(folder,'dt0000001.txt')
+      with open(filename, 'w') as f: f.write('0123456789\n'*10)
+      cachefile = getRecordCacheFile(filename, 'daily precip', folder)
+      assert cachefile == os.path.join(folder,'dt0000001_daily_precip')
+      assert not checkRecordCache(filename, cachefile) and loadRecordCache(filename, cachefile) == (None, None)
+      data = np.arange(31, dtype='float32')
+      saveRecordCache(filename, cachefile, data, begin_year=1990, begin_mon=11)
+      assert not any(f.endswith('.tmp') for f in os.listdir(folder)) # no temporary files left behind
+      assert checkRecordCache(filename, cachefile)
+      cache, atts = loadRecordCache(filename, cachefile, lmmap=True)
+      assert isEqual(cache, data) and atts == dict(begin_year=1990, begin_mon=11)
+      # touched, but not changed: still valid (checksum), and the check doesn't write
+      metafile = cachefile+'_meta.npz'; metatime = os.stat(metafile).st_mtime
+      stat = os.stat(filename); os.utime(filename, (stat.st_atime, stat.st_mtime+10))
+      assert checkRecordCache(filename, cachefile) and os.stat(metafile).st_mtime == metatime
+      with np.load(metafile) as npz: assert npz['mtime'] == stat.st_mtime
+      assert refreshRecordCache(filename, cachefile) # store new modification time
+      with np.load(metafile) as npz: assert npz['mtime'] == stat.st_mtime+10
+      # same size and modification time, but different content: still valid (checksum is not computed)
+      with open(filename, 'w') as f: f.write('9876543210\n'*10)
+      os.utime(filename, (stat.st_atime, stat.st_mtime+10))
+      assert checkRecordCache(filename, cachefile)
+      # same size, but different modification time and content: checksum
+      os.utime(filename, (stat.st_atime, stat.st_mtime+20))
+      assert not checkRecordCache(filename, cachefile) and not refreshRecordCache(filename, cachefile)
+      assert loadRecordCache(filename, cachefile) == (None, None)
+      # different size
+      saveRecordCache(filename, cachefile, data)
+      assert checkRecordCache(filename, cachefile)
+      with open(filename, 'a') as f: f.write('0')
+      os.utime(filename, (stat.st_atime, stat.st_mtime+20)) # same modification time
+      assert not checkRecordCache(filename, cachefile)
+      # corrupted or missing cache files are a cache miss
+      saveRecordCache(filename, cachefile, data)
+      with open(metafile, 'wb') as f: f.write('PK\x03\x04')
+      assert not checkRecordCache(filename, cachefile) and loadRecordCache(filename, cachefile) == (None, None)
+      saveRecordCache(filename, cachefile, data); os.remove(cachefile+'.npy')
+      assert not checkRecordCache(filename, cachefile)
+    finally:
+      shutil.rmtree(folder)
+
+  def testStationParsers(self):
+    ''' test vectorized station record parsers against the line-by-line parsers, and parallel parsing '''
+    import tempfile, shutil, codecs, warnings
+    import datasets.EC as EC
+    import datasets.GHCN as GHCN
+    from utils.parallel import shared_fill_rows, closeWorkerPool
+    folder = tempfile.mkdtemp()
+    try:
+      ## EC temperature file: three months with data flags, missing values and a value out of bounds 
+      ecvar = EC.TempDef(name='maximum temperature', prefix='dx', atts=EC.varatts['Tmax'])
+      values = np.around(np.random.uniform(-30, 30, size=(3,31)), decimals=1)
+      strings = [['{:.1f}'.format(v) for v in row] for row in values]
+      strings[0][3] += 'E'; strings[1][7] += 'a' # data flags
+      strings[0][30] = strings[2][5] = '-9999.9M'; strings[1][10] = '-9999.9' # missing values
+      strings[2][20] = '150.0' # out of bounds
+      lines = [u'0000001, TEST STATION, ON, Not Joined, Daily Maximum Temperature, Deg C']
+      lines += [u'Year Mo ' + ' '.join('Day{:02d}'.format(d+1) for d in xrange(31))]
+      for (year,mon),row in zip(((1990,11),(1990,12),(1991,1)),strings):
+        lines.append(u'{:4d} {:2d}'.format(year,mon) + ''.join('{:>8s}'.format(s) for s in row))
+      filename = os.path.join(folder,'dx0000001.txt')
+      with codecs.open(filename, 'w', encoding=ecvar.encoding) as f: f.write('\n'.join(lines)+'\n')
+      ecstn = EC.DailyStationRecord(id='0000001', name='TEST STATION', filename=filename, prov='ON', joined=False, 
+                                    begin_year=1990, begin_mon=11, end_year=1991, end_mon=1, lat=45., lon=-80., 
+                                    alt=100., **ecvar.getKWargs())
+      ecstn.checkHeader()
+      with warnings.catch_warnings():
+        warnings.simplefilter('ignore') # out of bounds values
+        loop = ecstn.parseRecord(lvectorize=False)
+        data, flags = ecstn.parseRecord(lvectorize=True, lflags=True)
+      assert data.shape == (3*31,) and data.dtype == loop.dtype
+      ref = values.ravel().astype(ecvar.dtype); ref[[30,31+10,62+5,62+20]] = np.NaN
+      assert np.all(np.isnan(loop) == np.isnan(ref)) and isEqual(loop[~np.isnan(ref)], ref[~np.isnan(ref)])
+      assert np.all(np.isnan(data) == np.isnan(loop)) and isEqual(data[~np.isnan(data)], loop[~np.isnan(loop)])
+      assert flags[3] == 'E' and flags[31+7] == 'a' and flags[30] == 'M' and flags[0] == ''
+      ## GHCN file: fixed-width records with other variables and flags
+      ghvar = GHCN.PrecipDef(name='PRCP', atts=GHCN.varatts['precip'])
+      values = np.random.randint(0, 500, size=(3,31))
+      lines = []
+      for (year,mon),row in zip(((1990,11),(1990,12),(1991,1)),values):
+        for var in ('TMAX','PRCP'):
+          fields = ['{:5d} a '.format(v) for v in row]
+          if var == 'PRCP': fields[2] = '-9999   '; fields[4] = '{:5d}T 0'.format(row[4])
+          lines.append('TEST0000001{:4d}{:02d}{:s}'.format(year,mon,var) + ''.join(fields))
+      assert all(len(line) == GHCN.linelen for line in lines)
+      filename = os.path.join(folder,'TEST0000001.dly')
+      with open(filename, 'w') as f: f.write('\n'.join(lines)+'\n')
+      ghstn = GHCN.DailyStationRecord(id='TEST0000001', name='TEST STATION', filename=filename, begin_year=1990, 
+                                      begin_mon=11, end_year=1991, end_mon=1, lat=45., lon=-80., alt=100., 
+                                      **ghvar.getKWargs())
+      ghstn.checkHeader()
+      loop = ghstn.parseRecord(lvectorize=False)
+      data, flags = ghstn.parseRecord(lvectorize=True, lflags=True)
+      ref = values.ravel().astype(ghvar.dtype); ref[[2,31+2,62+2]] = np.NaN
+      assert data.shape == loop.shape == (3*31,)
+      assert np.all(np.isnan(loop) == np.isnan(ref)) and isEqual(loop[~np.isnan(ref)], ref[~np.isnan(ref)])
+      assert np.all(np.isnan(data) == np.isnan(loop)) and isEqual(data[~np.isnan(data)], loop[~np.isnan(loop)])
+      assert flags[0] == ' a ' and flags[4] == 'T 0'
+      ## parse in parallel into a shared array (records with different begin and end dates)
+      bounds = [(0,3*31), (31,4*31)]; shape = (2,4,31)
+      shared = shared_fill_rows(EC.parseStationRecord, [(ecstn,),(ecstn,)], bounds, shape, 'float32', 
+                                fillValue=np.NaN, NP=2, kwargs=dict(lvectorize=True))
+      serial = np.empty((2,4*31), dtype='float32'); serial.fill(np.NaN)
+      for s,(i0,i1) in enumerate(bounds): serial[s,i0:i1] = EC.parseStationRecord(ecstn, lvectorize=True)
+      assert np.all(np.isnan(shared.ravel()) == np.isnan(serial.ravel()))
+      assert isEqual(shared.ravel()[~np.isnan(serial.ravel())], serial[~np.isnan(serial)])
+    finally:
+      closeWorkerPool(); shutil.rmtree(folder)
+
   def testLoadStandardDeviation(self):
     ''' test station data load functions (ensemble and list) '''
     from datasets.common import loadEnsembleTS
@@ -320,6 +894,7 @@ if __name__ == "__main__":
     specific_tests = []
 #     specific_tests += ['ApplyAlongAxis']
 #     specific_tests += ['AsyncPool']    
+#     specific_tests += ['SparseShapeAverage']
 #     specific_tests += ['ExpArgList']
 #     specific_tests += ['LoadDataset']
 #     specific_tests += ['BasicLoadEnsembleTS']
@@ -331,6 +906,7 @@ if __name__ == "__main__":
     tests = [] 
     # list of variable tests
     tests += ['MultiProcess']
+#     tests += ['Processing']
 #     tests += ['Datasets'] 
     
 
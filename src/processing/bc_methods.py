@@ -10,14 +10,25 @@ definition in a separate module, so it can be pickled and imported in other modu
 # external imports
 import collections as col
 import numpy as np
+import netCDF4 as nc
+import os, gzip, json
+try: import cPickle as pickle # cPickle is the same, but faster
+except: import pickle
+import logging
+import scipy.stats as ss
 # internal imports
-from geodata.misc import isEqual, DataError
+from geodata.misc import isEqual, DataError, ArgumentError, PermissionError
+from geodata.base import monthlyUnitsList
 from geodata.netcdf import DatasetNetCDF, VarNC
+from utils.nctools import checkFillValue, add_var
+from processing.multiprocess import asyncPoolEC
 
 
 # some helper stuff for validation
 eps = np.finfo(np.float32).eps # single precision rounding error is good enough
 Stats = col.namedtuple('Stats', ('Correction','RMSE','Correlation','Bias',))
+# file name patterns for different storage formats of BiasCorrection objects
+bc_file_patterns = dict(pickle='bias_{:s}.pickle', netcdf='bias_{:s}.nc', npz='bias_{:s}.npz')
 
 def getBCmethods(method, **bcargs):
     ''' function that returns an instance of a specific BiasCorrection child class specified as method; 
@@ -33,6 +44,12 @@ def getBCmethods(method, **bcargs):
         return SMBC(**bcargs)
     elif method.upper() == 'AABC':
         return AABC(**bcargs)
+    elif method.upper() in ('QM','EQM'):
+        return QuantileMapping(**bcargs)
+    elif method.upper() == 'DQM':
+        return QuantileMapping(ldetrend=True, **bcargs)
+    elif method.upper() == 'PQM':
+        return QuantileMapping(lparametric=True, **bcargs)
     else:
         raise NotImplementedError(method)
   
@@ -56,6 +73,66 @@ def getPickleFileName(method=None, obs_name=None, mode=None, periodstr=None, gri
     picklefile = pattern.format(name) # insert name into fixed pattern
     return picklefile
 
+def _fillNaN(data):
+    ''' helper function that returns a floating point array with NaN as missing values '''
+    if not np.issubdtype(data.dtype,np.inexact): data = data.astype(np.float64)
+    if isinstance(data,np.ma.MaskedArray): data = data.filled(np.NaN)
+    return data
+
+def mapQuantiles(x, qsrc, qtgt, lratio=False):
+    ''' map values x (samples x points) from source quantiles to target quantiles (quantiles x points) by
+        linear interpolation, for all points at once (using a vectorized binary search); beyond the 
+        range of the tables, the correction at the end points is applied (a ratio, if lratio=True);
+        values that are equal to several (tied) source quantiles (e.g. zero precipitation) are mapped 
+        to the target quantile in the middle of the tie range '''
+    nq = qsrc.shape[0]; cols = np.arange(qsrc.shape[1])
+    def search(lright):
+        ''' find interval in quantile table: qsrc[lo] <= x < qsrc[hi] (qsrc[lo] < x <= qsrc[hi], if not lright) '''
+        lo = np.zeros(x.shape, dtype=np.intp); hi = np.zeros(x.shape, dtype=np.intp) + (nq-1)
+        for _ in xrange(int(np.ceil(np.log2(max(nq-1,1))))):
+            lact = hi - lo > 1 # still searching
+            mid = (lo+hi)//2
+            lmid = qsrc[mid,cols] <= x if lright else qsrc[mid,cols] < x
+            lo = np.where(lact & lmid, mid, lo); hi = np.where(lact & ~lmid, mid, hi)
+        return lo, hi
+    lo, hi = search(lright=True)
+    # linear interpolation
+    x0 = qsrc[lo,cols]; dx = qsrc[hi,cols] - x0
+    y0 = qtgt[lo,cols]; dy = qtgt[hi,cols] - y0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        w = np.clip(np.where(dx > 0, (x-x0)/dx, 0.), 0., 1.)
+    y = y0 + w*dy
+    # ties: first and last source quantile that are equal to x
+    with np.errstate(invalid='ignore'):
+        first = np.where(qsrc[0] >= x, 0, search(lright=False)[1])
+        last = np.where(qsrc[-1] <= x, nq-1, lo)
+    ltie = last > first
+    if np.any(ltie):
+        m0 = (first+last)//2; m1 = (first+last+1)//2 # middle of the tie range
+        y = np.where(ltie, 0.5*(qtgt[m0,cols]+qtgt[m1,cols]), y)
+    y = np.where(np.isnan(x), np.NaN, y) # not caught by interpolation with tied quantiles
+    # extrapolation: apply correction at end points
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for i,lout in ((0,x < qsrc[0]),(-1,x > qsrc[-1])):
+            if lratio: y = np.where(lout, x*np.where(qsrc[i] > 0, qtgt[i]/qsrc[i], 1.), y)
+            else: y = np.where(lout, x+(qtgt[i]-qsrc[i]), y)
+    return y
+
+def _encodeJSON(obj):
+    ''' helper function to serialize Numpy arrays and scalars as JSON '''
+    if isinstance(obj,np.ndarray): return dict(__ndarray__=obj.tolist(), dtype=obj.dtype.str)
+    elif isinstance(obj,np.generic): return obj.item()
+    else: raise TypeError(obj)
+
+def _decodeJSON(obj):
+    ''' helper function to restore Numpy arrays and (byte) strings from JSON '''
+    if isinstance(obj,dict):
+        if '__ndarray__' in obj: return np.asarray(obj['__ndarray__'], dtype=obj['dtype'])
+        else: return {str(key):_decodeJSON(value) for key,value in obj.items()}
+    elif isinstance(obj,list): return [_decodeJSON(value) for value in obj]
+    elif isinstance(obj,unicode): return str(obj)
+    else: return obj
+
 ## classes that implement bias correction 
 
 class BiasCorrection(object):
@@ -85,7 +162,7 @@ class BiasCorrection(object):
             if not obsvar.data: obsvar.load() # assume it is a VarNC, if there is no data
             assert var.data and obsvar.data, obsvar.data      
             # check if they are actually equal
-            if isEqual(var.data_array, obsvar.data_array, eps=eps, masked_equal=True):
+            if var.shape == obsvar.shape and isEqual(var.data_array, obsvar.data_array, eps=eps, masked_equal=True):
                 correction = None
             else: 
                 correction = self._trainVar(var, obsvar, **kwargs)
@@ -107,16 +184,7 @@ class BiasCorrection(object):
             asNC=False
             bcds = dataset.copy(axesdeep=True, varsdeep=False) # make a copy, but don't duplicate data
         # prepare variable map, so we can iterate easily
-        itermap = dict() # the map we are going to iterate over
-        varlist = self.varlist if varlist is None else varlist
-        for varname in varlist:
-            if varmap and varname in varmap:
-                maplist = varmap[varname]
-                if isinstance(maplist, (list,tuple)): itermap[varname] = maplist
-                elif isinstance(maplist, basestring): itermap[varname] = (maplist,)
-                else: raise TypeError(maplist)
-            else:
-                itermap[varname] = (varname,)
+        itermap = self._getItermap(varlist=varlist, varmap=varmap)
         # loop over variables that will be corrected
         for srcvar,maplist in itermap.items():
             for tgtvar in maplist:
@@ -126,9 +194,8 @@ class BiasCorrection(object):
                     newvar = bcds[tgtvar] # should be loaded
                     if isinstance(newvar,VarNC): # the corrected variable needs to load data, hence can't be VarNC          
                         newvar = newvar.copy(axesdeep=False, varsdeep=False, asNC=False) 
-                    assert varname in self._correction, self._correction
-                    # bias-correct data and load in new variable 
-                    if self._correction[srcvar] is not None:
+                    # bias-correct data and load in new variable (variables without correction are copied)
+                    if self._correction.get(srcvar,None) is not None:
                         newvar.load(self._correctVar(oldvar, srcvar))
                     if newvar is not bcds[tgtvar]: 
                         bcds[tgtvar] = newvar # attach new (non-NC) var
@@ -141,6 +208,104 @@ class BiasCorrection(object):
         if varname is None: varname = var.name # allow for variable mapping
         return var.data_array # do nothing, just return input
     
+    def _correctArray(self, data, correction, units=None, **kwargs):
+        ''' apply correction parameters (aligned with data) to a data array (or block) and return 
+            bias-corrected data; this method has to be implemented for streaming corrections '''
+        return data # do nothing, just return input
+    
+    def correctNC(self, dataset, sink, varlist=None, varmap=None, taxis='time', memory=None, 
+                  loverwrite=False, **kwargs):
+        ''' stream bias-corrected variables from a DatasetNetCDF into a writable DatasetNetCDF (sink); 
+            data are read, corrected and written in blocks along the time axis (see VarNC.iterBlocks), 
+            so that memory use is bounded by one block (memory budget in MB), independent of the length
+            of the time-series; variables without correction are copied in the same way '''
+        if not isinstance(dataset,DatasetNetCDF): raise TypeError(dataset)
+        if not isinstance(sink,DatasetNetCDF): raise TypeError(sink)
+        if 'w' not in sink.mode: raise PermissionError("Target Dataset has to be opened in write mode.")
+        itermap = self._getItermap(varlist=varlist, varmap=varmap)
+        # loop over variables that will be corrected
+        for srcvar,maplist in itermap.items():
+            for tgtvar in maplist:
+                if tgtvar in dataset:
+                    var = dataset[tgtvar]
+                    # create target variable (without data)
+                    if tgtvar in sink:
+                        if not loverwrite: raise ArgumentError("Variable '{:s}' already exists in target Dataset.".format(tgtvar))
+                        if sink[tgtvar].shape != var.shape: raise DataError(sink[tgtvar])
+                    else: 
+                        sink.addVariable(var, asNC=True, copy=True, deepcopy=False)
+                    ncvar = sink[tgtvar].ncvar 
+                    correction = self._correction.get(srcvar,None)
+                    # read, correct and write data in blocks along the time axis
+                    iax = var.axisIndex(taxis) if var.hasAxis(taxis) else None
+                    if iax is not None and var.checkStream(memory=0):
+                        if correction is not None: 
+                            correction = self._prepareCorrection(correction, var, iax=iax, memory=memory)
+                        blocks = var.iterBlocks(axis=taxis, memory=memory)
+                    else: # no time axis or already loaded: correct in one go
+                        blocks = [(0, var.getArray(unmask=False, copy=False))]
+                    slcs = [slice(None)]*var.ndim
+                    for i0,data in blocks:
+                        if iax is not None: slcs[iax] = slice(i0,i0+data.shape[iax])
+                        if correction is not None:
+                            if iax is None: blkcorr = correction
+                            else: blkcorr = self._alignCorrection(correction, var, iax=iax, i0=i0, i1=i0+data.shape[iax])
+                            data = self._correctArray(data, blkcorr, units=var.units, **kwargs)
+                        ncvar[tuple(slcs)] = data # masking is handled by the NetCDF module
+                        del data # release memory before next block is read
+                    fillValue = checkFillValue(var.fillValue, var.dtype)
+                    if fillValue is not None: ncvar.setncattr('missing_value',fillValue)
+                    ncvar.group().sync()
+        # return target dataset
+        return sink
+    
+    def _prepareCorrection(self, correction, var, iax=0, memory=None):
+        ''' helper method to derive correction parameters that depend on the entire data array, before 
+            it is streamed in blocks along axis iax (e.g. using an additional pass over the data); 
+            by default, parameters are returned unchanged '''
+        return correction
+    
+    def _alignCorrection(self, correction, var, iax=0, i0=None, i1=None):
+        ''' helper method to extract the correction parameters corresponding to a block of data 
+            along axis iax (from record i0 to i1); parameters can be scalar, have the same shape as
+            the variable, or represent a seasonal cycle (12 month along the time axis) '''
+        if correction is None or np.isscalar(correction) or np.ndim(correction) == 0: 
+            return correction # no alignment necessary
+        if correction.ndim != var.ndim: raise DataError(correction.shape)
+        slcs = [slice(None)]*correction.ndim
+        if correction.shape == var.shape: 
+            slcs[iax] = slice(i0,i1) # same as data 
+        elif correction.shape[iax] == 1: 
+            pass # broadcast along time axis
+        elif correction.shape[iax] == 12: # seasonal cycle 
+            slcs[iax] = self._getMonthIndex(var.axes[iax], i0=i0, i1=i1)
+        else: raise DataError(correction.shape)
+        return correction[tuple(slcs)]
+    
+    def _getMonthIndex(self, taxis, i0=None, i1=None):
+        ''' helper method that returns the month index (0 = January) of records i0 to i1 of a time axis '''
+        if len(taxis) == 12: 
+            return np.arange(12)[i0:i1] # a climatology
+        elif taxis.units.lower() in monthlyUnitsList: 
+            # N.B.: monthly time-series start counting at 0, which corresponds to January
+            return np.asarray(taxis.coord[i0:i1], dtype=np.int)%12 
+        else: 
+            raise NotImplementedError("Periodic corrections can only be applied to monthly time-series.")
+    
+    def _getItermap(self, varlist=None, varmap=None):
+        ''' helper method to construct a map from corrected variables to target variables '''
+        itermap = dict() # the map we are going to iterate over
+        varlist = self.varlist if varlist is None else varlist
+        for varname in varlist:
+            if varmap and varname in varmap:
+                maplist = varmap[varname]
+                if isinstance(maplist, (list,tuple)): itermap[varname] = maplist
+                elif isinstance(maplist, basestring): itermap[varname] = (maplist,)
+                else: raise TypeError(maplist)
+            else:
+                itermap[varname] = (varname,)
+        return itermap
+    
     def _getVarlist(self, dataset, observations):
         ''' find all valid candidate variables for bias correction present in both input datasets '''
         varlist = []
@@ -182,13 +347,42 @@ class BiasCorrection(object):
         self._validation = validation # also store
         return validation
     
-    def picklefile(self, obs_name=None, mode=None, periodstr=None, gridstr=None, domain=None, tag=None):
+    def picklefile(self, obs_name=None, mode=None, periodstr=None, gridstr=None, domain=None, tag=None, pattern=None):
         ''' generate a standardized name for the pickle file, based on arguments '''
         if self._picklefile is None:      
             self._picklefile = getPickleFileName(method=self.name, obs_name=obs_name, periodstr=periodstr, 
-                                                 gridstr=gridstr, domain=domain, tag=tag) 
+                                                 gridstr=gridstr, domain=domain, tag=tag, pattern=pattern) 
         return self._picklefile
     
+    def save(self, filepath, loverwrite=True):
+        ''' save only the correction parameters (one array per variable) and meta data in a compact NetCDF 
+            (.nc) or Numpy (.npz) file, which can be loaded lazily (see loadBiasCorrection) '''
+        if os.path.exists(filepath):
+            if loverwrite: os.remove(filepath)
+            else: raise IOError("File '{:s}' already exists!".format(filepath))
+        # collect correction arrays (masked values are stored as NaN)
+        corrections = dict(); uncorrected = []
+        for varname,correction in self._correction.items():
+            if correction is None: uncorrected.append(varname)
+            elif isinstance(correction,np.ma.MaskedArray): corrections[varname] = _fillNaN(correction)
+            else: corrections[varname] = np.asarray(correction)
+        # meta data: class name and instance attributes (serialized as JSON)
+        atts = {key:value for key,value in self.__dict__.items() if key not in ('_correction','_validation')}
+        meta = json.dumps(dict(bc_class=self.__class__.__name__, attributes=atts, 
+                               corrected=sorted(corrections.keys()), uncorrected=uncorrected), default=_encodeJSON)
+        # write file
+        if filepath.endswith('.npz'):
+            np.savez_compressed(filepath, __meta__=np.array(meta), **corrections)
+        elif filepath.endswith('.nc'):
+            ncfile = nc.Dataset(filepath, mode='w', format='NETCDF4')
+            ncfile.setncattr('bc_meta', meta)
+            for varname,correction in corrections.items():
+                add_var(ncfile, varname, ['n{:d}'.format(n) for n in correction.shape], data=correction, zlib=True)
+            ncfile.close()
+        else: raise ArgumentError("Unknown file format (use .nc or .npz): '{:s}'".format(filepath))
+        if not os.path.exists(filepath): raise IOError("Error while saving to '{:s}'".format(filepath))
+        return filepath
+    
     def __str__(self):
         ''' a string representation of the method and parameters '''
         text = '{:s} Object'.format(self.long_name)
@@ -231,11 +425,15 @@ class Delta(BiasCorrection):
     def _correctVar(self, var, varname=None, **kwargs):
         ''' use stored ratios to bias-correct the input dataset and return a new copy '''
         if varname is None: varname = var.name # allow for variable mapping
+        return self._correctArray(var.data_array, self._correction[varname], units=var.units)
+          
+    def _correctArray(self, data, correction, units=None, **kwargs):
+        ''' apply ratio or difference to data (or a block of data) and return a new copy '''
         # decide between difference or ratio based on variable type
-        if var.units in self._ratio_units: # ratio for fluxes
-            data = var.data_array * self._correction[varname]
+        if units in self._ratio_units: # ratio for fluxes
+            data = data * correction
         else: # default behavior is differences
-            data = var.data_array + self._correction[varname]    
+            data = data + correction    
         # return bias-corrected data (copy)
         return data
 
@@ -289,6 +487,149 @@ class AABC(Delta):
         return r
         
         
+class QuantileMapping(BiasCorrection):
+    ''' A class that implements empirical quantile mapping with quantile tables for each grid point and 
+        month; optionally, linear trends can be removed before mapping (and restored afterwards), or 
+        quantiles can be derived from fitted distributions (normal, or gamma for fluxes). Quantile 
+        tables are computed and applied for all grid points at once and stored in single precision. '''
+    name = 'QM' # name used in file names
+    long_name = 'Empirical Quantile Mapping' # name for printing
+    _ratio_units = Delta._ratio_units # variable units that indicate ratio (for extrapolation)
+    _pmin = 1.e-3 # probabilities for parametric quantiles are clipped to this value (to avoid infinity)
+    
+    def __init__(self, varlist=None, nquantiles=101, lmonthly=True, ldetrend=False, lparametric=False, 
+                 taxis='time', **bcargs):
+        ''' nquantiles: size of the fixed quantile grid; lmonthly: separate tables for each month; 
+            ldetrend: detrended quantile mapping; lparametric: parametric quantile mapping '''
+        super(QuantileMapping,self).__init__(varlist=varlist, **bcargs)
+        self.probs = np.linspace(0., 1., nquantiles) # fixed quantile grid
+        self.lmonthly = lmonthly; self.ldetrend = ldetrend; self.lparametric = lparametric
+        self.taxis = taxis
+        if ldetrend: 
+            self.name = 'DQM'; self.long_name = 'Detrended Quantile Mapping'
+        elif lparametric: 
+            self.name = 'PQM'; self.long_name = 'Parametric Quantile Mapping'
+      
+    def _trainVar(self, var, obsvar, **kwargs):
+        ''' compute quantile tables for simulation and observations, with shape
+            (2, months, quantiles)+(shape of the variable without time axis) '''
+        tables = []
+        for v in (var,obsvar):
+            data, months, shape = self._getSamples(v)
+            if self.ldetrend: data = self._detrend(data)[0]
+            tables.append(self._quantileTable(data, months, units=var.units))
+        if tables[0].shape != tables[1].shape: raise DataError(obsvar)
+        table = np.stack(tables).reshape((2,)+tables[0].shape[:2]+shape)
+        # return correction parameters (quantile tables)
+        return table
+    
+    def _getSamples(self, var):
+        ''' helper method that returns data as a 2D array with time as the first axis (and NaN as 
+            missing values), the month index of each record, and the shape of the remaining axes '''
+        iax = var.axisIndex(self.taxis)
+        data = _fillNaN(var.data_array)
+        data = np.rollaxis(data, iax) # move time axis to the front
+        shape = data.shape[1:]
+        data = data.reshape((data.shape[0],-1))
+        if self.lmonthly: months = self._getMonthIndex(var.axes[iax])
+        else: months = np.zeros(data.shape[0], dtype=np.int)
+        return data, months, shape
+    
+    def _quantileTable(self, data, months, units=None):
+        ''' compute quantiles along the sample axis (0) for each month and all grid points at once '''
+        nmon = 12 if self.lmonthly else 1
+        table = np.empty((nmon,len(self.probs),data.shape[1]), dtype=np.float32)
+        for m in xrange(nmon):
+            sample = data[months == m,:]
+            if sample.shape[0] == 0: table[m] = np.NaN # no data for this month
+            elif self.lparametric: table[m] = self._parametricQuantiles(sample, units=units)
+            else: table[m] = np.nanpercentile(sample, self.probs*100., axis=0)
+        return table
+    
+    def _parametricQuantiles(self, sample, units=None):
+        ''' fit distributions to samples (method of moments) and return quantiles on the fixed grid '''
+        mean = np.nanmean(sample, axis=0); std = np.nanstd(sample, axis=0)
+        probs = np.clip(self.probs, self._pmin, 1.-self._pmin).reshape((-1,1))
+        if units in self._ratio_units: # gamma distribution for fluxes
+            with np.errstate(invalid='ignore', divide='ignore'):
+                scale = std**2/mean; shape = mean/scale
+            return ss.gamma.ppf(probs, shape, scale=scale)
+        else: # normal distribution
+            return mean + std*ss.norm.ppf(probs)
+    
+    def _detrend(self, data, i0=0, tmean=None, slope=None):
+        ''' remove linear trends along the sample axis (0) at all grid points; returns detrended data 
+            (with the same mean) and the trends; if data is a block of records (starting at i0), the 
+            mean time and slope of the entire time-series have to be passed (see _prepareCorrection) '''
+        time = np.where(np.isnan(data), np.NaN, np.arange(i0,i0+data.shape[0]).reshape((-1,1)))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            time -= np.nanmean(time, axis=0) if tmean is None else tmean
+            if slope is None:
+                tvar = np.nansum(time**2, axis=0) 
+                slope = np.where(tvar > 0, np.nansum(time*(data - np.nanmean(data, axis=0)), axis=0)/tvar, 0.)
+        trend = time*slope
+        return data - trend, trend
+    
+    def _prepareCorrection(self, correction, var, iax=0, memory=None):
+        ''' with detrending, the trends are estimated from the entire time-series in an additional pass, 
+            so that the result does not depend on the block size '''
+        if not self.ldetrend: return correction
+        # accumulate sums for a linear regression at all grid points
+        sums = None
+        for i0,data in var.iterBlocks(axis=var.axes[iax].name, memory=memory):
+            x = np.rollaxis(_fillNaN(data), iax) # time axis first
+            x = x.reshape((x.shape[0],-1))
+            time = np.where(np.isnan(x), np.NaN, np.arange(i0,i0+x.shape[0], dtype=np.float64).reshape((-1,1)))
+            block = (np.sum(~np.isnan(x), axis=0), np.nansum(time, axis=0), np.nansum(time**2, axis=0), 
+                     np.nansum(x, axis=0), np.nansum(time*x, axis=0))
+            sums = block if sums is None else tuple(s+b for s,b in zip(sums,block))
+        n, st, stt, sx, stx = sums
+        with np.errstate(invalid='ignore', divide='ignore'):
+            tmean = st/n; tvar = stt - st*tmean
+            slope = np.where(tvar > 0, (stx - tmean*sx)/tvar, 0.)
+        return dict(table=correction, tmean=tmean, slope=slope)
+    
+    def _alignCorrection(self, correction, var, iax=0, i0=None, i1=None):
+        ''' the quantile tables are the same for all blocks, but the month index (and the position of 
+            the block for trends of the entire time-series) is needed '''
+        if self.lmonthly: months = self._getMonthIndex(var.axes[iax], i0=i0, i1=i1)
+        else: months = None 
+        if isinstance(correction,dict): # see _prepareCorrection
+            trend = dict(i0=i0, tmean=correction['tmean'], slope=correction['slope'])
+            correction = correction['table']
+        else: trend = None
+        return dict(table=correction, months=months, iax=iax, trend=trend)
+    
+    def _correctVar(self, var, varname=None, **kwargs):
+        ''' map quantiles of the input variable to observed quantiles and return bias-corrected data '''
+        if varname is None: varname = var.name # allow for variable mapping
+        iax = var.axisIndex(self.taxis)
+        correction = self._alignCorrection(self._correction[varname], var, iax=iax, i0=0, i1=var.shape[iax])
+        return self._correctArray(var.data_array, correction, units=var.units)
+    
+    def _correctArray(self, data, correction, units=None, **kwargs):
+        ''' map a data array (or block) from simulated to observed quantiles, for all grid points at once;
+            with detrending, the trend is estimated from the data array, unless the trend of the entire 
+            time-series is passed with the correction parameters (see _prepareCorrection) '''
+        table = correction['table']; months = correction['months']; iax = correction['iax']
+        table = table.reshape(table.shape[:3]+(-1,)) # flatten grid points
+        x = np.rollaxis(_fillNaN(data), iax) # time axis first
+        shape = x.shape; x = x.reshape((shape[0],-1))
+        if self.ldetrend: x, trend = self._detrend(x, **(correction.get('trend') or dict()))
+        if months is None: months = np.zeros(shape[0], dtype=np.int)
+        lratio = units in self._ratio_units
+        y = np.empty_like(x)
+        for m in np.unique(months):
+            idx = months == m
+            y[idx,:] = mapQuantiles(x[idx,:], table[0,m], table[1,m], lratio=lratio)
+        if self.ldetrend: y += trend
+        y = np.rollaxis(y.reshape(shape), 0, iax+1) # restore original order
+        if np.issubdtype(data.dtype,np.inexact): y = y.astype(data.dtype, copy=False)
+        if isinstance(data,np.ma.MaskedArray): y = np.ma.masked_where(np.ma.getmaskarray(data), y)
+        # return bias-corrected data (copy)
+        return y
+        
+        
 class MyBC(BiasCorrection):
     ''' A BiasCorrection class that implements snowmelt shift and utilizes different (unobserved) precipitation types '''
     
@@ -302,3 +643,135 @@ class MyBC(BiasCorrection):
             this method should be implemented for each method '''
         if varname is None: varname = var.name # allow for variable mapping
         raise NotImplementedError
+  
+    def _correctArray(self, data, correction, units=None, **kwargs):
+        ''' apply bias correction to a block of data; not implemented yet '''
+        raise NotImplementedError
+
+
+## functions to apply bias-corrections to NetCDF datasets in a streaming fashion
+
+class CorrectionFile(col.Mapping):
+    ''' A read-only dictionary of correction parameters in a NetCDF or Numpy file, which are only read 
+        when a variable is accessed (and then cached); this is the '_correction' attribute of 
+        BiasCorrection objects loaded from compact files. '''
+    
+    def __init__(self, filepath, corrected, uncorrected=None):
+        ''' save file path and variable names '''
+        self.filepath = filepath
+        self.corrected = list(corrected)
+        self.uncorrected = list(uncorrected) if uncorrected else []
+        self._cache = dict()
+    
+    def __getitem__(self, varname):
+        ''' read correction parameters of one variable from file '''
+        if varname in self.uncorrected: return None
+        elif varname not in self.corrected: raise KeyError(varname)
+        if varname not in self._cache:
+            if self.filepath.endswith('.npz'):
+                npz = np.load(self.filepath)
+                try: correction = npz[varname]
+                finally: npz.close()
+            else:
+                ncfile = nc.Dataset(self.filepath, mode='r')
+                try: 
+                    ncvar = ncfile.variables[varname]
+                    ncvar.set_auto_mask(False) # missing values are NaN
+                    correction = ncvar.getValue() if ncvar.ndim == 0 else ncvar[:]
+                finally: ncfile.close()
+            if np.ndim(correction) == 0: correction = correction[()] # scalar parameters
+            self._cache[varname] = correction
+        return self._cache[varname]
+    
+    def __contains__(self, varname):
+        return varname in self.corrected or varname in self.uncorrected # don't read data
+    def __iter__(self): 
+        return iter(self.corrected + self.uncorrected)
+    def __len__(self): 
+        return len(self.corrected) + len(self.uncorrected)
+
+
+def loadBiasCorrection(filepath, llazy=True):
+    ''' load a BiasCorrection object from a compact NetCDF/Numpy file (see BiasCorrection.save; with 
+        llazy=True, correction parameters are only read, when they are needed), or from a pickle 
+        (optionally gzip-compressed; for backwards-compatibility) '''
+    if filepath.endswith('.nc') or filepath.endswith('.npz'):
+        # read meta data
+        if filepath.endswith('.npz'):
+            npz = np.load(filepath)
+            try: meta = str(npz['__meta__'])
+            finally: npz.close()
+        else:
+            ncfile = nc.Dataset(filepath, mode='r')
+            try: meta = ncfile.getncattr('bc_meta')
+            finally: ncfile.close()
+        meta = json.loads(meta, object_hook=_decodeJSON)
+        # reconstruct instance without calling the constructor
+        bc_class = globals().get(str(meta['bc_class']),None)
+        if bc_class is None or not issubclass(bc_class,BiasCorrection): raise TypeError(meta['bc_class'])
+        BC = bc_class.__new__(bc_class)
+        BC.__dict__.update(_decodeJSON(meta['attributes']))
+        correction = CorrectionFile(filepath, corrected=_decodeJSON(meta['corrected']), 
+                                    uncorrected=_decodeJSON(meta['uncorrected']))
+        if not llazy: correction = {varname:correction[varname] for varname in correction}
+        BC._correction = correction
+    else:
+        op = gzip.open if filepath.endswith('.gz') else open
+        with op(filepath, 'rb') as filehandle:
+            BC = pickle.load(filehandle)
+    if not isinstance(BC,BiasCorrection): raise TypeError(BC)
+    return BC
+
+def correctDatasetNC(dataset, sink, varlist=None, bc=None, varmap=None, memory=None, loverwrite=False, 
+                     ldebug=False, lparallel=False, pidstr='', logger=None, **kwargs):
+    ''' worker function that streams bias-corrected variables from a NetCDF dataset into a new NetCDF 
+        file (see BiasCorrection.correctNC); dataset can be a DatasetNetCDF, a callable that returns one 
+        (e.g. a partial of a load function) or a dictionary of DatasetNetCDF arguments, sink can be a 
+        DatasetNetCDF or a file path, and bc a BiasCorrection instance or the path to its pickle file '''
+    # logging
+    if logger is None: # make new logger     
+        logger = logging.getLogger() # new logger
+        logger.addHandler(logging.StreamHandler())
+    elif isinstance(logger,basestring): 
+        logger = logging.getLogger(name=logger) # connect to existing one
+    # load bias-correction and source dataset
+    if isinstance(bc,basestring): bc = loadBiasCorrection(bc)
+    if not isinstance(bc,BiasCorrection): raise TypeError(bc)
+    lopen = not isinstance(dataset,DatasetNetCDF) # close source dataset, if we opened it here
+    if isinstance(dataset,dict): 
+        dataargs = dict(mode='r'); dataargs.update(dataset)
+        dataset = DatasetNetCDF(**dataargs)
+    elif lopen and callable(dataset): dataset = dataset()
+    if not isinstance(dataset,DatasetNetCDF): raise TypeError(dataset)
+    # create target file
+    lclose = isinstance(sink,basestring)
+    if lclose:
+        if os.path.exists(sink):
+            if loverwrite: os.remove(sink)
+            else: raise IOError("Target file '{:s}' already exists!".format(sink))
+        sink = DatasetNetCDF(filelist=[sink], mode='w', atts=dataset.atts.copy())
+    logger.info("\n{:s}   ***   Streaming {:s} of Dataset '{:s}'   ***   \n".format(pidstr,bc.long_name,dataset.name))
+    # stream bias-corrected data
+    bc.correctNC(dataset, sink, varlist=varlist, varmap=varmap, memory=memory, loverwrite=loverwrite, **kwargs)
+    if ldebug: logger.info('\n'+str(sink)+'\n')
+    # clean up
+    if lclose: sink.close()
+    if lopen: dataset.close()
+    return 0 # "exit code"
+
+def streamBiasCorrection(jobs, bc, varlist=None, NP=None, ldebug=False, **kwargs):
+    ''' apply a BiasCorrection to several NetCDF datasets (e.g. ensemble members) in parallel; jobs is 
+        a list of (dataset, sink) or (dataset, sink, varlist) tuples, which must be picklable (i.e. 
+        dataset arguments and file paths, see correctDatasetNC); since NetCDF files can not be written 
+        concurrently, each job needs its own target file, so to parallelize over variables, jobs have to
+        be split by variable groups; the memory budget (kwarg 'memory' in MB) applies to each worker; 
+        returns the number of failed jobs '''
+    if not isinstance(jobs,(list,tuple)): raise TypeError(jobs)
+    args = []
+    for job in jobs:
+        if len(job) == 2: args.append( tuple(job)+(varlist,) )
+        elif len(job) == 3: args.append( tuple(job) )
+        else: raise ArgumentError(job)
+    kwargs['bc'] = bc
+    # N.B.: each job opens its own files, so that memory is released, when the worker process terminates
+    return asyncPoolEC(correctDatasetNC, args, kwargs, NP=NP, ldebug=ldebug, ltrialnerror=True, maxtasksperchild=1)
@@ -19,15 +19,16 @@ import logging
 from geodata.misc import DateError, printList
 from datasets import gridded_datasets
 from processing.multiprocess import asyncPoolEC
-from processing.misc import getMetaData,  getExperimentList, loadYAML
+from processing.misc import getMetaData,  getExperimentList, loadYAML, getJobCost
 from datasets.common import loadDataset
-from processing.bc_methods import getBCmethods
+from processing.bc_methods import getBCmethods, bc_file_patterns
 
 
 # worker function that is to be passed to asyncPool for parallel execution; use of TrialNError decorator is assumed
 def generateBiasCorrection(dataset, mode, dataargs, obs_dataset, bc_method, bc_args, loverwrite=False, lgzip=None, tag=None, 
-                           ldebug=False, lparallel=False, pidstr='', logger=None):
-  ''' worker function to generate a bias correction objects for a given dataset '''
+                           bcformat='pickle', ldebug=False, lparallel=False, pidstr='', logger=None):
+  ''' worker function to generate a bias correction objects for a given dataset; bcformat can be 'pickle',
+      or 'netcdf'/'npz' for a compact file that contains only the correction parameters '''
   # input checking
   if not isinstance(dataset,basestring): raise TypeError
   if not isinstance(dataargs,dict): raise TypeError # all dataset arguments are kwargs 
@@ -51,7 +52,9 @@ def generateBiasCorrection(dataset, mode, dataargs, obs_dataset, bc_method, bc_a
   # initialize BiasCorrection class instance
   BC = getBCmethods(bc_method, **bc_args)
   # get folder for target dataset and do some checks
-  picklefile = BC.picklefile(obs_name=obs_dataset.name, gridstr=dataargs.grid, domain=dataargs.domain, tag=tag)
+  if bcformat not in bc_file_patterns: raise NotImplementedError("Unknown file format: '{:s}'".format(bcformat))
+  picklefile = BC.picklefile(obs_name=obs_dataset.name, gridstr=dataargs.grid, domain=dataargs.domain, tag=tag, 
+                             pattern=bc_file_patterns[bcformat])
   if ldebug: picklefile = 'test_' + picklefile 
   picklepath = '{:s}/{:s}'.format(avgfolder,picklefile)
   
@@ -107,16 +110,20 @@ def generateBiasCorrection(dataset, mode, dataargs, obs_dataset, bc_method, bc_a
       print('')  
       
     ## pickle bias-correction object with trained parameters
-    # open file and save pickle
-    if os.path.exists(picklepath): os.remove(picklepath)
-    if lgzip:
-      op = gzip.open 
-      picklepath += '.gz'
-    else: op = open
-    with op(picklepath, 'wb') as filehandle:
-      pickle.dump(BC, filehandle, protocol=-1) # should be new binary protocol
-    if not os.path.exists(picklepath):
-      raise IOError, "Error while saving Pickle to '{0:s}'".format(picklepath)
+    if bcformat != 'pickle':
+      # save only correction parameters in a compact file (NetCDF or npz; already compressed)
+      BC.save(picklepath, loverwrite=True)
+    else:
+      # open file and save pickle
+      if os.path.exists(picklepath): os.remove(picklepath)
+      if lgzip:
+        op = gzip.open 
+        picklepath += '.gz'
+      else: op = open
+      with op(picklepath, 'wb') as filehandle:
+        pickle.dump(BC, filehandle, protocol=-1) # should be new binary protocol
+      if not os.path.exists(picklepath):
+        raise IOError, "Error while saving Pickle to '{0:s}'".format(picklepath)
 
       
     # write results to file
@@ -137,6 +144,10 @@ if __name__ == '__main__':
   if os.environ.has_key('PYAVG_THREADS'): 
     NP = int(os.environ['PYAVG_THREADS'])
   else: NP = None
+  # recycle worker processes after this many jobs (releases memory; default: never)
+  if os.environ.has_key('PYAVG_MAXTASKS'): 
+    maxtasksperchild = int(os.environ['PYAVG_MAXTASKS']) or None
+  else: maxtasksperchild = None
   # run script in debug mode
   if os.environ.has_key('PYAVG_DEBUG'): 
     ldebug =  os.environ['PYAVG_DEBUG'] == 'DEBUG' 
@@ -156,6 +167,7 @@ if __name__ == '__main__':
     config = loadYAML('biascorrection.yaml', lfeedback=True)
     # read config object
     NP = NP or config['NP']
+    maxtasksperchild = maxtasksperchild or config.get('maxtasksperchild',None)
     loverwrite = config['loverwrite']
     # source data specs
     modes = config['modes']
@@ -180,6 +192,7 @@ if __name__ == '__main__':
     # target data specs
     export_arguments = config['export_parameters'] # this is actually a larger data structure
     lm3 = export_arguments['lm3'] # convert water flux from kg/m^2/s to m^3/m^2/s    
+    bcformat = config.get('bcformat','pickle') # file format for bias-correction objects
   else:
     # settings for testing and debugging
     NP = 1 ; ldebug = False # for quick computations
@@ -225,6 +238,7 @@ if __name__ == '__main__':
     # renaming NRCan pet to pet_wrf is necessary to bias-correct WRF PET
     ## remaining parameters
     lgzip = True # compress pickles
+    bcformat = 'pickle' # entire object ('netcdf' or 'npz' for compact files with only correction parameters)
     tag = None # an additional tag string for pickle name
     load_list = None # variables that need to be loaded
     varlist = None # variables that should be bias-corrected
@@ -329,10 +343,14 @@ if __name__ == '__main__':
                                           varlist=load_list, domain=domain, period=period)) )
       
   # static keyword arguments
-  kwargs = dict(obs_dataset=obs_dataset, bc_method=bc_method, bc_args=bc_args, loverwrite=loverwrite, lgzip=lgzip, tag=tag)
+  kwargs = dict(obs_dataset=obs_dataset, bc_method=bc_method, bc_args=bc_args, loverwrite=loverwrite, lgzip=lgzip, tag=tag, 
+                bcformat=bcformat)
   # N.B.: formats will be iterated over inside export function
   
   ## call parallel execution function
-  ec = asyncPoolEC(generateBiasCorrection, args, kwargs, NP=NP, ldebug=ldebug, ltrialnerror=True)
+  # estimate job cost from source file size, so that large jobs are scheduled first
+  costs = [getJobCost(arg[0], arg[1], arg[-1]) for arg in args]
+  ec = asyncPoolEC(generateBiasCorrection, args, kwargs, NP=NP, ldebug=ldebug, ltrialnerror=True, costs=costs, 
+                   maxtasksperchild=maxtasksperchild)
   # exit with fraction of failures (out of 10) as exit code
   exit(int(10+int(10.*ec/len(args))) if ec > 0 else 0)
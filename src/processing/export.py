@@ -7,9 +7,7 @@ A script to convert datasets to raster format using GDAL.
 '''
 
 # external imports
-try: import cPickle as pickle
-except: import pickle
-import os, shutil, gzip # check if files are present etc.
+import os, shutil # check if files are present etc.
 import numpy as np
 from importlib import import_module
 from datetime import datetime
@@ -20,11 +18,11 @@ from geodata.gdal import addGDALtoDataset, addGDALtoVar
 from geodata.misc import DateError, DatasetError, printList, ArgumentError, VariableError, GDALError
 from datasets import gridded_datasets
 from processing.multiprocess import asyncPoolEC
-from processing.misc import getMetaData,  getExperimentList, loadYAML, getTargetFile
+from processing.misc import getMetaData,  getExperimentList, loadYAML, getTargetFile, getJobCost
 from utils.nctools import writeNetCDF
 # new variable functions and bias-correction 
 import processing.newvars as newvars
-from processing.bc_methods import getPickleFileName
+from processing.bc_methods import getPickleFileName, loadBiasCorrection, bc_file_patterns
 
 ## helper classes to handle different file formats
 
@@ -262,6 +260,12 @@ def performExport(dataset, mode, dataargs, expargs, bcargs, loverwrite=False,
         picklefile = getPickleFileName(method=bc_method, obs_name=bc_obs, gridstr=bc_grid, domain=bc_domain, 
                                        tag=bc_tag, pattern=bc_pattern)
         picklepath = '{:s}/{:s}'.format(picklefolder,picklefile)
+        if bc_pattern is None: # look for compact files first (NetCDF or npz; lgzip only applies to pickles)
+            for bcformat in ('netcdf','npz'):
+                bcfile = getPickleFileName(method=bc_method, obs_name=bc_obs, gridstr=bc_grid, domain=bc_domain, 
+                                           tag=bc_tag, pattern=bc_file_patterns[bcformat])
+                if os.path.exists('{:s}/{:s}'.format(picklefolder,bcfile)):
+                    picklepath = '{:s}/{:s}'.format(picklefolder,bcfile); lgzip = False; break
         if lgzip:
             picklepath += '.gz' # add extension
             if not os.path.exists(picklepath): raise IOError(picklepath)
@@ -307,11 +311,9 @@ def performExport(dataset, mode, dataargs, expargs, bcargs, loverwrite=False,
       if 'period' in source.atts and dataargs.periodstr != source.atts.period: # a NetCDF attribute
           raise DateError, "Specifed period is inconsistent with netcdf records: '{:s}' != '{:s}'".format(periodstr,source.atts.period)
       
-      # load BiasCorrection object from pickle
+      # load BiasCorrection object from pickle (or compact file)
       if bc_method:      
-          op = gzip.open if lgzip else open
-          with op(picklepath, 'r') as filehandle:
-              BC = pickle.load(filehandle) 
+          BC = loadBiasCorrection(picklepath) # detects format based on extension
           # assemble logger entry
           bcmsgstr = "(performing bias-correction using {:s} from {:s} towards {:s})".format(BC.long_name,bc_reference,bc_obs)
       
@@ -413,6 +415,10 @@ if __name__ == '__main__':
     if os.environ.has_key('PYAVG_THREADS'): 
       NP = int(os.environ['PYAVG_THREADS'])
     else: NP = None
+    # recycle worker processes after this many jobs (releases memory; default: never)
+    if os.environ.has_key('PYAVG_MAXTASKS'): 
+      maxtasksperchild = int(os.environ['PYAVG_MAXTASKS']) or None
+    else: maxtasksperchild = None
     # run script in debug mode
     if os.environ.has_key('PYAVG_DEBUG'): 
       ldebug =  os.environ['PYAVG_DEBUG'] == 'DEBUG' 
@@ -432,6 +438,7 @@ if __name__ == '__main__':
         config = loadYAML('export.yaml', lfeedback=True)
         # read config object
         NP = NP or config['NP']
+        maxtasksperchild = maxtasksperchild or config.get('maxtasksperchild',None)
         loverwrite = config['loverwrite']
         # source data specs
         modes = config['modes']
@@ -714,6 +721,9 @@ if __name__ == '__main__':
     # N.B.: formats will be iterated over inside export function
     
     ## call parallel execution function
-    ec = asyncPoolEC(performExport, args, kwargs, NP=NP, ldebug=ldebug, ltrialnerror=True)
+    # estimate job cost from source file size, so that large jobs are scheduled first
+    costs = [getJobCost(arg[0], arg[1], arg[-1]) for arg in args]
+    ec = asyncPoolEC(performExport, args, kwargs, NP=NP, ldebug=ldebug, ltrialnerror=True, costs=costs, 
+                     maxtasksperchild=maxtasksperchild)
     # exit with fraction of failures (out of 10) as exit code
     exit(int(10+int(10.*ec/len(args))) if ec > 0 else 0)
@@ -21,7 +21,7 @@ from geodata.base import Dataset
 from datasets import gridded_datasets
 from processing.multiprocess import asyncPoolEC
 from processing.process import CentralProcessingUnit
-from processing.misc import getMetaData, getTargetFile, getExperimentList, loadYAML
+from processing.misc import getMetaData, getTargetFile, getExperimentList, loadYAML, getJobCost
 
 
 # worker function that is to be passed to asyncPool for parallel execution; use of the decorator is assumed
@@ -158,6 +158,10 @@ if __name__ == '__main__':
   if os.environ.has_key('PYAVG_THREADS'): 
     NP = int(os.environ['PYAVG_THREADS'])
   else: NP = None
+  # recycle worker processes after this many jobs (releases memory; default: never)
+  if os.environ.has_key('PYAVG_MAXTASKS'): 
+    maxtasksperchild = int(os.environ['PYAVG_MAXTASKS']) or None
+  else: maxtasksperchild = None
   # run script in debug mode
   if os.environ.has_key('PYAVG_DEBUG'): 
     ldebug =  os.environ['PYAVG_DEBUG'] == 'DEBUG' 
@@ -177,6 +181,7 @@ if __name__ == '__main__':
     config = loadYAML('exstns.yaml', lfeedback=True)
     # read config object
     NP = NP or config['NP']
+    maxtasksperchild = maxtasksperchild or config.get('maxtasksperchild',None)
     loverwrite = config['loverwrite']
     # source data specs
     modes = config['modes']
@@ -359,6 +364,9 @@ if __name__ == '__main__':
   kwargs = dict(loverwrite=loverwrite, varlist=varlist)
           
   ## call parallel execution function
-  ec = asyncPoolEC(performExtraction, args, kwargs, NP=NP, ldebug=ldebug, ltrialnerror=True)
+  # estimate job cost from source file size, so that large jobs are scheduled first
+  costs = [getJobCost(arg[0], arg[1], arg[-1]) for arg in args]
+  ec = asyncPoolEC(performExtraction, args, kwargs, NP=NP, ldebug=ldebug, ltrialnerror=True, costs=costs, 
+                   maxtasksperchild=maxtasksperchild)
   # exit with fraction of failures (out of 10) as exit code
   exit(int(10+int(10.*ec/len(args))) if ec > 0 else 0)
@@ -132,18 +132,17 @@ def getTargetFile(dataset=None, mode=None, dataargs=None, grid=None, shape=None,
   # return filename
   return filename
 
-def getSourceAge(filelist=None, fileclasses=None, filetypes=None, exp=None, domain=None,
-                 periodstr=None, gridstr=None, lclim=None, lts=None):
-  ''' function to to get the latest modification date of a set of filetypes '''
-  srcage = datetime.fromordinal(1) # the beginning of time (proleptic Gregorian calendar)
+def getSourceFiles(filelist=None, fileclasses=None, filetypes=None, exp=None, domain=None,
+                   periodstr=None, gridstr=None, lclim=None, lts=None, lcheck=True):
+  ''' function to assemble the list of source files of a set of filetypes (and check that they exist);
+      if lcheck=False, missing files are omitted, instead of raising an IOError '''
   # if complete file list is given, just check each file
   if filelist:
     for filepath in filelist:
-      if not os.path.exists(filepath): raise IOError, "Source file '{:s}' does not exist!".format(filepath)        
-      # determine age of source file
-      fileage = datetime.fromtimestamp(os.path.getmtime(filepath))          
-      if srcage < fileage: srcage = fileage # use latest modification date
+      if lcheck and not os.path.exists(filepath): raise IOError, "Source file '{:s}' does not exist!".format(filepath)        
+    if not lcheck: filelist = [filepath for filepath in filelist if os.path.exists(filepath)]
   else:    
+    filelist = []
     # prepare period and grid strings
     periodstr = '_{}'.format(periodstr) if periodstr else ''
     gridstr = '_{}'.format(gridstr) if gridstr else ''    
@@ -157,10 +156,21 @@ def getSourceAge(filelist=None, fileclasses=None, filetypes=None, exp=None, doma
         if lclim: filename = fileclass.climfile.format(domain,gridstr,periodstr) # insert domain number, grid, and period
         elif lts: filename = fileclass.tsfile.format(domain,gridstr) # insert domain number, and grid
       filepath = '{:s}/{:s}'.format(exp.avgfolder,filename)
-      if not os.path.exists(filepath): raise IOError, "Source file '{:s}' does not exist!".format(filepath)        
-      # determine age of source file
-      fileage = datetime.fromtimestamp(os.path.getmtime(filepath))          
-      if srcage < fileage: srcage = fileage # use latest modification date
+      if os.path.exists(filepath): filelist.append(filepath)
+      elif lcheck: raise IOError, "Source file '{:s}' does not exist!".format(filepath)        
+  # return list of files
+  return filelist
+
+def getSourceAge(filelist=None, fileclasses=None, filetypes=None, exp=None, domain=None,
+                 periodstr=None, gridstr=None, lclim=None, lts=None):
+  ''' function to to get the latest modification date of a set of filetypes '''
+  srcage = datetime.fromordinal(1) # the beginning of time (proleptic Gregorian calendar)
+  filelist = getSourceFiles(filelist=filelist, fileclasses=fileclasses, filetypes=filetypes, exp=exp, domain=domain,
+                            periodstr=periodstr, gridstr=gridstr, lclim=lclim, lts=lts)
+  for filepath in filelist:
+    # determine age of source file
+    fileage = datetime.fromtimestamp(os.path.getmtime(filepath))          
+    if srcage < fileage: srcage = fileage # use latest modification date
   # return latest modification date
   return srcage
 
@@ -290,6 +300,36 @@ def getMetaData(dataset, mode, dataargs, lone=True):
   # return meta data
   return dataargs, loadfct, srcage, datamsgstr    
 
+def getJobCost(dataset, mode, dataargs):
+  ''' estimate the cost of a processing job as the total size of its source files (in bytes), for 
+      scheduling with asyncPoolEC; only file paths are assembled (datasets are not loaded or opened in 
+      the parent process); missing files (e.g. multi-file datasets) count as 0 '''
+  if mode[-5:] == '-mean': mode = 'climatology' # same as in getMetaData
+  lclim = mode == 'climatology'; lts = mode == 'time-series'
+  grid = dataargs.get('grid',None); period = dataargs.get('period',None)
+  try:
+    if dataset in ('WRF','CESM'):
+      module = import_module('datasets.{0:s}'.format(dataset))
+      exp = dataargs['experiment']; filetypes = dataargs['filetypes']
+      domain = dataargs.get('domain',None) if dataset == 'WRF' else None
+      fileclasses = module.fileclasses.copy()
+      for filetype in filetypes:
+        if filetype not in fileclasses: fileclasses[filetype] = module.FileType(filetype)
+      periodstr, gridstr = getPeriodGridString(period, grid, exp=exp)
+      filelist = getSourceFiles(fileclasses=fileclasses, filetypes=filetypes, exp=exp, domain=domain,
+                                periodstr=periodstr, gridstr=gridstr, lclim=lclim, lts=lts, lcheck=False)
+    else:
+      # observational datasets: only the default file name is considered
+      module = import_module('datasets.{0:s}'.format(dataset))
+      resolution = dataargs.get('resolution',None)
+      if resolution: obs_res = '{0:s}_{1:s}'.format(module.dataset_name,resolution)
+      else: obs_res = module.dataset_name
+      filename = getFileName(grid=grid, period=period, name=obs_res, filetype=mode)
+      filelist = getSourceFiles(filelist=['{:s}/{:s}'.format(module.avgfolder,filename)], lcheck=False)
+  except Exception: # e.g. invalid arguments; errors will be reported when the job is processed
+    return 0
+  return sum(os.path.getsize(filepath) for filepath in filelist)
+
 
 if __name__ == '__main__':
     pass
\ No newline at end of file
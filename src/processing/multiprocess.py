@@ -9,13 +9,19 @@ A simple script to test the usage of pool and how to return values...
 
 import multiprocessing
 import logging
+import resource # for peak memory usage
 import sys
 import gc # garbage collection
 import types
 import os
+import shutil
+import tempfile
 import numpy as np
 from datetime import datetime
-from time import sleep
+from time import sleep, time
+# internal imports (the worker pool and shared arrays are also used by the datasets package)
+from utils.parallel import shared_folder, worker_pool, getSharedFolder, getWorkerPool, closeWorkerPool
+from utils.parallel import shared_rows_worker, shared_fill_rows
 
 
 ## test functions
@@ -34,6 +40,28 @@ def test_noaax(arr, axis=0, kw=0):
   std = np.std(arr,axis=axis).reshape(shape)
   return (arr - mean) / std -kw
 
+def test_int_fct(arr, axis=1): # integer results for the chunk with the first row only
+  return arr.mean(axis=axis) if arr[0,0] > 0 else np.zeros(len(arr), dtype='int')
+
+def benchmark_aax(shape=(500,500,360), NP=None, chunksize=None):
+  ''' compare the shared-memory and the legacy (pickling) implementation of apply_along_axis using a 
+      two-sample Kolmogorov-Smirnov test along the last axis (two samples of equal size) '''
+  import functools
+  from geodata.stats import ks_2samp_wrapper # import here, to avoid circular import
+  if NP is None: NP = multiprocessing.cpu_count()
+  data = np.random.randn(*shape)
+  if chunksize is None: chunksize = 500000//len(data) # same as in apply_stat_test_2samp
+  fct = functools.partial(ks_2samp_wrapper, size1=shape[-1]//2)
+  print('\n   ***   Benchmark: ks_2samp on {:s} array, NP={:d}, chunksize={:d}   ***\n'.format(str(shape),NP,chunksize))
+  results = []
+  for lshared,name in ((False,'legacy (pickled chunks)'),(True,'shared memory (new pool)'),(True,'shared memory (reused pool)')):
+    t0 = time()
+    results.append(apply_along_axis(fct, data.ndim-1, data, NP=NP, chunksize=chunksize, lshared=lshared))
+    print('   {:30s} {:8.2f} s'.format(name, time()-t0))
+  assert all(np.array_equal(res, results[0]) for res in results[1:])
+  closeWorkerPool()
+  return results[0]
+
 
 def test_func(n, wait=None, queue=None):
   global global_var
@@ -146,14 +174,51 @@ class TrialNError():
       return 1 # indicate failure
 
 
-def asyncPoolEC(func, args, kwargs, NP=1, ldebug=False, ltrialnerror=True):
+# a decorator class that records job statistics for functions inside asyncPool_EC
+class JobStats():
+  ''' 
+    A decorator class that records the wall time, the peak memory usage (RSS) of the worker process 
+    and the exit code of a pool worker function; the job ID is passed as the first argument. 
+  '''
+  
+  def __init__(self, func):
+    ''' Save original function in decorator class. '''
+    self.func = func
+    
+  def __call__(self, jobid, *args, **kwargs):
+    ''' execute decorated function and return a dictionary with job statistics '''
+    t0 = time()
+    ec = self.func(*args, **kwargs)
+    # N.B.: the peak RSS is the maximum over the lifetime of the worker process (in kB on Linux); 
+    #       it only applies to an individual job, if maxtasksperchild=1
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return dict(job=jobid, ec=ec or 0, time=time()-t0, rss=rss, pid=os.getpid())
+
+def jobString(arguments, maxlen=60):
+  ''' a short string representation of the arguments of a job, for the summary '''
+  strlist = []
+  for arg in arguments:
+    if isinstance(arg,(basestring,int,float,np.number)): strlist.append(str(arg))
+    elif hasattr(arg,'name') and isinstance(arg.name,basestring): strlist.append(arg.name)
+    elif isinstance(arg,dict): 
+      strlist += [str(getattr(arg[key],'name',arg[key])) for key in ('experiment','filetypes','grid','period','resolution') 
+                  if arg.get(key,None) is not None]
+  string = ', '.join(strlist)
+  return string if len(string) <= maxlen else string[:maxlen-3]+'...'
+
+def asyncPoolEC(func, args, kwargs, NP=1, ldebug=False, ltrialnerror=True, costs=None, maxtasksperchild=None, 
+                lstats=False):
   ''' 
     A function that executes func with arguments args (len(args) times) on NP number of processors;
     args must be a list of argument tuples; kwargs are keyword arguments to func, which do not change
     between calls.
     Func is assumed to take a keyword argument lparallel to indicate parallel execution, and return 
     a common exit status (0 = no error, > 0 for an error code).
-    This function returns the number of failures as the exit code. 
+    If cost estimates are given for each job (e.g. source file size), jobs are submitted in order of 
+    decreasing cost, so that idle workers pick up the remaining smaller jobs (largest-first scheduling);
+    maxtasksperchild limits the number of jobs per worker process (to contain memory leaks).
+    This function returns the number of failures as the exit code; wall time, peak memory (RSS) and exit 
+    code of each job are reported in a summary and returned as well, if lstats=True.
   '''
   # input checking
   if not isinstance(func,types.FunctionType): raise TypeError
@@ -162,6 +227,8 @@ def asyncPoolEC(func, args, kwargs, NP=1, ldebug=False, ltrialnerror=True):
   if NP is not None and not isinstance(NP,int): raise TypeError
   if not isinstance(ldebug,(bool,np.bool)): raise TypeError
   if not isinstance(ltrialnerror,(bool,np.bool)): raise TypeError
+  if costs is not None and len(costs) != len(args): raise ValueError, 'Need one cost estimate for each job!'
+  if maxtasksperchild is not None and not isinstance(maxtasksperchild,int): raise TypeError
   
   # figure out if running parallel
   if NP is not None and NP == 1: lparallel = False
@@ -198,25 +265,27 @@ def asyncPoolEC(func, args, kwargs, NP=1, ldebug=False, ltrialnerror=True):
 #   sublogger.addHandler(sch)
 #   kwargs['logger'] = sublogger.name
   
-  # apply decorator
+  # apply decorators
   if ltrialnerror: func = TrialNError(func)
+  func = JobStats(func) # also records job ID
+  # job order: largest first (if costs are available), otherwise order of submission
+  if costs is None: order = range(len(args))
+  else: order = sorted(range(len(args)), key=lambda i: -costs[i]) # stable sort
   
   # print first logging message
   logger.info(datetime.today())
   logger.info('\nTHREADS: {0:s}, DEBUG: {1:s}\n'.format(str(NP),str(ldebug)))
-  exitcodes = [] # list of results  
+  jobstats = [] # list of results  
   def callbackEC(result):
     # custom callback function that appends the results to the list
-    exitcodes.append(result)
+    jobstats.append(result)
   ## loop over and process all job sets
   if lparallel:
     # create pool of workers   
-    pool = multiprocessing.Pool(processes=NP) # NP=None uses all available CPUs
-    # distribute tasks to workers
-    for arguments in args:
-      #exitcodes.append(pool.apply_async(func, arguments, kwargs))
-      #print arguments      
-      pool.apply_async(func, arguments, kwargs, callback=callbackEC) 
+    pool = multiprocessing.Pool(processes=NP, maxtasksperchild=maxtasksperchild) # NP=None uses all available CPUs
+    # distribute tasks to workers (workers take the next job from the queue, when they are done)
+    for i in order:
+      pool.apply_async(func, (i,)+tuple(args[i]), kwargs, callback=callbackEC) 
       # N.B.: we do not record result objects, since we have callback, which just extracts the exitcodes
     # wait until pool and queue finish
     pool.close()
@@ -224,12 +293,14 @@ def asyncPoolEC(func, args, kwargs, NP=1, ldebug=False, ltrialnerror=True):
     logger.debug('\n   ***   all processes joined   ***   \n')
   else:
     # don't parallelize, if there is only one process: just loop over files    
-    for arguments in args:       
-      exitcodes.append(func(*arguments, **kwargs))
+    for i in order:       
+      jobstats.append(func(i, *args[i], **kwargs))
     
   # evaluate exit codes    
+  jobstats.sort(key=lambda stats: stats['job']) # order of submission
   exitcode = 0
-  for ec in exitcodes:
+  for stats in jobstats:
+    ec = stats['ec']
     #if lparallel: ec = ec.get() # not necessary, if callback is used
     if ec < 0: raise ValueError, 'Exit codes have to be zero or positive!' 
     elif ec > 0: ec = 1
@@ -239,6 +310,11 @@ def asyncPoolEC(func, args, kwargs, NP=1, ldebug=False, ltrialnerror=True):
   nop = len(args) - exitcode
   
   # print summary (to log)
+  summary = '\n   {:>4s}  {:>3s}  {:>10s}  {:>9s}  {:s}'.format('Job','EC','Time [s]','RSS [MB]','Arguments')
+  for stats in jobstats:
+    summary += '\n   {:4d}  {:3d}  {:10.1f}  {:9.1f}  {:s}'.format(stats['job'], stats['ec'], stats['time'], 
+                                                                   stats['rss']/1024., jobString(args[stats['job']]))
+  logger.info(summary+'\n')
   if exitcode == 0:
     logger.info('\n   >>>   All {:d} operations completed successfully!!!   <<<   \n'.format(nop))
   else:
@@ -246,15 +322,77 @@ def asyncPoolEC(func, args, kwargs, NP=1, ldebug=False, ltrialnerror=True):
           '\n   ###   {:2d} operations did not complete/failed!   ###   \n'.format(exitcode))
   logger.info(datetime.today())
   # return with exit code
-  return exitcode
+  if lstats: return exitcode, jobstats
+  else: return exitcode
 
-def apply_along_axis(fct, axis, data, NP=0, chunksize=200, ldebug=False, laax=True, *args, **kwargs):
+## shared (memory-mapped) arrays and a persistent worker pool for apply_along_axis
+
+# N.B.: the persistent worker pool and shared_fill_rows are implemented in utils.parallel (imported above)
+
+def shared_aax_worker(fct, i0, i1, inpath=None, inshape=None, indtype=None, outpath=None, outshape=None, 
+                      outdtype=None, laax=True, args=(), kwargs=None):
+  ''' worker function: apply fct to rows i0:i1 of the shared input array and write the results directly 
+      to the shared output array; only file names and offsets are passed to the worker '''
+  # N.B.: the input is opened copy-on-write, so that fct can not modify it
+  indata = np.memmap(inpath, dtype=indtype, mode='c', shape=inshape)
+  outdata = np.memmap(outpath, dtype=outdtype, mode='r+', shape=outshape)
+  if laax: outdata[i0:i1] = np.apply_along_axis(fct, 1, indata[i0:i1], *args, **kwargs)
+  else: outdata[i0:i1] = fct(indata[i0:i1], *args, **kwargs)
+  outdata.flush(); del indata, outdata
+  return i1 - i0
+
+def shared_apply_along_axis(fct, data, cs, nc, NP=None, laax=True, outdtype=None, ldebug=False, args=(), kwargs=None):
+  ''' apply fct to nc chunks (of size cs) of rows of a 2D array, using the persistent worker pool; input 
+      and (preallocated) output are shared through memory-mapped files; the output dtype is outdtype or,
+      if None, the input dtype (promoted, if necessary, to hold the result for the first row); returns 
+      None, if the output can not be stored in a memory-mapped array (object dtype) '''
+  arraysize = data.shape[0]
+  # determine shape of output from the first row
+  if laax: probe = np.apply_along_axis(fct, 1, data[:1], *args, **kwargs)
+  else: probe = fct(data[:1], *args, **kwargs)
+  probe = np.asarray(probe)
+  if probe.dtype.hasobject: return None
+  outshape = (arraysize,)+probe.shape[1:]
+  # N.B.: the dtype of a single row is not reliable (e.g. integer results for some rows only)
+  if outdtype is None: outdtype = np.result_type(data.dtype, probe.dtype)
+  else: outdtype = np.dtype(outdtype)
+  del probe
+  if outdtype.hasobject: return None
+  nbytes = data.nbytes + int(np.prod(outshape))*outdtype.itemsize
+  tmpdir = tempfile.mkdtemp(prefix='aax_', dir=getSharedFolder(nbytes))
+  try:
+    # write input and allocate output
+    inpath = os.path.join(tmpdir,'input.dat'); outpath = os.path.join(tmpdir,'output.dat')
+    indata = np.memmap(inpath, dtype=data.dtype, mode='w+', shape=data.shape)
+    indata[:] = data; indata.flush(); del indata
+    outdata = np.memmap(outpath, dtype=outdtype, mode='w+', shape=outshape); del outdata
+    # distribute offsets to workers
+    pool = getWorkerPool(NP)
+    shared = dict(inpath=inpath, inshape=data.shape, indtype=data.dtype, outpath=outpath, outshape=outshape, 
+                  outdtype=outdtype, laax=laax, args=args, kwargs=kwargs)
+    results = []
+    for n in xrange(nc):
+      if ldebug: print('   Starting Chunk #{:d}'.format(n+1))
+      results.append(pool.apply_async(shared_aax_worker, (fct, n*cs, min((n+1)*cs,arraysize)), shared))
+    for result in results: result.get() # wait for workers and raise errors
+    if ldebug: print('\n   ***   all chunks completed (reading results)   ***\n')
+    # copy results into memory
+    results = np.array(np.memmap(outpath, dtype=outdtype, mode='r', shape=outshape))
+  finally:
+    shutil.rmtree(tmpdir, ignore_errors=True)
+  return results
+
+def apply_along_axis(fct, axis, data, NP=0, chunksize=200, ldebug=False, laax=True, lshared=False, outdtype=None, 
+                     *args, **kwargs):
   ''' a parallelized version of numpy's apply_along_axis; the preferred way of passing arguments is,
       by using functools.partial, but arguments can also be passed to this function; the call-signature
       is the same as for np.apply_along_axis, except for NP=OMP_NUM_THREADS, chunksize=200, 
-      ldebug=False, and laax=True; the latter can be set to False, if fct is fully vectorized and only
-      the parallelization feature is required, otherwise Numpy's apply_along_axis will be called within
-      child processes. '''  
+      ldebug=False, laax=True, lshared=False and outdtype=None; laax can be set to False, if fct is fully 
+      vectorized and only the parallelization feature is required, otherwise Numpy's apply_along_axis will 
+      be called within child processes; if lshared is True, data are shared with a persistent worker pool 
+      through memory-mapped files (in /dev/shm, if there is enough space), otherwise chunks are pickled and 
+      a new pool is started for every call; outdtype is the dtype of the shared output array (default: 
+      input dtype, promoted if necessary). '''  
   if NP == 0: NP = int(os.environ['OMP_NUM_THREADS'])
   # pre-processing: move sampel axis to the back
   if not axis == data.ndim-1:
@@ -287,26 +425,34 @@ def apply_along_axis(fct, axis, data, NP=0, chunksize=200, ldebug=False, laax=Tr
       nc = int(arraysize//chunksize) # number of chunks; use integer division
       if arraysize%chunksize != 0: nc += 1
       cs = chunksize
-    chunks = [data[i*cs:(i+1)*cs,:] for i in xrange(nc)] # views on subsets of the data
-    # initialize worker pool
-    if ldebug: print('\n   ***   firing up pool (using async results)   ***')
-    if ldebug: print('         OMP_NUM_THREADS = {:d}\n'.format(NP))
-    pool = multiprocessing.Pool(processes=NP)
-    results = [] # list of resulting chunks (concatenated later    
-    for n in xrange(nc):
-      # run computation on individual subsets/chunks
-      if ldebug: print('   Starting Chunk #{:d}'.format(n+1))
-      if laax: # use Numpy's apply_along_axis
-        result = pool.apply_async(np.apply_along_axis, (fct,1,chunks[n],)+args, kwargs)
-      else: # for ufunc-like functions that can operate on multi-dimensional arrays
-        result = pool.apply_async(fct, (chunks[n],)+args, kwargs)
-      results.append(result)
-    pool.close()
-    pool.join()
-    if ldebug: print('\n   ***   joined worker pool (getting results)   ***\n')
-    # retrieve and assemble results 
-    results = tuple(result.get() for result in results)
-    results = np.concatenate(results, axis=0) 
+    results = None
+    if lshared and not data.dtype.hasobject:
+      # share data through memory-mapped files with the persistent worker pool
+      if ldebug: print('\n   ***   using persistent pool and shared arrays   ***')
+      results = shared_apply_along_axis(fct, data, cs, nc, NP=NP, laax=laax, outdtype=outdtype, ldebug=ldebug, 
+                                        args=args, kwargs=kwargs)
+      # N.B.: returns None, if results can not be shared; fall back to pickled chunks
+    if results is None:
+      chunks = [data[i*cs:(i+1)*cs,:] for i in xrange(nc)] # views on subsets of the data
+      # initialize worker pool
+      if ldebug: print('\n   ***   firing up pool (using async results)   ***')
+      if ldebug: print('         OMP_NUM_THREADS = {:d}\n'.format(NP))
+      pool = multiprocessing.Pool(processes=NP)
+      results = [] # list of resulting chunks (concatenated later    
+      for n in xrange(nc):
+        # run computation on individual subsets/chunks
+        if ldebug: print('   Starting Chunk #{:d}'.format(n+1))
+        if laax: # use Numpy's apply_along_axis
+          result = pool.apply_async(np.apply_along_axis, (fct,1,chunks[n],)+args, kwargs)
+        else: # for ufunc-like functions that can operate on multi-dimensional arrays
+          result = pool.apply_async(fct, (chunks[n],)+args, kwargs)
+        results.append(result)
+      pool.close()
+      pool.join()
+      if ldebug: print('\n   ***   joined worker pool (getting results)   ***\n')
+      # retrieve and assemble results 
+      results = tuple(result.get() for result in results)
+      results = np.concatenate(results, axis=0) 
   # check and reshape
   assert results.shape[0] == arraysize
   if results.ndim == 1: # if the second dimension was reduced to a scalar
@@ -359,6 +505,9 @@ if __name__ == '__main__':
   run_test(nolaax, kw=1, laax=False) # without Numpy's apply_along_axis
   run_test(func1, kw=1, laax=True) # Numpy's apply_along_axis
   
+  # benchmark shared-memory and legacy apply_along_axis (ks_2samp on a large array)
+#   benchmark_aax(shape=(500,500,360), NP=NP)
+  
   #print logging.DEBUG,logging.INFO,logging.WARNING,logging.ERROR,logging.CRITICAL
     
   #test_mq(test_func, NP)
@@ -15,13 +15,21 @@ import numpy.ma as ma
 import functools
 import shutil
 import gc
+import hashlib # for station index cache keys
+import multiprocessing, threading
+import collections as col
+from multiprocessing.pool import ThreadPool
+import netCDF4 as nc
+import scipy.sparse as sparse
+from scipy.spatial import cKDTree
 from osgeo import gdal, osr
 # internal imports
 from geodata.misc import VariableError, AxisError, PermissionError, DatasetError, GDALError, ArgumentError #, DateError
 from geodata.base import Axis, Dataset, Variable
-from geodata.netcdf import DatasetNetCDF, asDatasetNC
+from geodata.netcdf import DatasetNetCDF, asDatasetNC, VarNC
 from utils.nctools import writeNetCDF
-from geodata.gdal import addGDALtoDataset, GridDefinition, gdalInterp, Shape
+from geodata.gdal import addGDALtoDataset, addGDALtoVar, GridDefinition, gdalInterp, Shape, sphericalMetric,\
+  getRegridWeights, regrid_methods
 from collections import OrderedDict
 # default data types
 dtype_int = np.dtype('int16')
@@ -31,6 +39,241 @@ class ProcessError(Exception):
   ''' Error class for exceptions occurring in methods of the CPU (CentralProcessingUnit). '''
   pass
 
+
+## helper functions for vectorized shape averaging
+
+def shapeWeights(masks, griddef=None, metric=None):
+  ''' Construct a sparse weight matrix of shape (n_shapes, n_gridpoints) from a stack of 2D shape masks 
+      in (y,x) order (True/1 for points inside the shape); masks can also contain fractional weights. 
+      If metric is 'lat', the spherical metric is applied (requires a geographic GridDefinition); 
+      a 1D (y) or 2D (y,x) array can also be passed as metric. '''
+  masks = np.asarray(masks, dtype=np.float64) # also converts boolean masks
+  if masks.ndim != 3: raise ArgumentError("Expected a stack of 2D masks; got array of shape {}".format(masks.shape))
+  nshp,ny,nx = masks.shape
+  # apply metric
+  if metric is not None and metric is not False:
+    if isinstance(metric,basestring):
+      if metric[:3].lower() == 'lat' and griddef is not None and not griddef.isProjected:
+        metric = sphericalMetric(griddef.ylat, integral=False, asVar=False)
+      else: raise NotImplementedError("Special keyword for metric not recognized: '{}'".format(metric))
+    elif isinstance(metric,Variable): metric = metric.getArray(unmask=True, fillValue=0)
+    metric = np.asarray(metric, dtype=np.float64)
+    if metric.ndim == 1: metric = metric.reshape((ny,1)) # latitude-dependent metric
+    if metric.shape not in ((ny,1),(ny,nx)): raise AxisError("Metric is incompatible with masks: {} != {}".format(metric.shape,(ny,nx)))
+    masks = masks * metric # broadcast along x and shapes
+  # N.B.: the normalization of the metric cancels out when the weighted average is computed
+  # convert to sparse matrix (zero entries are not stored)
+  return sparse.csr_matrix(masks.reshape((nshp,ny*nx)))
+
+def sparseShapeAverage(weights, data):
+  ''' Compute the weighted averages over all shapes for all leading dimensions at once; 'weights' is 
+      a sparse matrix of shape (n_shapes, n_gridpoints) and data has to be an array with the flattened 
+      horizontal dimensions as the last axis, i.e. (..., n_gridpoints); masked and NaN values are 
+      excluded by normalizing with the weight-sum of valid points. Returns an array of shape 
+      (n_shapes, ...) with NaN where a shape contains no valid points. '''
+  outshape = (weights.shape[0],)+data.shape[:-1]
+  data = data.reshape((-1,data.shape[-1])) # (bands, gridpoints)
+  if data.shape[-1] != weights.shape[1]: raise AxisError("Weights and data are incompatible: {} != {}".format(weights.shape,data.shape))
+  # separate values and valid points
+  if isinstance(data,ma.MaskedArray) and data.mask is not ma.nomask:
+    valid = ~ma.getmaskarray(data); values = data.filled(0)
+  else: valid = None; values = np.asarray(data)
+  if np.issubdtype(values.dtype,np.inexact):
+    nans = np.isnan(values)
+    if nans.any():
+      valid = ~nans if valid is None else np.logical_and(valid,~nans)
+      values = np.where(nans, 0, values)
+    del nans
+  # weighted sums over all shapes and bands (one sparse matrix product)
+  sums = weights.dot(values.T) # (shapes, bands)
+  # normalization: weight-sum of valid points (parallel sparse product) or just the row sums
+  if valid is None: norm = np.asarray(weights.sum(axis=1)) # (shapes,1) - broadcasts
+  else: norm = weights.dot(valid.T.astype(weights.dtype)) # (shapes, bands)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    avgdata = np.where(norm > 0, sums / norm, np.NaN) # NaN if no valid values or no overlap
+  # return with bands unraveled
+  return avgdata.reshape(outshape)
+
+
+## helper function for vectorized station extraction
+
+extract_cache = dict() # in-memory cache of station indices, keyed by station coordinates and grid
+
+def stationIndices(lons, lats, xlon=None, ylat=None, zs=None, stn_zs=None, laltcorr=True):
+  ''' Find the grid points corresponding to stations for all stations at once; if 'laltcorr' is True 
+      and elevation fields are given, the point with the smallest elevation error is selected among 
+      the four surrounding points, otherwise the horizontally closest point. Stations outside of the 
+      grid are omitted. Returns ixlon, iylat, istn and zs_err (empty, if no elevation fields are given). '''
+  lzs = zs is not None and stn_zs is not None
+  if laltcorr and lzs:
+    ip = xlon.getIndexArray(lons, mode='left', outOfBounds=True)
+    jp = ylat.getIndexArray(lats, mode='left', outOfBounds=True)
+    istn = np.where(np.logical_and(ip >= 0, jp >= 0))[0]
+    ip = ip[istn]; jp = jp[istn]
+    im = np.where(ip > 0, ip-1, ip); jm = np.where(jp > 0, jp-1, jp)
+    # check four closest grid points (in the same order as the original loop, so that ties are resolved
+    # in the same way: argmin returns the first minimum)
+    ci = np.stack((im,im,ip,ip)); cj = np.stack((jm,jp,jm,jp))
+    zerr = zs[cj,ci] - stn_zs[istn] # compute elevation error
+    sel = np.argmin(np.abs(zerr), axis=0); n = np.arange(len(istn))
+    ixlon = ci[sel,n]; iylat = cj[sel,n]; zs_err = zerr[sel,n]
+  else: 
+    # just choose horizontally closest point 
+    i = xlon.getIndexArray(lons, mode='closest', outOfBounds=True)
+    j = ylat.getIndexArray(lats, mode='closest', outOfBounds=True)
+    istn = np.where(np.logical_and(i >= 0, j >= 0))[0]
+    ixlon = i[istn]; iylat = j[istn]
+    if lzs: zs_err = zs[iylat,ixlon] - stn_zs[istn] # compute elevation error
+    else: zs_err = []
+  ixlon = np.asarray(ixlon, dtype='int'); iylat = np.asarray(iylat, dtype='int')
+  istn = np.asarray(istn, dtype='int'); zs_err = np.asarray(zs_err, dtype='float')
+  return ixlon, iylat, istn, zs_err
+
+def axisWeights(axis, values):
+  ''' Find the two coordinates that bracket each value and the linear interpolation weight of the 
+      second one; values outside the coordinate range are assigned to the closest coordinate. '''
+  coord = axis.coord; n = len(coord)
+  if not axis.ascending: coord = coord[::-1]
+  i1 = np.clip(coord.searchsorted(values, side='right'), 1, n-1); i0 = i1 - 1
+  w1 = np.clip(( values - coord[i0] ) / ( coord[i1] - coord[i0] ), 0., 1.)
+  if not axis.ascending: i0 = n-1-i0; i1 = n-1-i1 # flip again
+  return i0, i1, w1
+
+def stationWeights(lons, lats, xlon=None, ylat=None, interpolation='bilinear', nidw=4, power=2., lgeographic=False):
+  ''' Construct a sparse weight matrix of shape (n_stations, n_gridpoints) that interpolates gridded 
+      data (flattened (y,x) order) to station locations, either bilinear or with inverse distance 
+      weighting of the 'nidw' closest grid points (great-circle distance, if 'lgeographic' is True); 
+      weights are not normalized (cf. sparseShapeAverage). '''
+  lons = np.asarray(lons, dtype=np.float64); lats = np.asarray(lats, dtype=np.float64)
+  nstn = len(lons); nx = len(xlon); ny = len(ylat)
+  if interpolation == 'bilinear':
+    i0,i1,wi = axisWeights(xlon, lons); j0,j1,wj = axisWeights(ylat, lats)
+    rows = np.tile(np.arange(nstn), 4)
+    cols = np.concatenate((j0*nx+i0, j0*nx+i1, j1*nx+i0, j1*nx+i1))
+    data = np.concatenate(((1-wi)*(1-wj), wi*(1-wj), (1-wi)*wj, wi*wj))
+  elif interpolation == 'idw':
+    x2D, y2D = np.meshgrid(xlon.coord, ylat.coord)
+    if lgeographic: # Cartesian coordinates on the unit sphere (chord length is monotonic in distance)
+      toXYZ = lambda lon,lat: np.column_stack((np.cos(np.deg2rad(lat))*np.cos(np.deg2rad(lon)), 
+                                               np.cos(np.deg2rad(lat))*np.sin(np.deg2rad(lon)), np.sin(np.deg2rad(lat))))
+      grdpts = toXYZ(x2D.ravel(), y2D.ravel()); stnpts = toXYZ(lons, lats)
+    else: 
+      grdpts = np.column_stack((x2D.ravel(), y2D.ravel())); stnpts = np.column_stack((lons, lats))
+    dist, cols = cKDTree(grdpts).query(stnpts, k=nidw)
+    dist = dist.reshape((nstn,nidw)); cols = cols.reshape((nstn,nidw))
+    with np.errstate(divide='ignore'):
+      data = np.where(dist[:,:1] == 0, dist == 0, 1./dist**power) # exact hits only use that point
+    rows = np.repeat(np.arange(nstn), nidw); cols = cols.ravel(); data = data.ravel()
+  else: raise ArgumentError("Unknown interpolation method for station extraction: '{}'".format(interpolation))
+  weights = sparse.csr_matrix((data,(rows,cols)), shape=(nstn,ny*nx)) # duplicates are summed
+  weights.eliminate_zeros()
+  return weights
+
+def stationIndexKey(lons, lats, xlon=None, ylat=None, zs=None, stn_zs=None, laltcorr=True):
+  ''' construct a key that identifies a set of station indices (station coordinates and elevation, 
+      grid coordinates and elevation field) '''
+  md5 = hashlib.md5()
+  for arr in (lons, lats, xlon.coord, ylat.coord, zs, stn_zs):
+    if arr is not None: md5.update(np.ascontiguousarray(arr))
+    md5.update('|')
+  md5.update(str(laltcorr))
+  return md5.hexdigest()
+
+
+## helper function for vectorized climatologies
+
+def cycleSums(data, interval=12, axis=0, lvalid=False):
+  ''' Sum the records of a time-series by their position in the cycle (e.g. month of the year), using 
+      a reshaped view, so that only one vectorized pass is necessary; the time-series has to start at 
+      the beginning of a cycle, but can have any length. Returns the sums (masked where any record was 
+      masked), the number of records for each element of the cycle and, if 'lvalid' is True, the 
+      number of valid (not masked and not NaN) records at each point (otherwise None). '''
+  data = np.rollaxis(data, axis) # time axis first
+  if isinstance(data,ma.MaskedArray) and data.mask is not ma.nomask:
+    mask = ma.getmaskarray(data); data = data.filled(0)
+  else: mask = None; data = np.asarray(data)
+  nrec = data.shape[0]; ncyc = nrec//interval; nfull = ncyc*interval; nrem = nrec-nfull
+  # cycle-wise sums of complete cycles (reshaped view) and remaining records
+  def cycsum(a, dtype):
+    s = np.zeros((interval,)+a.shape[1:], dtype=dtype)
+    if ncyc > 0: s += a[:nfull].reshape((ncyc,interval)+a.shape[1:]).sum(axis=0, dtype=dtype)
+    if nrem > 0: s[:nrem] += a[nfull:]
+    return s
+  sums = cycsum(data, data.dtype)
+  if mask is not None: sums = ma.array(sums, mask=cycsum(mask, dtype_int) > 0)
+  cnt = np.zeros(interval, dtype=dtype_int); cnt += ncyc; cnt[:nrem] += 1
+  if lvalid:
+    valid = np.ones(data.shape, dtype=np.bool) if mask is None else ~mask
+    if np.issubdtype(data.dtype,np.inexact): valid &= ~np.isnan(data)
+    valid = np.rollaxis(cycsum(valid, dtype_int), 0, axis+1)
+  else: valid = None
+  # move time axis back into place
+  return np.rollaxis(sums, 0, axis+1), cnt, valid
+
+
+## helper function for per-variable parallelism
+
+pool_state = dict() # CPU instance and processing function; inherited by forked worker processes
+
+class TargetProxy(object):
+  ''' A stand-in for the target dataset, while variables are processed by workers (see processConcurrently): 
+      variables that processing functions add to the target (e.g. count variables) are recorded for the 
+      calling thread, so that the parent can add them in order; everything else is passed to the target. '''
+  def __init__(self, target):
+    self.__dict__['target'] = target
+    self.__dict__['_local'] = threading.local() # one record per worker thread
+  def record(self):
+    ''' start a new record for the calling thread '''
+    self._local.added = []
+  def added(self):
+    ''' return the variables that were added since the last call to record (and the arguments) '''
+    return self._local.added
+  def addVariable(self, var, **kwargs):
+    ''' record variable, instead of adding it to the target '''
+    self._local.added.append((var,kwargs))
+    return True
+  def __getattr__(self, attr): return getattr(self.target, attr)
+  def __setattr__(self, attr, value): setattr(self.target, attr, value)
+
+def packVariable(var, **kwargs):
+  ''' return a picklable representation of a variable (with data and GDAL grid definition) '''
+  var.load() # just to make sure
+  return dict(name=var.name, units=var.units, atts=dict(var.atts), data=var.data_array, dtype=var.dtype,
+              axes=tuple([ax.name for ax in var.axes]), fillValue=var.fillValue, kwargs=kwargs,
+              griddef=var.griddef if var.__dict__.get('gdal',False) else None)
+
+def unpackVariable(result, axes=None):
+  ''' reconstruct a Variable from a packed representation (see packVariable); axes is a dictionary of axes '''
+  var = Variable(name=result['name'], units=result['units'], axes=tuple([axes[axname] for axname in result['axes']]), 
+                 data=result['data'], dtype=result['dtype'], fillValue=result['fillValue'], atts=result['atts'])
+  if result['griddef'] is not None: var = addGDALtoVar(var, griddef=result['griddef'])
+  return var
+
+def processVariable(function, var, target):
+  ''' Apply function to a variable and return the result, as well as all variables that were added to the 
+      target (a TargetProxy) by the function (and the arguments). '''
+  target.record()
+  newvar = function(var) # perform actual processing
+  return newvar, target.added()
+
+def processVariableWorker(varname, filepath=None, ncname=None):
+  ''' Worker function for process pools: reopen the NetCDF source file by path, process the variable 
+      with the function in pool_state, and return picklable representations of the result and of all 
+      variables that were added to the target. '''
+  cpu = pool_state['cpu']; function = pool_state['function']
+  var = cpu.source.variables[varname]
+  if filepath is not None:
+    # N.B.: NetCDF file handles are closed before forking and can not be shared with the parent process
+    ncds = nc.Dataset(filepath, mode='r')
+    var.__dict__['ncvar'] = ncds.variables[ncname] # replace inherited handle
+  try:
+    newvar, added = processVariable(function, var, cpu.target)
+    results = [packVariable(newvar)] + [packVariable(addvar, **kwargs) for addvar,kwargs in added]
+  finally:
+    if filepath is not None: ncds.close()
+  return results
+
+
 class CentralProcessingUnit(object):
   
   def __init__(self, source, target=None, varlist=None, ignorelist=None, tmp=True, feedback=True):
@@ -120,8 +363,11 @@ class CentralProcessingUnit(object):
     if close: output.close()
     else: return output
 
-  def process(self, function, flush=False):
-    ''' This method applies the desired operation/function to each variable in varlist. '''
+  def process(self, function, flush=False, executor=None, NP=None):
+    ''' This method applies the desired operation/function to each variable in varlist. 
+        If 'executor' is 'process' or 'thread', variables from the source dataset are processed 
+        concurrently by NP workers (default: all cores), while results are written to the target 
+        in the order of varlist by the parent (see processConcurrently). '''
     if flush: # this function is to save RAM by flushing results to disk immediately
       if not isinstance(self.output,DatasetNetCDF):
         raise ProcessError("Flush can only be used with NetCDF Datasets (and not with temporary storage).\n{:}".format(self.output))
@@ -133,8 +379,15 @@ class CentralProcessingUnit(object):
           self.output = addGDALtoDataset(self.output, griddef=self.target.griddef, lforce=True)
         self.target = self.output
         self.tmp = False # not using temporary storage anymore
+    # process variables concurrently (except "in-place" operations)
+    varlist = self.varlist
+    if executor is not None and NP != 1:
+      parlist = [varname for varname in varlist if varname not in self.ignorelist and 
+                 self.source.hasVariable(varname) and not self.target.hasVariable(varname)]
+      self.processConcurrently(function, varlist=parlist, executor=executor, NP=NP, flush=flush)
+      varlist = [varname for varname in varlist if varname not in parlist]
     # loop over input variables
-    for varname in self.varlist:
+    for varname in varlist:
       # check agaisnt ignore list
       if varname not in self.ignorelist:
         try: 
@@ -159,17 +412,7 @@ class CentralProcessingUnit(object):
             srcds = self.source # need to define for error message below
             raise DatasetError("Variable '{:s}' not found in input dataset.".format(varname))
         except Exception, err:
-          if hasattr(srcds, 'filelist') and srcds.filelist and len(srcds.filelist) == 1:              
-            filename = srcds.filelist[0] # should be the absolute path
-            print("ERROR: an error occurred while processing Variable '{:s}' from source file '{:s}'.".format(varname,filename))
-            if 'NetCDF: HDF error' in str(err):
-              backup = filename + '.HDFerror'
-              print("HDF Error: moving source file to '{:s}'".format(backup))
-              shutil.move(filename, backup)
-              # N.B.: this error occurs when files are corrupted; moving them to a backup destination 
-              #       will cause the files to be downloaded again
-          else:
-            print("ERROR: an error occurred while processing Variable '{:s}' from Dataset '{:s}'.".format(varname,srcds.name))
+          self.reportError(varname, srcds, err)
           raise # raise previous exception
         assert varname == newvar.name
         # flush data to disk immediately      
@@ -180,6 +423,99 @@ class CentralProcessingUnit(object):
     # after everything is said and done:
     self.source = self.target # set target to source for next time
     
+  def reportError(self, varname, srcds, err):
+    ''' Print an error message for a variable; if a NetCDF source file is corrupted (HDF error), it is 
+        moved to a backup location. '''
+    if hasattr(srcds, 'filelist') and srcds.filelist and len(srcds.filelist) == 1:              
+      filename = srcds.filelist[0] # should be the absolute path
+      print("ERROR: an error occurred while processing Variable '{:s}' from source file '{:s}'.".format(varname,filename))
+      if 'NetCDF: HDF error' in str(err):
+        backup = filename + '.HDFerror'
+        print("HDF Error: moving source file to '{:s}'".format(backup))
+        shutil.move(filename, backup)
+        # N.B.: this error occurs when files are corrupted; moving them to a backup destination 
+        #       will cause the files to be downloaded again
+    else:
+      print("ERROR: an error occurred while processing Variable '{:s}' from Dataset '{:s}'.".format(varname,srcds.name))
+    
+  def processConcurrently(self, function, varlist=None, executor='process', NP=None, flush=False):
+    ''' Apply function to variables from the source dataset with a pool of workers; the parent 
+        writes results to the target dataset, so that all writes are serialized. While workers are 
+        active, the target is replaced by a TargetProxy, which records variables that the function 
+        adds to the target; these are added by the parent after the result.
+          'process'  NetCDF files are closed before worker processes are forked and reopened 
+                     afterwards; workers reopen source files by path and return the data of the 
+                     result and of added variables (including GDAL grid definitions); this 
+                     requires fork (i.e. not Windows)
+          'thread'   source variables are loaded by the parent and processed by a thread pool; 
+                     this is useful for operations that release the GIL, e.g. ReprojectImage 
+        At most 2*NP variables are in flight, in order to limit memory usage. '''
+    if varlist is None: varlist = self.varlist
+    if NP is None: NP = multiprocessing.cpu_count()
+    if executor not in ('process','thread'): raise ArgumentError("Unknown executor: '{}'".format(executor))
+    target = self.target; proxy = TargetProxy(target)
+    self.target = proxy # processing functions only see the proxy
+    try:
+      if executor == 'process':
+        pool_state['cpu'] = self; pool_state['function'] = function # inherited by worker processes
+        # close NetCDF files before forking (HDF5 handles can not be shared) and reopen afterwards
+        ncdatasets = []
+        for ds in (self.input, self.source, self.output, target):
+          if ( isinstance(ds,DatasetNetCDF) and all(ds is not ncds for ncds in ncdatasets) and ds.filelist and 
+               len(ds.filelist) == len(ds.datasets) and not any(isinstance(ncds,nc.MFDataset) for ncds in ds.datasets) ):
+            ncdatasets.append(ds)
+        for ds in ncdatasets: ds.close()
+        try: pool = multiprocessing.Pool(processes=NP)
+        finally: 
+          for ds in ncdatasets: ds.reopen()
+      else: 
+        pool = ThreadPool(processes=NP)
+      # submit variables to pool
+      queue = col.deque(); variter = iter(varlist)
+      def submit():
+        varname = next(variter, None)
+        if varname is None: return # all submitted
+        var = self.source.variables[varname]; ldata = var.data
+        if executor == 'process':
+          if isinstance(var,VarNC) and not ldata: 
+            args = (varname, var.ncvar.group().filepath(), var.ncvar._name) 
+          else: args = (varname,)
+          result = pool.apply_async(processVariableWorker, args)
+        else:
+          var.load() # read in parent, since NetCDF/HDF5 are not thread-safe
+          result = pool.apply_async(processVariable, (function, var, proxy))
+        queue.append((varname,var,ldata,result))
+      for i in xrange(2*NP): submit()
+      # collect results and write to target (in order)
+      try:
+        while queue:
+          varname,var,ldata,result = queue.popleft()
+          try:
+            if executor == 'process': 
+              results = result.get()
+              axes = dict(self.source.axes); axes.update(target.axes) # target axes have precedence
+              newvar = unpackVariable(results[0], axes=axes)
+              added = [(unpackVariable(res, axes=axes),res['kwargs']) for res in results[1:]]
+            else:
+              newvar, added = result.get()
+              if not ldata: var.unload() # if it was already loaded, don't unload
+            submit() # keep workers busy, while writing
+            target.addVariable(newvar, copy=True) # copy=True allows recasting as, e.g., a NC variable
+            newvar.unload() # since we already made a copy
+            for addvar,kwargs in added: target.addVariable(addvar, **kwargs) # e.g. count variables
+          except Exception, err:
+            self.reportError(varname, self.source, err)
+            raise # raise previous exception
+          assert varname == newvar.name
+          # flush data to disk immediately      
+          if flush: self.output.variables[varname].unload()
+          del var, newvar, added # free space; already added to new dataset
+      finally:
+        pool.close(); pool.terminate(); pool.join()
+    finally:
+      self.target = target
+      pool_state.clear()
+    
     
   ## functions (or function pairs, rather) that perform operations on the data
   # every function pair needs to have a setup function and a processing function
@@ -187,14 +523,21 @@ class CentralProcessingUnit(object):
   
   # function pair to average data over a given collection of shapes      
   def ShapeAverage(self, shape_dict=None, shape_name=None, shpax=None, xlon=None, ylat=None, 
-                   memory=500, **kwargs):
+                   lsparse=True, metric=None, supersample=None, memory=500, **kwargs):
     ''' Average over a limited area of a gridded datasets; calls processAverageShape. 
         A dictionary of NamedShape objects is expected to define the averaging areas. 
-        'memory' controls the garbage collection interval and approximately corresponds 
-        to MB in temporary (it does not include loading the variable into RAM, though). '''
+        If 'lsparse' is True, all shapes are averaged at once, using a sparse weight matrix; 
+        'metric' can be used to apply a metric to the weights ('lat' is the default for 
+        geographic grids, as in mapMean; use False to disable).
+        If a 'supersample' factor is given, the fractional coverage of grid cells is computed 
+        by supersampled rasterization and used as weights (only with lsparse=True). 
+        'memory' only applies to the legacy (non-sparse) method; it controls the garbage 
+        collection interval and approximately corresponds to MB in temporary (it does not 
+        include loading the variable into RAM, though). '''
     if not self.source.gdal: raise DatasetError("Source dataset must be GDAL enabled! {:s} is not.".format(self.source.name))
     if not isinstance(shape_dict,OrderedDict): raise TypeError(shape_dict)
     if not all(isinstance(shape,Shape) for shape in shape_dict.itervalues()): raise TypeError(shape)
+    if supersample and not lsparse: raise ArgumentError("Fractional coverage weights require the sparse method (lsparse=True).")
     # make temporary dataset
     if self.source is self.target:
       if self.tmp: assert self.source == self.tmpput and self.target == self.tmpput
@@ -252,26 +595,38 @@ class CentralProcessingUnit(object):
     # collect rasterized masks from shape files 
     mask_array = np.zeros((len(shpax),)+srcgrd.size[::-1], dtype=np.bool) 
     # N.B.: rasterize() returns mask in (y,x) shape, size is ordered as (x,y)
+    if supersample: frac_array = np.zeros((len(shpax),)+srcgrd.size[::-1], dtype=np.float32)
+    else: frac_array = mask_array # just binary masks
     shape_masks = []; shp_full = []; shp_empty = []; shp_encl = []
     for i,shape in enumerate(shape_dict.itervalues()):
-      mask = shape.rasterize(griddef=srcgrd, asVar=False, invert=False)
+      # N.B.: rasterized masks are cached, so that they don't have to be recomputed for every dataset
+      if supersample: 
+        frac = shape.rasterize(griddef=srcgrd, asVar=False, invert=False, supersample=supersample)
+        frac_array[i,:] = frac
+        mask = frac >= 0.5 # approximately equivalent to the default cell center criterion
+      else: mask = frac = shape.rasterize(griddef=srcgrd, asVar=False, invert=False)
       mask_array[i,:] = mask
-      masksum = mask.sum() 
-      lfull = masksum == mask.size; shp_full.append( lfull )
+      masksum = frac.sum() 
+      lfull = masksum == frac.size; shp_full.append( lfull )
       lempty = masksum == 0; shp_empty.append( lempty )
       shape_masks.append( mask if not lempty else None )
       if lempty: shp_encl.append( False )
       else:
-        shp_encl.append( np.all( mask[[0,-1],:] == False ) and np.all( mask[:,[0,-1]] == False ) )
+        shp_encl.append( np.all( frac[[0,-1],:] == 0 ) and np.all( frac[:,[0,-1]] == 0 ) )
         # i.e. if boundaries are masked
     # N.B.: shapes that have no overlap with grid will be skipped and filled with NaN
     # add rasterized masks to new dataset
     atts = dict(name='shp_mask', long_name='Rasterized Shape Mask', units='')
     tgt.addVariable(Variable(data=mask_array, atts=atts, axes=(shpax,srcgrd.ylat.copy(),srcgrd.xlon.copy())), 
                     asNC=True, copy=True)
+    if supersample:
+      atts = dict(name='shp_frac', long_name='Fractional Coverage of Grid Cells by Shape', units='', 
+                  supersample=supersample)
+      tgt.addVariable(Variable(data=frac_array, atts=atts, axes=(shpax,srcgrd.ylat.copy(),srcgrd.xlon.copy())), 
+                      asNC=True, copy=True)
     # add area enclosed by shape
     da = srcgrd.geotransform[1]*srcgrd.geotransform[5]
-    mask_area = mask_array.mean(axis=2).mean(axis=1)*da
+    mask_area = frac_array.mean(axis=2).mean(axis=1)*da
     atts = dict(name='shp_area', long_name='Area Contained in the Shape', 
                 units= 'm^2' if srcgrd.isProjected else 'deg^2' )
     tgt.addVariable(Variable(data=mask_area, axes=(shpax,), atts=atts), asNC=True, copy=True)
@@ -286,9 +641,14 @@ class CentralProcessingUnit(object):
     tgt.addVariable(Variable(data=shp_empty, axes=(shpax,), atts=atts), asNC=True, copy=True)
     # save all the meta data
     tgt.sync()
+    # construct sparse weight matrix for all shapes (only once)
+    if lsparse:
+      if metric is None and not srcgrd.isProjected: metric = 'lat' # default for spherical coordinates
+      weights = shapeWeights(frac_array, griddef=srcgrd, metric=metric)
+    else: weights = None
     # prepare function call    
-    function = functools.partial(self.processShapeAverage, masks=shape_masks, ylat=ylat, xlon=xlon, 
-                                 shpax=shpax, memory=memory) # already set parameters
+    function = functools.partial(self.processShapeAverage, masks=shape_masks, weights=weights, ylat=ylat, 
+                                 xlon=xlon, shpax=shpax, memory=memory) # already set parameters
     # start process
     if self.feedback: print('\n   +++   processing shape/area averaging   +++   ') 
     self.process(function, **kwargs) # currently 'flush' is the only kwarg
@@ -296,9 +656,10 @@ class CentralProcessingUnit(object):
     if self.tmp: self.tmpput = self.target
     if ltmptoo and self.tmp: assert self.tmpput.name == 'tmptoo' # set above, when temp. dataset is created    
   # the previous method sets up the process, the next method performs the computation
-  def processShapeAverage(self, var, masks=None, ylat=None, xlon=None, shpax=None, memory=500):
-    ''' Compute masked area averages from variable data. 'memory' controls the garbage collection 
-        interval approximately corresponds to MB in RAM.'''
+  def processShapeAverage(self, var, masks=None, weights=None, ylat=None, xlon=None, shpax=None, memory=500):
+    ''' Compute masked area averages from variable data. If a sparse weight matrix is passed, all 
+        shapes are averaged in one pass; otherwise masks are applied one by one and 'memory' controls 
+        the garbage collection interval approximately corresponds to MB in RAM.'''
     # process gdal variables (if a variable has a horiontal grid, it should be GDAL enabled)
     if var.gdal and ( np.issubdtype(var.dtype,np.integer) or np.issubdtype(var.dtype,np.inexact) ):
       if self.feedback: print('\n'+var.name),
@@ -325,11 +686,21 @@ class CentralProcessingUnit(object):
         varname = var.name
         print '\n ... averaging ',varname 
       ## compute shape averages for each time step
+      if weights is not None:
+        # The horizontal axes are moved to the back and flattened, so that the averages for all shapes 
+        # and all other dimensions (e.g. time) can be computed with a single sparse matrix product. 
+        if var.ndim < 2: raise AxisError(var)
+        assert weights.shape == (len(masks),len(ylat)*len(xlon))
+        iy = var.axisIndex(ylat.name); ix = var.axisIndex(xlon.name)
+        order = [i for i in xrange(var.ndim) if i not in (iy,ix)] + [iy,ix]
+        srcdata = var.getArray(unmask=False, copy=False).transpose(order)
+        tgtdata[:] = sparseShapeAverage(weights, srcdata.reshape(srcdata.shape[:-2]+(len(ylat)*len(xlon),)))
+        del srcdata; mask = None # for clean-up below
       # Basically, for each shape the entire array is masked, using the shape and the broadcasting 
       # functionality for horizontal masks of the Variable class (which creates a lot of overhead);
       # then the masked average is taken and the process is repeated for the next shape/mask.
       # Using mapMean creates a lot of overhead and there are probably more efficient ways to do it. 
-      if var.ndim == 2:
+      elif var.ndim == 2:
         for i,mask in enumerate(masks): 
           if mask is None: tgtdata[i] = np.NaN # NaN for missing values (i.e. no overlap)
           else: tgtdata[i] = var.mapMean(mask=mask, invert=True, asVar=False, squeeze=True) # compute the averages
@@ -361,9 +732,16 @@ class CentralProcessingUnit(object):
     # return variable
     return newvar
   # function pair to extract station data from a time-series (or climatology)      
-  def Extract(self, template=None, stnax=None, xlon=None, ylat=None, laltcorr=True, **kwargs):
+  def Extract(self, template=None, stnax=None, xlon=None, ylat=None, laltcorr=True, lvectorize=True, 
+              interpolation=None, nidw=4, memory=None, **kwargs):
     ''' Extract station data points from gridded datasets; calls processExtract. 
-        A station dataset can be passed as template (must have station coordinates. '''
+        A station dataset can be passed as template (must have station coordinates. 
+        If 'lvectorize' is True, station indices are computed for all stations at once and cached 
+        for the station template and grid; otherwise stations are processed one at a time. 
+        With interpolation='bilinear' or 'idw' (inverse distance weighting of the 'nidw' closest points), 
+        station values are interpolated (integer variables still use the nearest point) and the 
+        largest weight and number of points for each station are added as 'wgt_max' and 'wgt_cnt'. 
+        Large NetCDF variables are streamed from file, if they exceed 'memory' (in MB). '''
     if not self.source.gdal: raise DatasetError("Source dataset must be GDAL enabled! {:s} is not.".format(self.source.name))
     if template is None: raise NotImplementedError()
     elif isinstance(template, Dataset):
@@ -413,12 +791,16 @@ class CentralProcessingUnit(object):
       latlon = osr.SpatialReference() 
       latlon.SetWellKnownGeogCS('WGS84') # a normal lat/lon coordinate system
       tx = osr.CoordinateTransformation(latlon,srcgrd.projection)
-      xs = []; ys = [] 
-      for i in xrange(len(lons)):
-        x,y,z = tx.TransformPoint(lons[i].astype(np.float64),lats[i].astype(np.float64))
-        xs.append(x); ys.append(y); del z
-      lons = np.array(xs); lats = np.array(ys)
-      #lons,lats = tx.TransformPoints(lons,lats) # doesn't seem to work...
+      if lvectorize:
+        point_array = np.column_stack((lons,lats)).astype(np.float64) # all points at once
+        point_array = np.asarray(tx.TransformPoints(point_array), dtype=np.float64)
+        lons = point_array[:,0]; lats = point_array[:,1]; del point_array
+      else:
+        xs = []; ys = [] 
+        for i in xrange(len(lons)):
+          x,y,z = tx.TransformPoint(lons[i].astype(np.float64),lats[i].astype(np.float64))
+          xs.append(x); ys.append(y); del z
+        lons = np.array(xs); lats = np.array(ys)
     else:
       if lons.min() < 0. and xlon.coord.max() > 180.: lons = np.where(lons < 0., lons + 360., lons)
       elif lons.max() > 180. and xlon.coord.min() < 0.: lons = np.where(lons > 180., 360.-lons, lons)
@@ -427,7 +809,19 @@ class CentralProcessingUnit(object):
     ixlon = []; iylat = []; istn = []; zs_err = [] # also record elevation error
     lzs = src.hasVariable('zs')
     lstnzs = template.hasVariable('zs') or  template.hasVariable('stn_zs')
-    if laltcorr and lzs and lstnzs:
+    if lvectorize:
+      zs = None; stn_zs = None
+      if lzs and lstnzs:
+        if src.zs.ndim > 2: src.zs = src.zs(time=0, lidx=True) # first time-slice (for CESM)
+        if src.zs.ndim != 2 or not src.gdal or src.zs.units != 'm': raise VariableError(src)
+        zs = src.zs.getArray(unmask=True,fillValue=-300)
+        if template.hasVariable('zs'): stn_zs = template.zs.getArray(unmask=True,fillValue=-300)
+        else: stn_zs = template.stn_zs.getArray(unmask=True,fillValue=-300)
+      key = stationIndexKey(lons, lats, xlon=xlon, ylat=ylat, zs=zs, stn_zs=stn_zs, laltcorr=laltcorr)
+      if key not in extract_cache:
+        extract_cache[key] = stationIndices(lons, lats, xlon=xlon, ylat=ylat, zs=zs, stn_zs=stn_zs, laltcorr=laltcorr)
+      ixlon, iylat, istn, zs_err = extract_cache[key]
+    elif laltcorr and lzs and lstnzs:
       if src.zs.ndim > 2: src.zs = src.zs(time=0, lidx=True) # first time-slice (for CESM)
       if src.zs.ndim != 2 or not src.gdal or src.zs.units != 'm': raise VariableError(src)
       # consider altidue of surrounding points as well      
@@ -466,6 +860,20 @@ class CentralProcessingUnit(object):
     # N.B.: it is necessary to append, because we don't know the number of valid points
     ixlon = np.array(ixlon, dtype='int'); iylat = np.array(iylat, dtype='int')
     istn = np.array(istn, dtype='int'); zs_err = np.array(zs_err, dtype='float')
+    # interpolation weights for the same stations
+    if interpolation is None or interpolation == 'nearest': weights = None
+    else:
+      weights = stationWeights(lons[istn], lats[istn], xlon=xlon, ylat=ylat, interpolation=interpolation, 
+                               nidw=nidw, lgeographic=not srcgrd.isProjected)
+      if len(zs_err) > 0: # elevation error of interpolated elevation
+        zs = src.zs.getArray(unmask=True,fillValue=-300)
+        if template.hasVariable('zs'): stn_zs = template.zs.getArray(unmask=True,fillValue=-300)
+        else: stn_zs = template.stn_zs.getArray(unmask=True,fillValue=-300)
+        zs_err = sparseShapeAverage(weights, zs.ravel()) - stn_zs[istn]
+      # weight diagnostics
+      wgt_sum = np.asarray(weights.sum(axis=1)).ravel()
+      wgt_max = weights.max(axis=1).toarray().ravel() / wgt_sum # largest normalized weight
+      wgt_cnt = np.diff(weights.indptr) # number of interpolation points
     # prepare target dataset
     # N.B.: attributes should already be set in target dataset (by caller module)
     #       we are also assuming the new dataset has no axes yet
@@ -483,6 +891,14 @@ class CentralProcessingUnit(object):
       zs_err = Variable(name='zs_err', units='m', data=zs_err, axes=(newstnax,),
                         atts=dict(long_name='Station Elevation Error'))
       tgt.addVariable(zs_err, asNC=True, copy=True); del zs_err # need to copy to make NC var
+    # create variables for weight diagnostics
+    if weights is not None:
+      wgt_max = Variable(name='wgt_max', units='', data=wgt_max, axes=(newstnax,),
+                         atts=dict(long_name='Largest Interpolation Weight ({:s})'.format(interpolation)))
+      tgt.addVariable(wgt_max, asNC=True, copy=True); del wgt_max
+      wgt_cnt = Variable(name='wgt_cnt', units='#', data=wgt_cnt.astype(dtype_int), axes=(newstnax,),
+                         atts=dict(long_name='Number of Interpolation Points ({:s})'.format(interpolation)))
+      tgt.addVariable(wgt_cnt, asNC=True, copy=True); del wgt_cnt
     # add a bunch of other variables with station meta data
     for var in template.variables.itervalues():
       if var.ndim == 1 and var.hasAxis(stnax): # station attributes
@@ -495,7 +911,8 @@ class CentralProcessingUnit(object):
     # save all the meta data
     tgt.sync()
     # prepare function call    
-    function = functools.partial(self.processExtract, ixlon=ixlon, iylat=iylat, ylat=ylat, xlon=xlon, stnax=stnax) # already set parameters
+    function = functools.partial(self.processExtract, ixlon=ixlon, iylat=iylat, ylat=ylat, xlon=xlon, stnax=stnax, 
+                                 weights=weights, memory=memory) # already set parameters
     # start process
     if self.feedback: print('\n   +++   processing point-data extraction   +++   ') 
     self.process(function, **kwargs) # currently 'flush' is the only kwarg
@@ -503,8 +920,9 @@ class CentralProcessingUnit(object):
     if self.tmp: self.tmpput = self.target
     if ltmptoo and self.tmp: assert self.tmpput.name == 'tmptoo' # set above, when temp. dataset is created    
   # the previous method sets up the process, the next method performs the computation
-  def processExtract(self, var, ixlon=None, iylat=None, ylat=None, xlon=None, stnax=None):
-    ''' Extract grid poitns corresponding to stations. '''
+  def processExtract(self, var, ixlon=None, iylat=None, ylat=None, xlon=None, stnax=None, weights=None, memory=None):
+    ''' Extract grid poitns corresponding to stations; if a sparse weight matrix is passed, station values 
+        are interpolated, except for integer variables. Large VarNC instances are streamed from file. '''
     # process gdal variables (if a variable has a horiontal grid, it should be GDAL enabled)
     if var.gdal:
       if self.feedback: print('\n'+var.name),
@@ -518,22 +936,43 @@ class CentralProcessingUnit(object):
           axes.append(tgt.getAxis(ax.name))
       axes = tuple(axes)
       shape = tuple(len(ax) for ax in axes)
-      srcdata = var.getArray(copy=False) # don't make extra copy
-      # roll x & y axes to the front (xlon first, then ylat, then the rest)
-      srcdata = np.rollaxis(srcdata, axis=var.axisIndex(ylat.name), start=0)
-      srcdata = np.rollaxis(srcdata, axis=var.axisIndex(xlon.name), start=0)
-      assert srcdata.shape == (len(xlon),len(ylat))+shape[1:]
-      # here we extract the data points
-      if srcdata.ndim == 2:
-        tgtdata = srcdata[ixlon,iylat] # constructed above
-      elif srcdata.ndim > 2:
-        tgtdata = srcdata[ixlon,iylat,:] # constructed above
-      else: raise AxisError(srcdata)
+      iy = var.axisIndex(ylat.name); ix = var.axisIndex(xlon.name)
+      lweights = weights is not None and not np.issubdtype(var.dtype, np.integer)
+      def extract(srcdata):
+        if lweights:
+          # move y & x axes to the end and interpolate all stations at once (sparse matrix product)
+          order = [i for i in xrange(srcdata.ndim) if i not in (iy,ix)] + [iy,ix]
+          srcdata = srcdata.transpose(order)
+          srcdata = srcdata.reshape(srcdata.shape[:-2]+(srcdata.shape[-2]*srcdata.shape[-1],))
+          tgtdata = sparseShapeAverage(weights, srcdata) # stations are the first axis
+          if isinstance(srcdata,ma.MaskedArray): tgtdata = ma.masked_invalid(tgtdata)
+          return tgtdata.astype(var.dtype)
+        # roll x & y axes to the front (xlon first, then ylat, then the rest)
+        srcdata = np.rollaxis(srcdata, axis=iy, start=0)
+        srcdata = np.rollaxis(srcdata, axis=ix, start=0)
+        assert srcdata.shape[:2] == (len(xlon),len(ylat))
+        # here we extract the data points
+        if srcdata.ndim == 2:
+          return srcdata[ixlon,iylat] # constructed above
+        elif srcdata.ndim > 2:
+          return srcdata[ixlon,iylat,:] # constructed above
+        else: raise AxisError(srcdata)
+      if isinstance(var,VarNC) and var.ndim > 2 and var.checkStream(memory=memory):
+        # read blocks along the first non-horizontal axis (e.g. time) and extract from each block
+        iax = min(i for i in xrange(var.ndim) if i not in (iy,ix))
+        tgtlist = [extract(srcdata) for i0,srcdata in var.iterBlocks(axis=iax, memory=memory)]
+        # N.B.: the block axis is the first axis after the station axis
+        if any(isinstance(tgtdata,ma.MaskedArray) for tgtdata in tgtlist): tgtdata = ma.concatenate(tgtlist, axis=1)
+        else: tgtdata = np.concatenate(tgtlist, axis=1)
+        del tgtlist
+      else:
+        srcdata = var.getArray(copy=False) # don't make extra copy
+        tgtdata = extract(srcdata); del srcdata
       #try: except: print srcdata.shape, [slc.max() for slc in slices] 
       # create new Variable
       assert shape == tgtdata.shape
       newvar = var.copy(axes=axes, data=tgtdata) # new axes and data
-      del srcdata, tgtdata # clean up (just to make sure)      
+      del tgtdata # clean up (just to make sure)      
     else:
       var.load() # need to load variables into memory, because we are not doing anything else...
       newvar = var # just pass over the variable to the new dataset
@@ -542,8 +981,13 @@ class CentralProcessingUnit(object):
     
   # function pair to compute a climatology from a time-series      
   def Regrid(self, griddef=None, projection=None, geotransform=None, size=None, xlon=None, ylat=None, 
-             lmask=True, int_interp=None, float_interp=None, **kwargs):
-    ''' Setup climatology and start computation; calls processClimatology. '''
+             lmask=True, int_interp=None, float_interp=None, lplan=True, supersample=None, **kwargs):
+    ''' Setup regridding and start computation; calls processRegrid. 
+        If 'lplan' is True, variables are regridded with precomputed sparse weights, if the interpolation 
+        method is supported ('nearest', 'bilinear' or 'average'); the weights are computed once for each 
+        pair of grids and cached in memory and next to the pickled grids. Other methods use GDAL. 
+        N.B.: by default this applies to integer variables ('nearest'); the float defaults ('convolution' 
+              or 'cubicspline') are not supported, so 'float_interp' has to be set to use plans. '''
     # make temporary gdal dataset
     if self.source is self.target:
       if self.tmp: assert self.source == self.tmpput and self.target == self.tmpput
@@ -605,15 +1049,16 @@ class CentralProcessingUnit(object):
       lwrapSrc = False # no need to shift, if a projected grid is involved!
       lwrapTgt = False # no need to shift, if a projected grid is involved!
     # determine GDAL interpolation
-    if int_interp is None: int_interp = gdalInterp('nearest')
-    else: int_interp = gdalInterp(int_interp)
+    if int_interp is None: int_interp = 'nearest'
     if float_interp is None:
-      if srcres < tgtres: float_interp = gdalInterp('convolution') # down-sampling: 'convolution'
-      else: float_interp = gdalInterp('cubicspline') # up-sampling
-    else: float_interp = gdalInterp(float_interp)      
+      if srcres < tgtres: float_interp = 'convolution' # down-sampling: 'convolution'
+      else: float_interp = 'cubicspline' # up-sampling
+    # regridding plans (sparse weights are computed when they are first needed)
+    if lplan: plans = dict(srcgrd=srcgrd, tgtgrd=griddef, supersample=supersample)
+    else: plans = None
     # prepare function call    
     function = functools.partial(self.processRegrid, ylat=ylat, xlon=xlon, lwrapSrc=lwrapSrc, lwrapTgt=lwrapTgt, # already set parameters
-                                 lmask=lmask, int_interp=int_interp, float_interp=float_interp)
+                                 lmask=lmask, int_interp=int_interp, float_interp=float_interp, plans=plans)
     # start process
     if self.feedback: print('\n   +++   processing regridding   +++   ') 
     self.process(function, **kwargs) # currently 'flush' is the only kwarg
@@ -623,8 +1068,9 @@ class CentralProcessingUnit(object):
     if self.tmp: self.tmpput = self.target
     if ltmptoo and self.tmp: assert self.tmpput.name == 'tmptoo' # set above, when temp. dataset is created    
   # the previous method sets up the process, the next method performs the computation
-  def processRegrid(self, var, ylat=None, xlon=None, lwrapSrc=False, lwrapTgt=False, lmask=True, int_interp=None, float_interp=None):
-    ''' Compute a climatology from a variable time-series. '''
+  def processRegrid(self, var, ylat=None, xlon=None, lwrapSrc=False, lwrapTgt=False, lmask=True, int_interp=None, 
+                    float_interp=None, plans=None):
+    ''' Regrid a variable to the target grid, either with GDAL or using regridding plans (sparse weights). '''
     # process gdal variables
     if var.gdal:
       if self.feedback: print('\n'+var.name),
@@ -635,30 +1081,47 @@ class CentralProcessingUnit(object):
       # create new Variable
       var.load() # most rebust way to determine the dtype! and we need it later anyway
       newvar = var.copy(axes=axes, data=None, projection=self.target.projection) # and, of course, load new data
-      # if necessary, shift array back, to ensure proper wrapping of coordinates
-      # prepare regridding
-      # get GDAL dataset instances
-      srcdata = var.getGDAL(load=True, wrap360=lwrapSrc)
-      tgtdata = newvar.getGDAL(load=False, wrap360=lwrapTgt, allocate=True, fillValue=var.fillValue)
       # determine GDAL interpolation
       if 'gdal_interp' in var.__dict__: gdal_interp = var.gdal_interp
       elif 'gdal_interp' in var.atts: gdal_interp = var.atts['gdal_interp'] 
       else: # use default based on variable type
         if np.issubdtype(var.dtype, np.integer): gdal_interp = int_interp # can't process logicals anyway...
         else: gdal_interp = float_interp                          
-      # perform regridding
-      err = gdal.ReprojectImage(srcdata, tgtdata, var.projection.ExportToWkt(), newvar.projection.ExportToWkt(), gdal_interp)
-      #print srcdata.ReadAsArray().std(), tgtdata.ReadAsArray().std()
-      #print var.projection.ExportToWkt()
-      #print newvar.projection.ExportToWkt()
-      del srcdata # clean up (just to make sure)
-      # N.B.: the target array should be allocated and prefilled with missing values, otherwise ReprojectImage
-      #       will just fill missing values with zeros!  
-      if err != 0: raise GDALError('ERROR CODE {:}'.format(err))
-      #tgtdata.FlushCash()  
-      # load data into new variable
-      newvar.loadGDAL(tgtdata, mask=lmask, wrap360=lwrapTgt, fillValue=var.fillValue)      
-      del tgtdata # clean up (just to make sure)
+      if plans is not None and gdal_interp in regrid_methods and var.axisIndex(var.ylat) == var.ndim-2 and var.axisIndex(var.xlon) == var.ndim-1:
+        # apply sparse weights to all bands at once (no GDAL datasets or wrapping necessary)
+        weights = getRegridWeights(plans['srcgrd'], plans['tgtgrd'], interpolation=gdal_interp, 
+                                   supersample=plans['supersample'], lcache=True)
+        srcdata = var.getArray(unmask=False)
+        tgtdata = sparseShapeAverage(weights, srcdata.reshape(srcdata.shape[:-2]+(srcdata.shape[-2]*srcdata.shape[-1],)))
+        del srcdata # clean up
+        tgtdata = np.rollaxis(tgtdata, 0, tgtdata.ndim).reshape(newvar.shape) # target points are the first axis
+        invalid = np.isnan(tgtdata) # no valid source points
+        fillValue = var.fillValue if var.fillValue is not None else ma.default_fill_value(var.dtype)
+        if np.issubdtype(var.dtype, np.integer): tgtdata = np.round(tgtdata)
+        tgtdata[invalid] = fillValue
+        tgtdata = tgtdata.astype(var.dtype)
+        if lmask: tgtdata = ma.array(tgtdata, mask=invalid)
+        newvar.load(tgtdata)
+      else:
+        if isinstance(gdal_interp,basestring): gdal_interp = gdalInterp(gdal_interp)
+        # if necessary, shift array back, to ensure proper wrapping of coordinates
+        # prepare regridding
+        # get GDAL dataset instances
+        srcdata = var.getGDAL(load=True, wrap360=lwrapSrc)
+        tgtdata = newvar.getGDAL(load=False, wrap360=lwrapTgt, allocate=True, fillValue=var.fillValue)
+        # perform regridding
+        err = gdal.ReprojectImage(srcdata, tgtdata, var.projection.ExportToWkt(), newvar.projection.ExportToWkt(), gdal_interp)
+        #print srcdata.ReadAsArray().std(), tgtdata.ReadAsArray().std()
+        #print var.projection.ExportToWkt()
+        #print newvar.projection.ExportToWkt()
+        del srcdata # clean up (just to make sure)
+        # N.B.: the target array should be allocated and prefilled with missing values, otherwise ReprojectImage
+        #       will just fill missing values with zeros!  
+        if err != 0: raise GDALError('ERROR CODE {:}'.format(err))
+        #tgtdata.FlushCash()  
+        # load data into new variable
+        newvar.loadGDAL(tgtdata, mask=lmask, wrap360=lwrapTgt, fillValue=var.fillValue)      
+        del tgtdata # clean up (just to make sure)
     else:
       var.load() # need to load variables into memory, because we are not doing anything else...
       newvar = var # just pass over the variable to the new dataset
@@ -666,8 +1129,12 @@ class CentralProcessingUnit(object):
     return newvar
   
   # function pair to compute a climatology from a time-series      
-  def Climatology(self, timeAxis='time', climAxis=None, period=None, offset=0, shift=0, timeSlice=None, **kwargs):
-    ''' Setup climatology and start computation; calls processClimatology. '''
+  def Climatology(self, timeAxis='time', climAxis=None, period=None, offset=0, shift=0, timeSlice=None, 
+                  memory=None, lcount=False, **kwargs):
+    ''' Setup climatology and start computation; calls processClimatology. 
+        NetCDF variables that are not loaded and exceed 'memory' (in MB; default: 
+        geodata.netcdf.stream_memory) are streamed from file in blocks of complete years. 
+        If 'lcount' is True, the number of valid records for each month is added as '<var>_cnt'. '''
     if period is not None and not isinstance(period,(np.integer,int)): raise TypeError(period) # period in years
     if not isinstance(offset,(np.integer,int)): raise TypeError(offset) # offset in years (from start of record)
     if not isinstance(shift,(np.integer,int)): raise TypeError(shift) # shift in month (if first month is not January)
@@ -693,7 +1160,8 @@ class CentralProcessingUnit(object):
       if var.hasAxis(timeAxis) and var.dtype.kind == 'S': self.ignorelist.append(varname)
     # prepare function call
     function = functools.partial(self.processClimatology, # already set parameters
-                                 timeAxis=timeAxis, climAxis=climAxis, timeSlice=timeSlice, shift=shift)
+                                 timeAxis=timeAxis, climAxis=climAxis, timeSlice=timeSlice, shift=shift,
+                                 memory=memory, lcount=lcount)
     # start process
     if self.feedback: print('\n   +++   processing climatology   +++   ')     
     if self.source.gdal: griddef = self.source.griddef
@@ -705,7 +1173,8 @@ class CentralProcessingUnit(object):
     # N.B.: if the dataset is empty, it wont do anything, hence we do it now    
     if self.feedback: print('\n')    
   # the previous method sets up the process, the next method performs the computation
-  def processClimatology(self, var, timeAxis='time', climAxis=None, timeSlice=None, shift=0):
+  def processClimatology(self, var, timeAxis='time', climAxis=None, timeSlice=None, shift=0, memory=None, 
+                         lcount=False):
     ''' Compute a climatology from a variable time-series. '''
     # process variable that have a time axis
     if var.hasAxis(timeAxis):
@@ -716,50 +1185,44 @@ class CentralProcessingUnit(object):
       newshape = list(var.shape)
       newshape[tidx] = interval # shape of the climatology field  
       if not (interval == 12): raise NotImplementedError(interval)
-      # load data
-      if timeSlice is not None:
-        idx = tuple([timeSlice if ax.name == timeAxis else slice(None) for ax in var.axes])
-      else: idx = None
-      dataarray = var.getArray(unmask=False, copy=False)[idx]
-      if var.masked: avgdata = ma.zeros(newshape, dtype=var.dtype) # allocate array
-      else: avgdata = np.zeros(newshape, dtype=var.dtype) # allocate array    
-      # average data
-      timelength = dataarray.shape[tidx]
-      if timelength % interval == 0:
-        # use array indexing
-        climelts = np.arange(interval, dtype=dtype_int)
-        for t in xrange(0,timelength,interval):
-          if self.feedback: print('.'), # t/interval+1
-          avgdata += dataarray.take(t+climelts, axis=tidx)
-        del dataarray # clean up
-        # normalize
-        avgdata /= (timelength/interval) 
+      # data source: stream blocks of complete cycles from file, or load the entire time-series
+      if timeSlice is None: timeSlice = slice(None)
+      start, stop, step = timeSlice.indices(var.shape[tidx])
+      if isinstance(var,VarNC) and step == 1 and var.checkStream(memory=memory): # strided slices are loaded
+        blocks = var.iterBlocks(axis=tidx, start=start, stop=stop, blkmul=interval, memory=memory)
       else: 
-        # simple indexing
-        climcnt = np.zeros(interval, dtype=dtype_int)
-        for t in xrange(timelength):
-          if self.feedback and t%interval == 0: print('.'), # t/interval+1
-          idx = int(t%interval)
-          climcnt[idx] += 1
-          if dataarray.ndim == 1:
-            avgdata[idx] = avgdata[idx] + dataarray[t]
-          else: 
-            avgdata[idx,:] = avgdata[idx,:] + dataarray[t,:]
+        idx = tuple([timeSlice if ax.name == timeAxis else slice(None) for ax in var.axes])
+        blocks = [(0,var.getArray(unmask=False, copy=False)[idx])] # just one block
+      # accumulate sums over cycles (one vectorized pass per block)
+      avgdata = None; validcnt = None
+      climcnt = np.zeros(interval, dtype=dtype_int)
+      for t,dataarray in blocks:
+        if self.feedback: print('.'), # one dot per block
+        sums, cnt, valid = cycleSums(dataarray, interval=interval, axis=tidx, lvalid=lcount)
         del dataarray # clean up
-        # normalize
-        for i in xrange(interval):
-          if avgdata.ndim == 1:
-            if climcnt[i] > 0: avgdata[i] /= climcnt[i]
-            else: avgdata[i] = 0 if np.issubdtype(var.dtype, np.integer) else np.NaN
-          else:
-            if climcnt[i] > 0: avgdata[i,:] /= climcnt[i]
-            else: avgdata[i,:] = 0 if np.issubdtype(var.dtype, np.integer) else np.NaN
+        avgdata = sums if avgdata is None else avgdata + sums # masks are combined
+        if lcount: validcnt = valid if validcnt is None else validcnt + valid
+        climcnt += cnt
+      del blocks # clean up
+      # normalize
+      cntshape = [1]*avgdata.ndim; cntshape[tidx] = interval
+      avgdata /= np.maximum(climcnt,1).reshape(cntshape)
+      if np.any(climcnt == 0): # no records for some elements
+        idx = [slice(None)]*avgdata.ndim; idx[tidx] = climcnt == 0
+        avgdata[tuple(idx)] = 0 if np.issubdtype(var.dtype, np.integer) else np.NaN
       # shift data (if first month was not January)
       if shift != 0: avgdata = np.roll(avgdata, shift, axis=tidx)
       # create new Variable
       axes = tuple([climAxis if ax.name == timeAxis else ax for ax in var.axes]) # exchange time axis
       newvar = var.copy(axes=axes, data=avgdata, dtype=var.dtype) # and, of course, load new data
       del avgdata # clean up - just to make sure
+      # add number of valid records as a separate variable
+      if lcount:
+        if shift != 0: validcnt = np.roll(validcnt, shift, axis=tidx)
+        cntatts = dict(name='{:s}_cnt'.format(var.name), units='#', 
+                       long_name='Valid Records of {:s}'.format(var.atts.get('long_name',var.name)))
+        cntvar = Variable(axes=axes, data=validcnt, atts=cntatts)
+        self.target.addVariable(cntvar, copy=True, loverwrite=True) # copy=True allows recasting as NC variable
       #     print newvar.name, newvar.masked
       #     print newvar.fillValue
       #     print newvar.data_array.__class__
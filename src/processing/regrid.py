@@ -21,13 +21,14 @@ from datasets import gridded_datasets
 from datasets.common import addLengthAndNamesOfMonth, getCommonGrid
 from processing.multiprocess import asyncPoolEC
 from processing.process import CentralProcessingUnit
-from processing.misc import getMetaData, getTargetFile, getExperimentList, loadYAML
+from processing.misc import getMetaData, getTargetFile, getExperimentList, loadYAML, getJobCost
 
 
 # worker function that is to be passed to asyncPool for parallel execution; use of the decorator is assumed
 def performRegridding(dataset, mode, griddef, dataargs, loverwrite=False, varlist=None, lwrite=True, 
-                      lreturn=False, ldebug=False, lparallel=False, pidstr='', logger=None):
-  ''' worker function to perform regridding for a given dataset and target grid '''
+                      lreturn=False, ldebug=False, lparallel=False, pidstr='', logger=None, regrid_args=None):
+  ''' worker function to perform regridding for a given dataset and target grid; regrid_args are passed 
+      to CPU.Regrid (e.g. interpolation methods and regridding plans) '''
   # input checking
   if not isinstance(dataset,basestring): raise TypeError
   if not isinstance(dataargs,dict): raise TypeError # all dataset arguments are kwargs 
@@ -117,7 +118,7 @@ def performRegridding(dataset, mode, griddef, dataargs, loverwrite=False, varlis
     # perform regridding (if target grid is different from native grid!)
     if griddef.name != dataset:
       # reproject and resample (regrid) dataset
-      CPU.Regrid(griddef=griddef, flush=True)
+      CPU.Regrid(griddef=griddef, flush=True, **(regrid_args or dict()))
 
     # get results    
     CPU.sync(flush=True)
@@ -163,6 +164,10 @@ if __name__ == '__main__':
   if os.environ.has_key('PYAVG_THREADS'): 
     NP = int(os.environ['PYAVG_THREADS'])
   else: NP = None
+  # recycle worker processes after this many jobs (releases memory; default: never)
+  if os.environ.has_key('PYAVG_MAXTASKS'): 
+    maxtasksperchild = int(os.environ['PYAVG_MAXTASKS']) or None
+  else: maxtasksperchild = None
   # run script in debug mode
   if os.environ.has_key('PYAVG_DEBUG'): 
     ldebug =  os.environ['PYAVG_DEBUG'] == 'DEBUG' 
@@ -182,6 +187,7 @@ if __name__ == '__main__':
     config = loadYAML('regrid.yaml', lfeedback=True)
     # read config object
     NP = NP or config['NP']
+    maxtasksperchild = maxtasksperchild or config.get('maxtasksperchild',None)
     loverwrite = config['loverwrite']
     # source data specs
     modes = config['modes']
@@ -204,6 +210,9 @@ if __name__ == '__main__':
     domains = config['domains']
     # target data specs
     grids = config['grids']
+    # interpolation ('average' or 'bilinear' use precomputed sparse weights for float variables)
+    regrid_args = dict(float_interp=config.get('float_interp',None), int_interp=config.get('int_interp',None), 
+                       lplan=config.get('lplan',True), supersample=config.get('supersample',None))
   else:
     # settings for testing and debugging
 #     NP = 1 ; ldebug = True # for quick computations
@@ -226,6 +235,7 @@ if __name__ == '__main__':
     resolutions = {'CRU':'','GPCC':['025','05','10','25'],'NARR':'','CFSR':['05','031'],'NRCan':'NA12'}; unity_grid = 'arb2_d02'
     datasets = []
     lLTM = True # also regrid the long-term mean climatologies 
+    regrid_args = dict(float_interp=None, lplan=True) # GDAL default for floats; 'average' uses sparse weights
 #     datasets += ['NRCan']; lLTM = False; periods = [(1970,2000),(1980,2010)] # NRCan normals period
 #     resolutions = {'NRCan': ['na12_ephemeral','na12_maritime','na12_prairies'][1:2]}
 #     datasets += ['PRISM','GPCC','PCIC']; #periods = None
@@ -419,9 +429,12 @@ if __name__ == '__main__':
                                                          domain=domain, period=period)) )
       
   # static keyword arguments
-  kwargs = dict(loverwrite=loverwrite, varlist=varlist)
+  kwargs = dict(loverwrite=loverwrite, varlist=varlist, regrid_args=regrid_args)
   
   ## call parallel execution function
-  ec = asyncPoolEC(performRegridding, args, kwargs, NP=NP, ldebug=ldebug, ltrialnerror=True)
+  # estimate job cost from source file size, so that large jobs are scheduled first
+  costs = [getJobCost(arg[0], arg[1], arg[-1]) for arg in args]
+  ec = asyncPoolEC(performRegridding, args, kwargs, NP=NP, ldebug=ldebug, ltrialnerror=True, costs=costs, 
+                   maxtasksperchild=maxtasksperchild)
   # exit with fraction of failures (out of 10) as exit code
   exit(int(10+int(10.*ec/len(args))) if ec > 0 else 0)
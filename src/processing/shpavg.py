@@ -20,14 +20,14 @@ from geodata.netcdf import DatasetNetCDF
 from geodata.base import Dataset
 from datasets import gridded_datasets
 from processing.misc import getMetaData, getTargetFile, getExperimentList, loadYAML,\
-  getProjectVars
+  getProjectVars, getJobCost
 from processing.multiprocess import asyncPoolEC
 from processing.process import CentralProcessingUnit
 
 
 # worker function that is to be passed to asyncPool for parallel execution; use of the decorator is assumed
 def performShapeAverage(dataset, mode, shape_name, shape_dict, dataargs, loverwrite=False, varlist=None, 
-                        lwrite=True, lreturn=False, lappend=False,
+                        lwrite=True, lreturn=False, lappend=False, supersample=None,
                         ldebug=False, lparallel=False, pidstr='', logger=None):
   ''' worker function to extract point data from gridded dataset '''  
   # input checking
@@ -115,7 +115,7 @@ def performShapeAverage(dataset, mode, shape_name, shape_dict, dataargs, loverwr
     CPU = CentralProcessingUnit(source, sink, varlist=varlist, tmp=False, feedback=ldebug)
   
     # extract data at station locations
-    CPU.ShapeAverage(shape_dict=shape_dict, shape_name=shape_name, flush=True)
+    CPU.ShapeAverage(shape_dict=shape_dict, shape_name=shape_name, supersample=supersample, flush=True)
     # get results    
     CPU.sync(flush=True)
     
@@ -152,6 +152,10 @@ if __name__ == '__main__':
   if os.environ.has_key('PYAVG_THREADS'): 
     NP = int(os.environ['PYAVG_THREADS'])
   else: NP = None
+  # recycle worker processes after this many jobs (releases memory; default: never)
+  if os.environ.has_key('PYAVG_MAXTASKS'): 
+    maxtasksperchild = int(os.environ['PYAVG_MAXTASKS']) or None
+  else: maxtasksperchild = None
   # run script in debug mode
   if os.environ.has_key('PYAVG_DEBUG'): 
     ldebug =  os.environ['PYAVG_DEBUG'] == 'DEBUG' 
@@ -171,6 +175,7 @@ if __name__ == '__main__':
     config = loadYAML('shpavg.yaml', lfeedback=True)
     # read config object
     NP = NP or config['NP']
+    maxtasksperchild = maxtasksperchild or config.get('maxtasksperchild',None)
     loverwrite = config['loverwrite']
     lappend = config['lappend']
     # source data specs
@@ -196,6 +201,7 @@ if __name__ == '__main__':
     # target data specs
     shape_name = config['shape_name']
     shapes = config['shapes']
+    supersample = config.get('supersample',None)
   else:
 #     NP = 1 ; ldebug = True # for quick computations
     NP = 3; ldebug = False # for quick computations
@@ -272,6 +278,7 @@ if __name__ == '__main__':
 #     WRF_filetypes = ('aux',)
     grid = 'grw2' # grid parameter to load datasets
     # define shape data  
+    supersample = None # supersampling factor for fractional coverage of grid cells (None: binary masks)
     shapes = OrderedDict()
 #     shape_name = 'shpavg' # all Canadian shapes
 #     shapes['provinces'] = None # Canadian provinces from EC module
@@ -397,9 +404,12 @@ if __name__ == '__main__':
                                                                     grid=grid, domain=domain, period=period)) )
       
   # static keyword arguments
-  kwargs = dict(loverwrite=loverwrite, varlist=varlist)
+  kwargs = dict(loverwrite=loverwrite, varlist=varlist, supersample=supersample)
           
   ## call parallel execution function
-  ec = asyncPoolEC(performShapeAverage, args, kwargs, NP=NP, ldebug=ldebug, ltrialnerror=True)
+  # estimate job cost from source file size, so that large jobs are scheduled first
+  costs = [getJobCost(arg[0], arg[1], arg[-1]) for arg in args]
+  ec = asyncPoolEC(performShapeAverage, args, kwargs, NP=NP, ldebug=ldebug, ltrialnerror=True, costs=costs, 
+                   maxtasksperchild=maxtasksperchild)
   # exit with fraction of failures (out of 10) as exit code
   exit(int(10+int(10.*ec/len(args))) if ec > 0 else 0)
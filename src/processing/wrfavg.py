@@ -212,6 +212,10 @@ if __name__ == '__main__':
   if os.environ.has_key('PYAVG_THREADS'): 
     NP = int(os.environ['PYAVG_THREADS'])
   else: NP = None
+  # recycle worker processes after this many jobs (releases memory; default: never)
+  if os.environ.has_key('PYAVG_MAXTASKS'): 
+    maxtasksperchild = int(os.environ['PYAVG_MAXTASKS']) or None
+  else: maxtasksperchild = None
   # run script in debug mode
   if os.environ.has_key('PYAVG_DEBUG'): 
     ldebug =  os.environ['PYAVG_DEBUG'] == 'DEBUG' 
@@ -232,6 +236,7 @@ if __name__ == '__main__':
     config = loadYAML('wrfavg.yaml', lfeedback=True)
     # read config object
     NP = NP or config['NP']
+    maxtasksperchild = maxtasksperchild or config.get('maxtasksperchild',None)
     loverwrite = config['loverwrite']
     # source data specs
     varlist = config['varlist']
@@ -312,6 +317,12 @@ if __name__ == '__main__':
   # static keyword arguments
   kwargs = dict(periods=periods, offset=offset, griddef=griddef, loverwrite=loverwrite, varlist=varlist)        
   # call parallel execution function
-  ec = asyncPoolEC(computeClimatology, args, kwargs, NP=NP, ldebug=ldebug, ltrialnerror=True)
+  # estimate job cost from the size of the source file, so that large jobs are scheduled first
+  costs = []
+  for experiment,filetype,domain in args:
+    filepath = '{:s}/{:s}'.format(experiment.avgfolder, fileclasses[filetype].tsfile.format(domain,''))
+    costs.append(os.path.getsize(filepath) if os.path.exists(filepath) else 0) # missing files are skipped anyway
+  ec = asyncPoolEC(computeClimatology, args, kwargs, NP=NP, ldebug=ldebug, ltrialnerror=True, costs=costs, 
+                   maxtasksperchild=maxtasksperchild)
   # exit with fraction of failures (out of 10) as exit code
   exit(int(10+int(10.*ec/len(args))) if ec > 0 else 0)
@@ -9,6 +9,7 @@ Random utility functions...
 # external imports
 import numpy as np
 import scipy.linalg as la
+import os, tempfile, zipfile
 from utils.signalsmooth import smooth
 import collections as col
 # internal imports
@@ -582,4 +583,35 @@ def tail(f, n=20):
         size -= linesFound
         bytes -= BUFSIZ
         block -= 1
-    return ''.join(data).splitlines()[-n:]
\ No newline at end of file
+    return ''.join(data).splitlines()[-n:]
+
+
+## atomic file I/O for cache files
+def atomicSave(filepath, savefct, *args, **kwargs):
+    ''' write a file atomically: savefct is called with a handle to a temporary file in the same folder 
+        (followed by args and kwargs), and the temporary file is renamed to filepath afterwards, so that 
+        concurrent readers never see a partially written file '''
+    folder = os.path.dirname(filepath) or '.'
+    fd, tmpfile = tempfile.mkstemp(dir=folder, prefix='.'+os.path.basename(filepath), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as filehandle: savefct(filehandle, *args, **kwargs)
+        os.chmod(tmpfile, 0o644) # mkstemp only grants access to the owner
+        os.rename(tmpfile, filepath) # atomic on POSIX systems
+    except:
+        if os.path.exists(tmpfile): os.remove(tmpfile)
+        raise
+
+def saveNPZ(filepath, lcompress=True, **arrays):
+    ''' save arrays to a (compressed) numpy npz file atomically (see atomicSave) '''
+    atomicSave(filepath, np.savez_compressed if lcompress else np.savez, **arrays)
+
+def loadNPZ(filepath):
+    ''' load all arrays from a numpy npz file into a dictionary; returns None, if the file does not exist or 
+        can not be read (e.g. truncated), so that the result can be treated as a cache miss '''
+    if not os.path.exists(filepath): return None
+    try:
+        npz = np.load(filepath)
+        try: arrays = {key:npz[key] for key in npz.files}
+        finally: npz.close()
+    except (IOError, OSError, ValueError, EOFError, zipfile.BadZipfile): return None
+    return arrays
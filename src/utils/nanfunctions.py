@@ -12,6 +12,10 @@ Functions
 - `nanmean` -- mean of non-NaN values
 - `nanvar` -- variance of non-NaN values
 - `nanstd` -- standard deviation of non-NaN values
+- `nanmoments` -- count, sum, mean and squared deviations of non-NaN values
+- `merge_moments` -- combine moments of two blocks of data
+- `moments_to_stat` -- compute a statistic from (merged) moments
+- `nanstats` -- several statistics of non-NaN values in a single pass
 
 """
 from __future__ import division, absolute_import, print_function
@@ -22,7 +26,8 @@ import numpy as np
 
 __all__ = [
     'nansum', 'nanmax', 'nanmin', 'nanargmax', 'nanargmin', 'nanmean',
-    'nanvar', 'nanstd'
+    'nanvar', 'nanstd', 'nansem', 'nanmoments', 'merge_moments', 
+    'moments_to_stat', 'nanstats'
     ]
 
 
@@ -605,6 +610,8 @@ def nanmean(a, axis=None, dtype=None, out=None, keepdims=False):
     array([ 1.,  3.5])
 
     """
+    if _use_nanstats(a, out):
+        return nanstats(a, axis=axis, stats='mean', dtype=dtype, keepdims=keepdims)
     arr, mask = _replace_nan(a, 0)
     if mask is None:
         return np.mean(arr, axis=axis, dtype=dtype, out=out, keepdims=keepdims)
@@ -726,6 +733,9 @@ def nanvar(a, axis=None, dtype=None, out=None, dof=None, ddof=0, keepdims=False)
     array([ 0.,  0.25])
 
     """
+    if _use_nanstats(a, out):
+        return nanstats(a, axis=axis, stats='var', dtype=dtype, dof=dof, ddof=ddof,
+                        keepdims=keepdims)
     arr, mask = _replace_nan(a, 0)
     if mask is None:
         if dof is not None:
@@ -877,6 +887,9 @@ def nanstd(a, axis=None, dtype=None, out=None, dof=None, ddof=0, keepdims=False)
     array([ 0.,  0.5])
 
     """
+    if _use_nanstats(a, out):
+        return nanstats(a, axis=axis, stats='std', dtype=dtype, dof=dof, ddof=ddof,
+                        keepdims=keepdims)
     var = nanvar(a, axis=axis, dtype=dtype, out=out, ddof=ddof, dof=dof,
                  keepdims=keepdims)
     if isinstance(var, np.ndarray):
@@ -961,6 +974,9 @@ def nansem(a, axis=None, dtype=None, out=None, dof=None, ddof=0, keepdims=False)
     numpy.doc.ufuncs : Section "Output arguments"
 
     """
+    if _use_nanstats(a, out):
+        return nanstats(a, axis=axis, stats='sem', dtype=dtype, dof=dof, ddof=ddof,
+                        keepdims=keepdims)
     arr, mask = _replace_nan(a, 0)
     if mask is None:
         if dof is None:
@@ -1031,3 +1047,237 @@ def nansem(a, axis=None, dtype=None, out=None, dof=None, ddof=0, keepdims=False)
     elif axis is None and not keepdims and sem.size == 1:
         sem = np.asscalar(sem)
     return sem
+
+
+def nanmoments(a, axis=-1, lextrema=True):
+    """
+    Compute the moments of a block of data along the specified axis,
+    ignoring NaNs and masked values. The moments of several blocks can be
+    combined with `merge_moments`, so that statistics of large arrays can
+    be accumulated block-by-block (e.g. when streaming data from disk).
+
+    Parameters
+    ----------
+    a : array_like
+        Block of data; masked values are treated like NaNs.
+    axis : int, optional
+        Axis along which the moments are computed.
+    lextrema : bool, optional
+        Also compute the minimum and maximum.
+
+    Returns
+    -------
+    moments : dict
+        Dictionary with the count ('cnt'), sum ('sum'), mean ('mean') and 
+        sum of squared deviations from the mean ('m2') of valid values, and
+        optionally minimum ('min') and maximum ('max'); all in float64.
+
+    See Also
+    --------
+    merge_moments, moments_to_stat
+
+    """
+    if isinstance(a, np.ma.MaskedArray):
+        valid = ~np.ma.getmaskarray(a)
+        a = a.filled(0)
+    else:
+        valid = None
+    arr = np.asarray(a, dtype=np.float64)
+    if valid is None:
+        valid = ~np.isnan(arr)
+    else:
+        valid &= ~np.isnan(arr)
+    arr = np.where(valid, arr, 0.)
+    cnt = valid.sum(axis=axis)
+    tot = arr.sum(axis=axis)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        avg = np.where(cnt > 0, tot/cnt, 0.)
+    dev = arr - np.expand_dims(avg, axis)
+    dev *= valid
+    moments = dict(cnt=cnt, sum=tot, mean=avg, m2=np.sum(dev*dev, axis=axis))
+    if lextrema:
+        moments['min'] = np.where(valid, arr, np.inf).min(axis=axis)
+        moments['max'] = np.where(valid, arr, -np.inf).max(axis=axis)
+    return moments
+
+
+def merge_moments(acc, moments):
+    """
+    Merge the moments of a new block into the accumulated moments, using
+    the parallel algorithm of Chan et al. for the squared deviations. If
+    `acc` is None, `moments` are returned as they are.
+
+    See Also
+    --------
+    nanmoments, moments_to_stat
+
+    """
+    if acc is None:
+        return moments
+    na = acc['cnt']
+    nb = moments['cnt']
+    cnt = na + nb
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = np.where(cnt > 0, nb/cnt, 0.)
+    delta = moments['mean'] - acc['mean']
+    acc['mean'] = acc['mean'] + delta*frac
+    acc['m2'] = acc['m2'] + moments['m2'] + delta*delta*na*frac
+    acc['sum'] = acc['sum'] + moments['sum']
+    acc['cnt'] = cnt
+    if 'min' in acc and 'min' in moments:
+        acc['min'] = np.fmin(acc['min'], moments['min'])
+        acc['max'] = np.fmax(acc['max'], moments['max'])
+    return acc
+
+
+def moments_to_stat(moments, stat, dof=None, ddof=0):
+    """
+    Compute a statistic from (accumulated) moments; `stat` can be 'count',
+    'sum', 'mean', 'var', 'std', 'sem', 'min' or 'max'. The conventions are 
+    those of the corresponding nan-functions, i.e. slices without valid 
+    values (or without degrees of freedom) are NaN, except for counts and 
+    sums, which are 0; `dof` overrides the degrees of freedom ``N - ddof``.
+
+    See Also
+    --------
+    nanmoments, merge_moments
+
+    """
+    cnt = moments['cnt']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if stat == 'count':
+            res = cnt
+        elif stat == 'sum':
+            res = moments['sum']
+        elif stat == 'mean':
+            res = np.where(cnt > 0, moments['sum']/cnt, np.nan)
+        elif stat in ('var', 'std', 'sem'):
+            if dof is None:
+                dof = cnt - ddof
+            if stat == 'sem':
+                res = np.sqrt(moments['m2'])/dof
+            else:
+                res = moments['m2']/dof
+                if stat == 'std':
+                    res = np.sqrt(res)
+            res = np.where(dof > 0, res, np.nan)
+        elif stat in ('min', 'max'):
+            if stat not in moments:
+                raise ValueError("Extrema were not computed.")
+            res = np.where(cnt > 0, moments[stat], np.nan)
+        else:
+            raise ValueError(stat)
+    return res
+
+
+def _use_nanstats(a, out=None):
+    """
+    Check if the block-wise moment accumulation of `nanstats` can be used
+    for a reduction, i.e. `a` is a masked array or an array of real
+    floating point type, and no output array is given.
+    """
+    if out is not None or not isinstance(a, np.ndarray):
+        return False
+    if issubclass(a.dtype.type, np.complexfloating):
+        return False
+    return isinstance(a, np.ma.MaskedArray) or issubclass(a.dtype.type, np.floating)
+
+
+def nanstats(a, axis=None, stats=('mean', 'var'), dtype=None, dof=None, ddof=0,
+             keepdims=False, blocksize=None):
+    """
+    Compute several statistics of the non-NaN (and non-masked) values along
+    the specified axis in a single pass over the data.
+
+    The array is traversed in blocks along the reduction axis; the moments 
+    of each block are computed with `nanmoments` and accumulated with 
+    `merge_moments`, so that NaNs are never replaced in a copy of the whole
+    array and temporary arrays are limited to the size of one block.
+
+    Parameters
+    ----------
+    a : array_like
+        Input array; masked values are treated like NaNs.
+    axis : int, optional
+        Axis along which the statistics are computed. The default is to 
+        compute the statistics of the flattened array.
+    stats : str or sequence of str, optional
+        Statistics to compute: 'count', 'sum', 'mean', 'var', 'std', 'sem',
+        'min' and/or 'max'.
+    dtype : data-type, optional
+        Type of the results; accumulation is always in float64. The default
+        is the type of `a` for floating point input and float64 otherwise.
+    dof : int, optional
+        Degrees of Freedom; usually determined from the count and ddof
+    ddof : int, optional
+        "Delta Degrees of Freedom": the divisor used for 'var', 'std' and 
+        'sem' is ``N - ddof``, where ``N`` is the number of valid elements.
+    keepdims : bool, optional
+        If this is set to True, the reduced axis is left in the result as a
+        dimension with size one.
+    blocksize : int, optional
+        Number of elements along the reduction axis in each block; by 
+        default blocks contain approximately 2**22 elements.
+
+    Returns
+    -------
+    results : dict
+        Dictionary with one array for each statistic; if `stats` is a 
+        string, only the array for this statistic is returned. Slices 
+        without valid values are NaN (except for counts and sums, which are
+        0); results are masked there, if `a` is a masked array.
+
+    See Also
+    --------
+    nanmoments, merge_moments, moments_to_stat
+
+    """
+    lsingle = isinstance(stats, str)
+    if lsingle:
+        stats = (stats,)
+    a = np.asanyarray(a)
+    lmasked = isinstance(a, np.ma.MaskedArray)
+    if dtype is None:
+        dtype = a.dtype if issubclass(a.dtype.type, np.floating) else np.float64
+    if axis is None:
+        shape = (1,)*a.ndim
+        a = a.reshape(-1)
+        axis = 0
+    else:
+        if axis < 0:
+            axis += a.ndim
+        shape = a.shape[:axis] + (1,) + a.shape[axis+1:]
+    n = a.shape[axis]
+    if blocksize is None:
+        blocksize = max(1, 2**22 // max(1, a.size // max(1, n)))
+    lextrema = any(stat in ('min', 'max') for stat in stats)
+    # accumulate moments block by block (views along the reduction axis)
+    acc = None
+    slc = [slice(None)]*a.ndim
+    for i in range(0, max(n, 1), blocksize):
+        slc[axis] = slice(i, i+blocksize)
+        acc = merge_moments(acc, nanmoments(a[tuple(slc)], axis=axis, lextrema=lextrema))
+    # compute statistics
+    results = dict()
+    for stat in stats:
+        res = np.asarray(moments_to_stat(acc, stat, dof=dof, ddof=ddof))
+        res = res.astype(np.intp if stat == 'count' else dtype)
+        if keepdims:
+            res = res.reshape(shape)
+        if lmasked:
+            cnt = acc['cnt'].reshape(shape) if keepdims else acc['cnt']
+            res = np.ma.masked_where(cnt == 0, res)
+        elif res.ndim == 0:
+            res = res[()]
+        results[stat] = res
+    return results[stats[0]] if lsingle else results
+
+
+# nan-functions (and their numpy equivalents) that can be computed with
+# nanstats, and the corresponding statistic
+nanstats_functions = {nanmean: 'mean', nansum: 'sum', nanvar: 'var', nanstd: 'std',
+                      nansem: 'sem', nanmin: 'min', nanmax: 'max'}
+for _name in ('nanmean', 'nansum', 'nanvar', 'nanstd', 'nanmin', 'nanmax'):
+    if hasattr(np, _name):
+        nanstats_functions[getattr(np, _name)] = _name[3:]
+del _name
@@ -0,0 +1,87 @@
+'''
+Created on 2026-10-16
+
+A persistent pool of worker processes and memory-mapped (shared) arrays; the workers receive only file 
+names and offsets, and write their results directly to the shared output array. This module has no 
+dependencies within the project, so that it can be used by the datasets and processing packages alike.
+
+@author: Andre R. Erler, GPL v3
+'''
+
+# external imports
+import multiprocessing
+import os
+import atexit
+import shutil
+import tempfile
+import numpy as np
+
+
+## persistent worker pool and RAM-backed folder for shared arrays
+
+shared_folder = '/dev/shm' if os.path.isdir('/dev/shm') else None # RAM-backed file system, if available
+worker_pool = dict(pool=None, NP=None) # persistent pool of workers (reused between calls)
+
+def getSharedFolder(nbytes, margin=1.5):
+  ''' return the RAM-backed folder for shared arrays, if it has enough free space for nbytes (with a safety 
+      margin), otherwise None (i.e. the default temporary folder); running out of space in /dev/shm 
+      would crash workers with a SIGBUS, rather than raise an error '''
+  if shared_folder is None: return None
+  try: 
+    stat = os.statvfs(shared_folder)
+    free = stat.f_bavail * stat.f_frsize
+  except OSError: return None
+  return shared_folder if free > margin*nbytes else None
+
+def getWorkerPool(NP):
+  ''' return the persistent worker pool; a new pool is only created, if the number of processes changes '''
+  if worker_pool['pool'] is None or worker_pool['NP'] != NP:
+    closeWorkerPool()
+    worker_pool['pool'] = multiprocessing.Pool(processes=NP); worker_pool['NP'] = NP
+  return worker_pool['pool']
+
+def closeWorkerPool():
+  ''' terminate the persistent worker pool (also called at exit) '''
+  if worker_pool['pool'] is not None:
+    worker_pool['pool'].terminate(); worker_pool['pool'].join()
+  worker_pool['pool'] = None; worker_pool['NP'] = None
+atexit.register(closeWorkerPool)
+
+
+## fill rows of a shared array
+
+def shared_rows_worker(fct, n, i0, i1, outpath=None, outshape=None, outdtype=None, args=(), kwargs=None):
+  ''' worker function: write the result of fct(*args, **kwargs) to the (flattened) row n of the shared 
+      output array, between indices i0 and i1 '''
+  result = fct(*args, **kwargs) # compute first, so that the output is only opened briefly
+  outdata = np.memmap(outpath, dtype=outdtype, mode='r+', shape=outshape)
+  outdata.reshape((outshape[0],-1))[n,i0:i1] = result
+  outdata.flush(); del outdata
+  return n
+
+def shared_fill_rows(fct, arglist, bounds, shape, dtype, fillValue=np.NaN, NP=None, ldebug=False, kwargs=None):
+  ''' fill the rows of a preallocated array with the results of fct(*args, **kwargs), one row for each 
+      element of arglist and between the (flattened) indices in bounds; the rows are computed by the 
+      persistent worker pool and written directly to a shared memory-mapped array '''
+  if len(arglist) != shape[0] or len(bounds) != shape[0]: 
+    raise ValueError, "Need one argument tuple and one pair of bounds for each row."
+  kwargs = kwargs or dict()
+  tmpdir = tempfile.mkdtemp(prefix='rows_', dir=getSharedFolder(int(np.prod(shape))*np.dtype(dtype).itemsize))
+  try:
+    outpath = os.path.join(tmpdir,'output.dat')
+    outdata = np.memmap(outpath, dtype=dtype, mode='w+', shape=shape)
+    outdata[:] = fillValue; outdata.flush(); del outdata
+    # distribute rows to workers
+    pool = getWorkerPool(NP)
+    shared = dict(outpath=outpath, outshape=shape, outdtype=dtype, kwargs=kwargs)
+    results = []
+    for n,(args,(i0,i1)) in enumerate(zip(arglist,bounds)):
+      results.append(pool.apply_async(shared_rows_worker, (fct, n, i0, i1), dict(args=args, **shared)))
+    for result in results: 
+      n = result.get() # wait for workers and raise errors
+      if ldebug: print('   Completed Row #{:d}'.format(n+1))
+    # copy results into memory
+    data = np.array(np.memmap(outpath, dtype=dtype, mode='r', shape=shape))
+  finally:
+    shutil.rmtree(tmpdir, ignore_errors=True)
+  return data
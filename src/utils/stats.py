@@ -12,8 +12,8 @@ from scipy.stats.stats import _chk_asarray, rankdata, distributions
 from scipy.special import betainc
 
 # helper function
-def _sum_of_squares(x):
-    return np.sum(x**2)
+def _sum_of_squares(x, axis=None):
+    return np.sum(x**2, axis=axis)
 
 # helper function
 def _betai(a, b, x):
@@ -205,6 +205,158 @@ def spearmanr(a, b=None, axis=0, dof=None):
     else:
         return rs, prob
 
+## vectorized two-sample statistics along the last axis
+# N.B.: these functions operate on entire arrays of samples at once (one sample per grid point along
+#       the last axis); NaN's are treated as missing values, and points with too few valid values 
+#       (or any NaN, if ignoreNaN is False) return NaN
+
+# helper function
+def _tdist_pval(t_squared, df):
+    ''' two-sided p-value of Student's t-distribution from the squared t-statistic '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        prob = _betai(0.5*df, 0.5, df / (df + t_squared))
+    return np.where(np.isnan(t_squared) | np.isnan(df), np.NaN, prob) # _betai turns NaN into 1
+
+# helper function
+def _invalid_points(n1, n2, size, ignoreNaN=True, nmin=3):
+    ''' mask of points with too few valid values or, if NaN's are not ignored, any NaN '''
+    if ignoreNaN: return (n1 < nmin) | (n2 < nmin)
+    else: return (n1 < size[0]) | (n2 < size[1])
+
+# helper function
+def _count_mean_var(x, valid):
+    ''' NaN-aware sample size, mean and unbiased variance along the last axis '''
+    n = valid.sum(axis=-1).astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(valid, x, 0.).sum(axis=-1) / n
+        dev = np.where(valid, x - mean[...,np.newaxis], 0.)
+        var = _sum_of_squares(dev, axis=-1) / (n - 1.)
+    return n, mean, dev, var
+
+## Student's T-test for two independent samples
+def ttest_ind_array(a, b, equal_var=True, ignoreNaN=True, nmin=3):
+    """
+    Vectorized version of scipy.stats.ttest_ind along the last axis, with 
+    NaN's removed from each sample independently; returns the t-statistic 
+    and the two-tailed p-value for each point.
+    """
+    a = np.asarray(a, dtype=np.float64); b = np.asarray(b, dtype=np.float64)
+    valid1 = ~np.isnan(a); valid2 = ~np.isnan(b)
+    n1, m1, dev1, v1 = _count_mean_var(a, valid1); del dev1
+    n2, m2, dev2, v2 = _count_mean_var(b, valid2); del dev2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if equal_var:
+            df = n1 + n2 - 2.
+            svar = ((n1 - 1.) * v1 + (n2 - 1.) * v2) / df
+            denom = np.sqrt(svar * (1./n1 + 1./n2))
+        else:
+            vn1 = v1 / n1; vn2 = v2 / n2
+            df = (vn1 + vn2)**2 / (vn1**2 / (n1 - 1.) + vn2**2 / (n2 - 1.))
+            denom = np.sqrt(vn1 + vn2)
+        t = (m1 - m2) / denom
+    prob = _tdist_pval(t*t, df)
+    invalid = _invalid_points(n1, n2, (a.shape[-1],b.shape[-1]), ignoreNaN=ignoreNaN, nmin=nmin)
+    t = np.where(invalid, np.NaN, t); prob = np.where(invalid, np.NaN, prob)
+    return t, prob
+
+## Kolmogorov-Smirnov Test on 2 samples
+def ks_2samp_array(a, b, ignoreNaN=True, nmin=3):
+    """
+    Vectorized version of scipy.stats.ks_2samp along the last axis: the 
+    statistic D is computed from a sorted merge of both samples, where 
+    the cumulative sum of the weights +1/n1 and -1/n2 is the difference 
+    of the empirical CDFs; it is evaluated only at the last value of a 
+    group of ties. The p-value uses the asymptotic distribution of D, as
+    in older versions of scipy.stats.ks_2samp.
+    """
+    a = np.asarray(a, dtype=np.float64); b = np.asarray(b, dtype=np.float64)
+    valid1 = ~np.isnan(a); valid2 = ~np.isnan(b)
+    n1 = valid1.sum(axis=-1).astype(np.float64)
+    n2 = valid2.sum(axis=-1).astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w1 = np.where(valid1, 1./n1[...,np.newaxis], 0.)
+        w2 = np.where(valid2, -1./n2[...,np.newaxis], 0.)
+    data = np.concatenate((a,b), axis=-1)
+    idx = np.argsort(data, axis=-1, kind='mergesort') # NaN's are sorted to the end
+    data = np.take_along_axis(data, idx, axis=-1)
+    cdf = np.cumsum(np.take_along_axis(np.concatenate((w1,w2), axis=-1), idx, axis=-1), axis=-1)
+    last = np.ones(data.shape, dtype=np.bool_)
+    last[...,:-1] = data[...,1:] != data[...,:-1]
+    d = np.max(np.where(last, np.abs(cdf), 0.), axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        en = np.sqrt(n1 * n2 / (n1 + n2))
+        prob = distributions.kstwobign.sf((en + 0.12 + 0.11 / en) * d)
+    invalid = _invalid_points(n1, n2, (a.shape[-1],b.shape[-1]), ignoreNaN=ignoreNaN, nmin=nmin)
+    d = np.where(invalid, np.NaN, d); prob = np.where(invalid, np.NaN, prob)
+    return d, prob
+
+## ranks along the last axis
+def rankdata_array(a):
+    """
+    Vectorized version of rankdata along the last axis; ties are assigned
+    the average of their ranks. The first and last position of each group 
+    of ties are propagated with cumulative maxima and minima.
+    """
+    a = np.asarray(a)
+    n = a.shape[-1]
+    idx = np.argsort(a, axis=-1, kind='mergesort')
+    s = np.take_along_axis(a, idx, axis=-1)
+    pos = np.arange(n) * np.ones(s.shape, dtype=np.int64) # broadcast
+    first = np.ones(s.shape, dtype=np.bool_); first[...,1:] = s[...,1:] != s[...,:-1]
+    last = np.ones(s.shape, dtype=np.bool_); last[...,:-1] = first[...,1:]
+    ifirst = np.maximum.accumulate(np.where(first, pos, 0), axis=-1)
+    ilast = np.minimum.accumulate(np.where(last, pos, n-1)[...,::-1], axis=-1)[...,::-1]
+    ranks = np.empty(s.shape, dtype=np.float64)
+    np.put_along_axis(ranks, idx, 0.5 * (ifirst + ilast) + 1., axis=-1)
+    return ranks
+
+# helper function
+def _corrcoef_array(x, y, valid):
+    ''' linear correlation coefficient of valid pairs along the last axis '''
+    n = valid.sum(axis=-1).astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xm = np.where(valid, x - np.where(valid, x, 0.).sum(axis=-1, keepdims=True) / n[...,np.newaxis], 0.)
+        ym = np.where(valid, y - np.where(valid, y, 0.).sum(axis=-1, keepdims=True) / n[...,np.newaxis], 0.)
+        r = np.add.reduce(xm * ym, axis=-1) / np.sqrt(_sum_of_squares(xm, axis=-1) * _sum_of_squares(ym, axis=-1))
+    return np.clip(r, -1.0, 1.0), n
+
+## Pearson's linear correlation coefficient
+def pearsonr_array(x, y, dof=None, ignoreNaN=True, nmin=3):
+    """
+    Vectorized version of pearsonr along the last axis; pairs with a NaN 
+    in either sample are removed. Returns the correlation coefficient and
+    the two-tailed p-value for each point.
+    """
+    x = np.asarray(x, dtype=np.float64); y = np.asarray(y, dtype=np.float64)
+    valid = ~( np.isnan(x) | np.isnan(y) )
+    r, n = _corrcoef_array(x, y, valid)
+    df = n-2 if dof is None else np.zeros_like(n) + dof
+    with np.errstate(divide='ignore', invalid='ignore'):
+        prob = _tdist_pval(r*r * (df / ((1.0 - r) * (1.0 + r))), df) # zero, if abs(r) == 1
+    invalid = _invalid_points(n, n, (x.shape[-1],y.shape[-1]), ignoreNaN=ignoreNaN, nmin=nmin)
+    r = np.where(invalid, np.NaN, r); prob = np.where(invalid, np.NaN, prob)
+    return r, prob
+
+## Spearman's rank correlation coefficient
+def spearmanr_array(x, y, dof=None, ignoreNaN=True, nmin=3):
+    """
+    Vectorized version of spearmanr along the last axis; pairs with a NaN
+    in either sample are removed before ranking (missing values are sorted
+    to the end). Returns the rank correlation coefficient and the two-tailed
+    p-value for each point.
+    """
+    x = np.asarray(x, dtype=np.float64); y = np.asarray(y, dtype=np.float64)
+    valid = ~( np.isnan(x) | np.isnan(y) )
+    rx = rankdata_array(np.where(valid, x, np.inf))
+    ry = rankdata_array(np.where(valid, y, np.inf))
+    rs, n = _corrcoef_array(rx, ry, valid)
+    df = n-2 if dof is None else np.zeros_like(n) + dof - 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        prob = _tdist_pval(rs*rs * (df / ((1.0 - rs) * (1.0 + rs))), df)
+    invalid = _invalid_points(n, n, (x.shape[-1],y.shape[-1]), ignoreNaN=ignoreNaN, nmin=nmin)
+    rs = np.where(invalid, np.NaN, rs); prob = np.where(invalid, np.NaN, prob)
+    return rs, prob
+
 
 if __name__ == '__main__':
     pass